@@ -1,3 +1,4 @@
+import asyncio
 import json
 import unittest
 import unittest.mock
@@ -366,3 +367,59 @@ class TestRecordingLookup(unittest.TestCase):
         assert entities[1].release.musicbrainz["tag"] == []
         assert entities[1].musicbrainz["genre"] == ['big band', 'swing revival', 'jazz', 'ragtime', 'swing']
         assert entities[1].musicbrainz["tag"] == []
+
+    @staticmethod
+    def _lookup_response(mbids):
+        """ Answer a lookup with a copy of the first recording of return_json for each MBID """
+
+        template = return_json["1234a7ae-2af2-4291-aa84-bd0bafe291a1"]
+        mock = unittest.mock.MagicMock()
+        mock.status_code = 200
+        mock.text = json.dumps({mbid: dict(template, recording=dict(template["recording"], name=mbid)) for mbid in mbids})
+        return mock
+
+    @unittest.mock.patch('troi.http_request.http_post')
+    def test_read_chunks(self, req):
+        mbids = ["%08d-0000-0000-0000-000000000000" % i for i in range(9)]
+        req.side_effect = lambda url, json, headers: self._lookup_response(json["recording_mbids"][1:])
+
+        e = troi.musicbrainz.recording_lookup.RecordingLookupElement()
+        e.CHUNK_SIZE = 4
+        inputs = [troi.Recording(mbid=mbid) for mbid in mbids + mbids[:2]]
+        entities = e.read([inputs])
+
+        # 9 distinct MBIDs in chunks of 4 take 3 requests, and the first MBID of each chunk is not found
+        assert req.call_count == 3
+        assert sorted(len(call.kwargs["json"]["recording_mbids"]) for call in req.call_args_list) == [1, 4, 4]
+        expected = [mbid for mbid in mbids + mbids[:2] if mbid not in (mbids[0], mbids[4], mbids[8])]
+        assert [r.name for r in entities] == expected
+        assert [r.mbid for r in entities] == expected
+
+    @unittest.mock.patch('troi.http_request.ahttp_post')
+    def test_aread_chunks(self, req):
+        mbids = ["%08d-0000-0000-0000-000000000000" % i for i in range(5)]
+
+        async def post(url, json, headers):
+            return self._lookup_response(json["recording_mbids"])
+
+        req.side_effect = post
+        e = troi.musicbrainz.recording_lookup.RecordingLookupElement()
+        e.CHUNK_SIZE = 2
+        playlist = troi.Playlist(recordings=[troi.Recording(mbid=mbid) for mbid in reversed(mbids)])
+        result = asyncio.run(e.aread([playlist]))
+
+        assert req.call_count == 3
+        assert result is playlist
+        assert [r.name for r in playlist.recordings] == list(reversed(mbids))
+
+    @unittest.mock.patch('troi.http_request.http_post')
+    def test_stream_empty(self, req):
+        e = troi.musicbrainz.recording_lookup.RecordingLookupElement()
+        assert e.read([[]]) == list(e.stream([iter([])])) == []
+
+        # A playlist without recordings is passed on, not replaced by an empty list
+        playlist = troi.Playlist(recordings=[])
+        assert e.read([playlist]) is playlist
+        assert list(e.stream([iter([playlist])])) == [playlist]
+        assert asyncio.run(e.aread([playlist])) is playlist
+        assert req.call_count == 0
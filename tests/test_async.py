@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+import unittest.mock
+
+import requests_mock
+
+import troi
+from troi import Recording, RunContext
+from troi.operations import UnionElement, DifferenceElement
+from tests.test_instrumentation import DummyInstrumentedPatch
+
+
+class Overlap:
+    """ Count the reads in progress, to check that reads overlap without timing them. """
+
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+
+    def __enter__(self):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+
+    def __exit__(self, *args):
+        self.active -= 1
+
+
+class AsyncSourceElement(troi.Element):
+
+    def __init__(self, mbids, delay=0.0, overlap=None):
+        super().__init__()
+        self.mbids = mbids
+        self.delay = delay
+        self.overlap = overlap or Overlap()
+        self.reads = 0
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        raise NotImplementedError()
+
+    async def aread(self, inputs):
+        self.reads += 1
+        with self.overlap:
+            await asyncio.sleep(self.delay)
+        return [Recording(mbid=mbid) for mbid in self.mbids]
+
+
+class TestAsync(unittest.TestCase):
+
+    def test_agenerate(self):
+        overlap = Overlap()
+        shared = AsyncSourceElement(["a", "b"], delay=.2, overlap=overlap)
+        other = AsyncSourceElement(["b"], delay=.2, overlap=overlap)
+
+        diff = DifferenceElement()
+        diff.set_sources([shared, other])
+
+        union = UnionElement()
+        union.set_sources([shared, diff])
+
+        context = RunContext()
+        result = asyncio.run(union.agenerate(True, context))
+        assert [r.mbid for r in result] == ["a", "b", "a"]
+        assert shared.reads == 1
+        assert other.reads == 1
+        # The sources were read at the same time
+        assert overlap.max_active == 2
+
+        # Each element is charged for the time its own task ran, not for the time it spent asleep
+        stats = context.instrumentation.stats()
+        assert stats["total_wall_time"] >= .2
+        assert all(element["wall_time"] < .1 for element in stats["elements"].values())
+
+    def test_many_concurrent_runs(self):
+        overlap = Overlap()
+
+        async def run_all():
+            sources = [AsyncSourceElement([str(i)], delay=.1, overlap=overlap) for i in range(100)]
+            return await asyncio.gather(*[source.agenerate(True, RunContext()) for source in sources])
+
+        results = asyncio.run(run_all())
+        assert [r[0].mbid for r in results] == [str(i) for i in range(100)]
+        assert overlap.max_active == 100
+
+    @requests_mock.Mocker()
+    def test_agenerate_playlist(self, mock_requests):
+        mock_requests.get("https://api.listenbrainz.org/1/test", json=["a", "b"])
+
+        with unittest.mock.patch("troi.http_request.have_aiohttp", False):
+            patch = DummyInstrumentedPatch({"quiet": True, "min_recordings": None})
+            playlist = asyncio.run(patch.agenerate_playlist())
+
+        assert [r.mbid for r in playlist.playlists[0].recordings] == ["a"]
+        fetch = patch.stats["elements"]["PlaylistElement/PlaylistMakerElement/FetchRecordingsElement"]
+        assert fetch["http_requests"] == 1
@@ -0,0 +1,177 @@
+import copy
+import datetime
+import random
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import troi
+import troi.filters
+import troi.listenbrainz.listens
+import troi.sorts
+from troi import ArtistCredit, Recording, RunContext
+from troi.batch import RecordingBatch
+from troi.pipeline import Pipeline
+from tests.test_filters import DummyPatch
+
+
+def make_recordings(count, seed=0):
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    recordings = []
+    for i in range(count):
+        listenbrainz = {}
+        if rng.random() < .5:
+            listenbrainz["score"] = rng.choice([-1, 0, 1])
+        if rng.random() < .5:
+            listenbrainz["latest_listened_at"] = now - datetime.timedelta(days=rng.randint(0, 30), hours=rng.randint(0, 23))
+        recordings.append(
+            Recording(mbid="mbid-%d" % rng.randint(0, count // 2) if rng.random() < .9 else None,
+                      artist_credit=ArtistCredit(artist_credit_id=rng.randint(0, 5)) if rng.random() < .9 else None,
+                      year=rng.choice([None, 0, 1970, 1985, 1999, 2005, 2020]),
+                      ranking=rng.random() if rng.random() < .8 else None,
+                      listenbrainz=listenbrainz))
+    return recordings
+
+
+class ListSourceElement(troi.Element):
+
+    def __init__(self, recordings, batch=False):
+        super().__init__()
+        self.recordings = recordings
+        self.batch = batch
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        if self.batch:
+            return RecordingBatch.from_recordings(self.recordings)
+        return list(self.recordings)
+
+
+class TestRecordingBatch(unittest.TestCase):
+
+    def test_conversion(self):
+        recordings = make_recordings(50)
+        batch = RecordingBatch.from_recordings(recordings)
+        assert len(batch) == 50
+        assert batch.to_recordings() == recordings
+        assert list(batch) == recordings
+        assert batch[3] is recordings[3]
+        assert batch.mbid[0] == (recordings[0].mbid or "")
+
+        r = Recording(mbid="a", year=1999, ranking=.5, artist_credit=ArtistCredit(artist_credit_id=7),
+                      listenbrainz={"score": -1, "latest_listened_at": datetime.datetime(2020, 1, 2)})
+        empty = Recording()
+        batch = RecordingBatch.from_recordings([r, empty])
+        assert r.has_listenbrainz() and not empty.has_listenbrainz()
+        assert empty._listenbrainz is None
+        assert batch.year.tolist() == [1999, 0]
+        assert batch.artist_credit_id.tolist() == [7, 0]
+        assert batch.score.tolist() == [-1, 0]
+        assert batch.ranking[0] == .5 and np.isnan(batch.ranking[1])
+        assert batch.latest_listened_at[0] == np.datetime64("2020-01-02")
+        assert np.isnat(batch.latest_listened_at[1])
+
+        selected = batch[np.array([False, True])]
+        assert isinstance(selected, RecordingBatch)
+        assert selected.to_recordings()[0] is empty
+
+        assert len(RecordingBatch.from_recordings([])) == 0
+
+    def test_filters_match_read(self):
+        elements = [
+            troi.filters.ArtistCreditFilterElement([1, 3]),
+            troi.filters.ArtistCreditFilterElement([1, 3], include=True),
+            troi.filters.DuplicateRecordingMBIDFilterElement(),
+            troi.filters.ConsecutiveRecordingFilterElement(),
+            troi.filters.YearRangeFilterElement(1980),
+            troi.filters.YearRangeFilterElement(1980, 2000),
+            troi.filters.YearRangeFilterElement(1980, 2000, inverse=True),
+            troi.filters.LatestListenedAtFilterElement(7),
+            troi.filters.LatestListenedAtFilterElement(7, keep_unlistened_if_empty=True),
+            troi.filters.NeverListenedFilterElement(),
+            troi.filters.NeverListenedFilterElement(remove_unlistened=False),
+            troi.filters.HatedRecordingsFilterElement(),
+            troi.sorts.YearSortElement(),
+            troi.sorts.YearSortElement(reverse=True),
+        ]
+        for count in (0, 3, 500):
+            recordings = make_recordings(count, seed=count)
+            for e in elements:
+                e.set_patch_object(DummyPatch())
+                expected = e.read([recordings])
+                storage = dict(e.local_storage)
+                result = e.read_batch([RecordingBatch.from_recordings(recordings)])
+                assert isinstance(result, RecordingBatch)
+                assert result.to_recordings() == expected, type(e).__name__
+                assert e.local_storage == storage
+
+    def test_pipeline_passes_batches(self):
+        recordings = make_recordings(200)
+        source = ListSourceElement(recordings, batch=True)
+        hated = troi.filters.HatedRecordingsFilterElement()
+        hated.set_sources(source)
+        years = troi.filters.YearRangeFilterElement(1980)
+        years.set_sources(hated)
+        dedup = troi.filters.DuplicateRecordingMBIDFilterElement()
+        dedup.set_sources(years)
+
+        expected = dedup.read([years.read([hated.read([recordings])])])
+        with mock.patch.object(RecordingBatch, "from_recordings", wraps=RecordingBatch.from_recordings) as from_recordings, \
+                mock.patch.object(troi.filters.HatedRecordingsFilterElement, "read", autospec=True) as read:
+            for result in (dedup.generate(True), Pipeline(dedup).run()):
+                assert isinstance(result, RecordingBatch)
+                assert list(result) == expected
+            # only the source converts its recordings, the filters pass the batch on
+            assert from_recordings.call_count == 2
+            assert read.call_count == 0
+
+    def test_pipeline_passes_lists(self):
+        recordings = make_recordings(200)
+        source = ListSourceElement(recordings)
+        hated = troi.filters.HatedRecordingsFilterElement()
+        hated.set_sources(source)
+        years = troi.filters.YearRangeFilterElement(1980)
+        years.set_sources(hated)
+
+        expected = years.read([hated.read([recordings])])
+        with mock.patch.object(RecordingBatch, "from_recordings") as from_recordings:
+            for result in (years.generate(True), Pipeline(years).run(), years.generate(True, RunContext(streaming=True))):
+                assert list(result) == expected
+            # lists are not converted to batches
+            assert from_recordings.call_count == 0
+
+    def test_listens_and_filter_chain(self):
+        # The periodic jams pipeline: recommendations, recent listens and a chain of listened filters
+        recordings = make_recordings(300)
+        index = {r.mbid: 1700000000 + i for i, r in enumerate(recordings[:50]) if r.mbid}
+
+        def run(batch, context=None):
+            source = ListSourceElement(copy.deepcopy(recordings), batch=batch)
+            listens = troi.listenbrainz.listens.RecentListensTimestampLookup("rob", days=2)
+            listens.index = dict(index)
+            listens.set_sources(source)
+            chain = troi.filters.FilterChainElement([troi.filters.NeverListenedFilterElement(),
+                                                     troi.filters.LatestListenedAtFilterElement(7)])
+            chain.set_sources(listens)
+            chain.set_patch_object(DummyPatch())
+            return chain.generate(True, context), chain.local_storage
+
+        (expected, expected_storage), (result, storage) = run(False), run(True)
+        assert isinstance(result, RecordingBatch)
+        assert [r.mbid for r in result] == [r.mbid for r in expected]
+        assert storage == expected_storage
+
+        result, storage = run(True, RunContext(streaming=True))
+        assert [r.mbid for r in result] == [r.mbid for r in expected]
+        assert storage == expected_storage
+
+    def test_read_batch_default(self):
+        # Elements without read_batch() are given the recordings of the batch
+        e = troi.filters.GenreFilterElement(["rock"])
+        recordings = make_recordings(10)
+        assert e.read_batch([RecordingBatch.from_recordings(recordings)]) == e.read([recordings])
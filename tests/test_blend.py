@@ -0,0 +1,73 @@
+import random
+import unittest
+from collections import Counter, deque
+
+from troi import ArtistCredit, Recording
+from troi.patches.lb_radio_classes.blend import InterleaveRecordingsElement, WeighAndBlendRecordingsElement, weighted_blend
+from troi.utils import interleave
+
+
+def recordings(prefix, count, artist_credit_id=None):
+    return [Recording(mbid="%s%d" % (prefix, i),
+                      artist_credit=ArtistCredit(artist_credit_id=artist_credit_id if artist_credit_id is not None else i))
+            for i in range(count)]
+
+
+class TestBlend(unittest.TestCase):
+
+    def test_interleave(self):
+        assert interleave([[1, 2, 3], [], [4], [5, 6]]) == [1, 4, 5, 2, 6, 3]
+
+        e = InterleaveRecordingsElement()
+        a, b = recordings("a", 3), recordings("b", 1)
+        assert e.read([a, b]) == [a[0], b[0], a[1], a[2]]
+        assert len(a) == 3
+
+    def test_weighted_blend(self):
+        queues = [deque(range(0, 1000)), deque(range(1000, 1100)), deque(), deque(range(2000, 2500))]
+        items = list(weighted_blend(queues, [3, 1, 1, 0], rng=random.Random(1)))
+        assert sorted(items) == list(range(1100))
+        assert not queues[0] and not queues[1] and len(queues[3]) == 500
+
+        # Items of each queue keep their order and the first 200 picks follow the weights
+        assert [i for i in items if i < 1000] == list(range(1000))
+        counts = Counter(i // 1000 for i in items[:200])
+        assert 120 < counts[0] < 180
+
+        assert list(weighted_blend([deque(range(10))], [1], accept=lambda i: i % 2)) == [1, 3, 5, 7, 9]
+        assert list(weighted_blend([deque([1])], [0])) == []
+
+    def test_weigh_and_blend(self):
+        random.seed(2)
+        a = recordings("a", 50)
+        b = recordings("b", 50, artist_credit_id=7)
+        c = recordings("a", 5)
+        e = WeighAndBlendRecordingsElement([2, 1, 1], max_num_recordings=30, max_artist_occurrence=3)
+        result = e.read([a, b, c])
+
+        # Seed recordings come first, unless they are duplicates
+        assert result[:2] == [a[0], b[0]]
+        assert c[0] not in result
+        assert len(result) == 30
+        assert len(set(r.mbid for r in result)) == 30
+        assert len([r for r in result if r.artist_credit.artist_credit_id == 7]) == 3
+        assert len(a) == 50
+
+        # Sources run out before max_num_recordings is reached
+        e = WeighAndBlendRecordingsElement([1, 1], max_num_recordings=100)
+        assert len(e.read([recordings("a", 10), recordings("b", 10)])) == 20
+        assert e.read([[], []]) == []
+
+    def test_weigh_and_blend_stream(self):
+        a = recordings("a", 50)
+        b = recordings("b", 50)
+        e = WeighAndBlendRecordingsElement([1, 1], max_num_recordings=10)
+        random.seed(3)
+        expected = e.read([a, b])
+        random.seed(3)
+        sources = [iter(a), iter(b)]
+        assert list(e.stream(sources)) == expected
+
+        # The sources are only read until the output is full
+        assert len(list(sources[0])) + len(list(sources[1])) >= 88
+        assert list(e.stream([iter([]), iter([])])) == []
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+
+import requests
+import requests_mock
+from click.testing import CliRunner
+
+import troi.ratelimit
+from troi.cassette import Cassette, CassetteMiss, StandInServer, use_cassette, RECORD, REPLAY, PASSTHROUGH
+from troi.cli import cli
+from troi.http_request import http_get, http_post, close_sessions
+from troi.listenbrainz.stats import UserRecordingElement
+
+LOOKUP_URL = "https://api.listenbrainz.org/1/metadata/recording"
+ARTIST_URL = "https://mb.example.org/ws/2/artist/8f6bd1e4-fbe1-4f50-aa9b-94c450ec0f11"
+SIMILAR_URL = "https://labs.api.listenbrainz.org/similar-artists/json"
+
+
+class TestCassette(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "cassette.json")
+
+    def tearDown(self):
+        close_sessions()
+        troi.ratelimit.reset()
+        self.dir.cleanup()
+
+    def record(self):
+        with requests_mock.Mocker() as mock_requests, use_cassette(self.path, RECORD) as cassette:
+            mock_requests.post(LOOKUP_URL, [{"json": {"call": 1}}, {"json": {"call": 2}}])
+            mock_requests.get(ARTIST_URL, json={"name": "Portishead"}, headers={"ETag": '"v1"'})
+            mock_requests.post(SIMILAR_URL, json=[])
+            http_post(LOOKUP_URL, json={"recording_mbids": ["a"], "inc": "artist"}, headers={"Authorization": "Token x"})
+            http_post(LOOKUP_URL, json={"recording_mbids": ["a"], "inc": "artist"})
+            http_get(ARTIST_URL, params={"fmt": "json"})
+            http_post(SIMILAR_URL, json=[{"artist_mbids": ["a"]}])
+            assert cassette.requests == 4
+
+    def test_replay(self):
+        self.record()
+        assert len(Cassette(self.path)) == 4
+        with open(self.path) as f:
+            assert "Token x" not in f.read()
+
+        # Nothing is mocked, so any request that is made would fail
+        with requests_mock.Mocker(), use_cassette(self.path, REPLAY) as cassette:
+            body = {"inc": "artist", "recording_mbids": ["a"]}
+            assert http_post(LOOKUP_URL, json=body).json() == {"call": 1}
+            assert http_post(LOOKUP_URL, json=body).json() == {"call": 2}
+            assert http_post(LOOKUP_URL, json=body).json() == {"call": 2}
+
+            r = http_get(ARTIST_URL + "?fmt=json")
+            assert r.status_code == 200
+            assert r.headers["ETag"] == '"v1"'
+            assert r.json() == {"name": "Portishead"}
+
+            with self.assertRaises(CassetteMiss):
+                http_get(ARTIST_URL)
+            assert cassette.requests == 4
+
+    def test_stand_in_server(self):
+        self.record()
+
+        with use_cassette(self.path, PASSTHROUGH) as cassette, \
+                StandInServer(Cassette(self.path), latency=.05, rate_limit=100) as server:
+            r = http_get(ARTIST_URL, params={"fmt": "json"})
+            assert r.json() == {"name": "Portishead"}
+            assert r.headers["X-RateLimit-Limit"] == "100"
+            assert r.headers["X-RateLimit-Remaining"] == "99"
+            assert cassette.http_time >= .05
+
+            r = http_post(LOOKUP_URL, json={"inc": "artist", "recording_mbids": ["a"]})
+            assert r.json() == {"call": 1}
+
+            # The stand-in answers requests that are not on the cassette with a 404
+            assert http_get(ARTIST_URL).status_code == 404
+
+        assert server.cassette.positions
+
+    def test_stand_in_rate_limit(self):
+        self.record()
+
+        # Without troi's rate limiting, the third request in the window is refused
+        with StandInServer(Cassette(self.path), rate_limit=2, rate_window=60) as server:
+            url = server.url + "/https/labs.api.listenbrainz.org/similar-artists/json"
+            responses = [requests.post(url, json=[{"artist_mbids": ["a"]}]) for _ in range(3)]
+            assert [r.status_code for r in responses] == [200, 200, 429]
+            assert responses[2].headers["X-RateLimit-Remaining"] == "0"
+
+    def test_bench(self):
+        runner = CliRunner()
+        result = runner.invoke(cli, ["bench", "-c", self.path, "--runs", "2", "list"])
+        assert result.exit_code == 0, result.output
+        assert "run 1: " in result.output
+        assert "run 2: " in result.output
+        assert "runs: 2 " in result.output
+
+        result = runner.invoke(cli, ["bench", "-c", self.path, "--record", "--stand-in", "list"])
+        assert result.exit_code != 0
+        assert "--stand-in" in result.output
+        assert not os.path.exists(self.path)
+
+    def test_listenbrainz_client(self):
+        # liblistenbrainz calls made by troi's elements go through http_fetch, so they are recorded and replayed
+        url = "https://api.listenbrainz.org/1/stats/user/rob/recordings"
+        payload = {"payload": {"recordings": [{"artist_mbids": [], "artist_name": "Portishead", "release_name": "Dummy",
+                                               "release_mbid": None, "track_name": "Roads", "recording_mbid": None}]}}
+        with requests_mock.Mocker() as mock_requests, use_cassette(self.path, RECORD) as cassette:
+            mock_requests.get(url, json=payload)
+            assert [r.name for r in UserRecordingElement("rob").read()] == ["Roads"]
+            assert cassette.requests == 1
+
+        with requests_mock.Mocker(), use_cassette(self.path, REPLAY) as cassette:
+            assert [r.name for r in UserRecordingElement("rob").read()] == ["Roads"]
+            assert cassette.requests == 1
@@ -0,0 +1,120 @@
+import time
+import unittest
+from unittest import mock
+
+import requests
+import requests_mock
+
+import troi
+import troi.http_request
+import troi.ratelimit
+from troi.listenbrainz.listens import RecentListensTimestampLookup
+from troi import Deadline, DeadlineExceeded, Recording, RunContext
+from troi.deadline import scope
+from troi.executor import ThreadedExecutor
+from troi.operations import UnionElement
+from tests.test_element import CountingSourceElement, PullCountingSourceElement
+
+
+class SlowSourceElement(troi.Element):
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        time.sleep(self.delay)
+        troi.deadline.check()
+        return [Recording(mbid="slow")]
+
+
+class SlowStreamElement(PullCountingSourceElement):
+
+    def stream(self, source_iterators):
+        for r in super().stream(source_iterators):
+            if self.pulled == 3:
+                time.sleep(.1)
+                troi.deadline.check()
+            yield r
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_deadline(self):
+        deadline = Deadline(.05)
+        assert 0 < deadline.remaining() <= .05
+        deadline.check()
+        time.sleep(.06)
+        assert deadline.expired()
+        assert deadline.remaining() == 0
+        with self.assertRaises(DeadlineExceeded):
+            deadline.check()
+
+    def test_optional_element(self):
+        slow = SlowSourceElement(.1)
+        union = UnionElement()
+        union.set_sources([CountingSourceElement(["a"]), slow])
+
+        with self.assertRaises(DeadlineExceeded):
+            union.generate(True, RunContext(deadline=Deadline(.05)))
+
+        slow.optional = True
+        for context in (RunContext(deadline=Deadline(.05)), RunContext(executor=ThreadedExecutor(2), deadline=Deadline(.05))):
+            result = union.generate(True, context)
+            assert [r.mbid for r in result] == ["a"]
+
+        # without a deadline, nothing changes
+        result = union.generate(True, RunContext())
+        assert [r.mbid for r in result] == ["a", "slow"]
+
+    def test_optional_stream(self):
+        source = SlowStreamElement(10)
+        source.optional = True
+        result = source.generate(True, RunContext(streaming=True, deadline=Deadline(.05)))
+        assert [r.mbid for r in result] == ["0", "1"]
+
+    @requests_mock.Mocker()
+    def test_http_fetch(self, mock_requests):
+        url = "https://api.listenbrainz.org/1/test"
+        mock_requests.get(url, json=[])
+
+        with scope(Deadline(5)):
+            troi.http_request.http_get(url, timeout=10)
+        assert 0 < mock_requests.last_request.timeout <= 5
+
+        # Don't wait for a rate limit that outlasts the deadline
+        troi.ratelimit.get_bucket("https", "api.listenbrainz.org").update(10, 0, 60)
+        with scope(Deadline(5)), self.assertRaises(DeadlineExceeded):
+            troi.http_request.http_get(url)
+        assert mock_requests.call_count == 1
+        troi.ratelimit.reset()
+
+        mock_requests.get(url, exc=requests.exceptions.ConnectTimeout)
+        with scope(Deadline(5)), self.assertRaises(requests.exceptions.ConnectTimeout):
+            troi.http_request.http_get(url)
+
+        deadline = Deadline(.01)
+        time.sleep(.02)
+        with scope(deadline), self.assertRaises(DeadlineExceeded):
+            troi.http_request.http_get(url)
+        assert mock_requests.call_count == 2
+
+    def test_paging_stops(self):
+        # Every page has a listen, so only the deadline stops the paging
+        page = mock.Mock()
+        page.json.side_effect = lambda: {"payload": {"listens": [{"listened_at": int(time.time()), "track_metadata": {
+            "additional_info": {}}}]}}
+
+        def get(*args, **kwargs):
+            time.sleep(.02)
+            return page
+
+        lookup = RecentListensTimestampLookup("rob", days=2)
+        with mock.patch("troi.listenbrainz.listens.http_get", side_effect=get) as http_get:
+            with scope(Deadline(.1)), self.assertRaises(DeadlineExceeded):
+                lookup._fetch_recent_listens_index()
+        assert 1 < http_get.call_count <= 6
@@ -0,0 +1,175 @@
+import unittest
+
+import troi
+import troi.filters
+from troi import Recording, RunContext
+from troi.operations import UnionElement, DifferenceElement
+from troi.executor import ThreadedExecutor
+
+
+class CountingSourceElement(troi.Element):
+
+    def __init__(self, mbids):
+        super().__init__()
+        self.mbids = mbids
+        self.reads = 0
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        self.reads += 1
+        return [Recording(mbid=mbid) for mbid in self.mbids]
+
+
+class RenameElement(troi.Element):
+
+    COPY_ON_WRITE = True
+
+    @staticmethod
+    def inputs():
+        return [Recording]
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        for r in inputs[0]:
+            r.name = "renamed"
+        return inputs[0]
+
+
+class TestElementMemo(unittest.TestCase):
+
+    def _shared_pipeline(self):
+        shared = CountingSourceElement(["a", "b"])
+        other = CountingSourceElement(["b"])
+
+        diff = DifferenceElement()
+        diff.set_sources([shared, other])
+
+        union = UnionElement()
+        union.set_sources([shared, diff])
+
+        return shared, union
+
+    def test_shared_source_evaluated_once(self):
+        shared, union = self._shared_pipeline()
+        result = union.generate(True)
+        assert shared.reads == 1
+        assert [r.mbid for r in result] == ["a", "b", "a"]
+
+        # Each run gets a fresh memo
+        union.generate(True)
+        assert shared.reads == 2
+
+    def test_shared_source_concurrent(self):
+        shared, union = self._shared_pipeline()
+        union.generate(True, RunContext(executor=ThreadedExecutor(4)))
+        assert shared.reads == 1
+
+    def test_memoize_off(self):
+        shared, union = self._shared_pipeline()
+        union.generate(True, RunContext(memoize=False))
+        assert shared.reads == 2
+
+    def test_copy_on_write(self):
+        shared = CountingSourceElement(["a"])
+        rename = RenameElement()
+        rename.set_sources(shared)
+
+        union = UnionElement()
+        union.set_sources([shared, rename])
+
+        result = union.generate(True)
+        assert shared.reads == 1
+        assert result[0].name is None
+        assert result[1].name == "renamed"
+        assert result[0] is not result[1]
+
+        # Without a shared source, no copy is made
+        source = CountingSourceElement(["a"])
+        rename = RenameElement()
+        rename.set_sources(source)
+        context = RunContext()
+        result = rename.generate(True, context)
+        assert not context.is_shared(source)
+        assert result[0] is context.get_result(source)[1][0]
+
+
+class PullCountingSourceElement(troi.Element):
+
+    def __init__(self, count):
+        super().__init__()
+        self.count = count
+        self.pulled = 0
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        return list(self.stream([]))
+
+    def stream(self, source_iterators):
+        for i in range(self.count):
+            self.pulled += 1
+            yield Recording(mbid=str(i))
+
+
+class FirstThreeElement(troi.Element):
+
+    @staticmethod
+    def inputs():
+        return [Recording]
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        return inputs[0][:3]
+
+    def stream(self, source_iterators):
+        for i, r in enumerate(source_iterators[0]):
+            yield r
+            if i == 2:
+                break
+
+
+class TestElementStreaming(unittest.TestCase):
+
+    def test_early_termination(self):
+        source = PullCountingSourceElement(100)
+        hate_filter = troi.filters.HatedRecordingsFilterElement()
+        hate_filter.set_sources(source)
+        first = FirstThreeElement()
+        first.set_sources(hate_filter)
+
+        result = first.generate(True, RunContext(streaming=True))
+        assert [r.mbid for r in result] == ["0", "1", "2"]
+        assert source.pulled == 3
+
+        result = first.generate(True)
+        assert [r.mbid for r in result] == ["0", "1", "2"]
+        assert source.pulled == 103
+
+    def test_read_adapter(self):
+        source = PullCountingSourceElement(10)
+        dedup = troi.filters.DuplicateRecordingMBIDFilterElement()
+        dedup.set_sources(source)
+        first = FirstThreeElement()
+        first.set_sources(dedup)
+
+        result = first.generate(True, RunContext(streaming=True))
+        assert [r.mbid for r in result] == ["0", "1", "2"]
+        # DuplicateRecordingMBIDFilterElement only implements read(), so its source is read completely
+        assert source.pulled == 10
+
+    def test_shared_source_streaming(self):
+        shared, union = TestElementMemo()._shared_pipeline()
+        result = union.generate(True, RunContext(streaming=True))
+        assert shared.reads == 1
+        assert [r.mbid for r in result] == ["a", "b", "a"]
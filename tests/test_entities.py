@@ -1,3 +1,6 @@
+import copy
+import pickle
+import tracemalloc
 import unittest
 
 from troi import Artist, ArtistCredit, Release, Recording, Playlist
@@ -109,3 +112,44 @@ class TestEntities(unittest.TestCase):
         assert p.mbid == "8fe3f1d4-b6d5-4726-89ad-926e3420b9e3"
         assert p.filename == "omnomnom.jspf"
         assert p.recordings == [r]
+
+    def test_compact_entities(self):
+
+        r = Recording(mbid="8fe3f1d4-b6d5-4726-89ad-926e3420b9e3")
+        assert not hasattr(r, "__dict__")
+        with self.assertRaises(AttributeError):
+            r.not_an_attribute = 1
+
+        # metadata dicts and notes are created on first use
+        assert r._listenbrainz is None and r._notes is None
+        r.lb["score"] = 1
+        r.add_note("note")
+        assert r.listenbrainz == {"score": 1}
+        assert r.notes == ["note"]
+        r.listenbrainz = {"score": 2}
+        assert r.lb["score"] == 2
+
+        for clone in (copy.deepcopy(r), pickle.loads(pickle.dumps(r))):
+            assert clone.mbid == r.mbid
+            assert clone.lb == {"score": 2}
+            assert clone.notes == ["note"]
+
+    def test_entity_memory(self):
+
+        def make(count):
+            return [Recording(mbid=str(i),
+                              name="name",
+                              artist_credit=ArtistCredit(name="artist", artists=[Artist(name="artist")]),
+                              release=Release(name="release")) for i in range(count)]
+
+        make(10)
+        tracemalloc.start()
+        try:
+            recordings = make(1000)
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # A recording with its artist credit, artist and release took ~1800 bytes before entities used
+        # __slots__ and created their metadata dicts lazily, and ~600 bytes after.
+        assert size / len(recordings) < 900
@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+
+import troi
+from troi import Recording, PipelineError, RunContext
+from troi.executor import SerialExecutor, ThreadedExecutor, get_executor
+from troi.operations import UnionElement
+
+
+class SleepySourceElement(troi.Element):
+
+    def __init__(self, mbid, delay=0.0, fail=False):
+        super().__init__()
+        self.mbid = mbid
+        self.delay = delay
+        self.fail = fail
+        self.thread = None
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        time.sleep(self.delay)
+        self.thread = threading.current_thread()
+        if self.fail:
+            raise PipelineError("source %s failed" % self.mbid)
+        return [Recording(mbid=self.mbid)]
+
+
+class TestExecutor(unittest.TestCase):
+
+    def test_get_executor(self):
+        assert isinstance(get_executor(None), SerialExecutor)
+        assert isinstance(get_executor(1), SerialExecutor)
+        executor = get_executor(3)
+        assert isinstance(executor, ThreadedExecutor)
+        assert executor.max_workers == 3
+
+        with self.assertRaises(ValueError):
+            ThreadedExecutor(0)
+
+    def test_threaded_map_keeps_order(self):
+        executor = ThreadedExecutor(4)
+        results = executor.map(lambda i: time.sleep((5 - i) * .01) or i, range(5))
+        assert results == [0, 1, 2, 3, 4]
+
+    def test_generate_concurrently(self):
+        slow = SleepySourceElement("a", delay=.2)
+        fast = SleepySourceElement("b")
+        union = UnionElement()
+        union.set_sources([slow, fast])
+
+        start = time.monotonic()
+        result = union.generate(True, RunContext(executor=ThreadedExecutor(2)))
+        assert time.monotonic() - start < .4
+        assert [r.mbid for r in result] == ["a", "b"]
+        assert slow.thread is not threading.current_thread()
+
+        result = union.generate(True)
+        assert [r.mbid for r in result] == ["a", "b"]
+        assert slow.thread is threading.current_thread()
+
+    def test_generate_error_propagation(self):
+        union = UnionElement()
+        union.set_sources([SleepySourceElement("a", delay=.05), SleepySourceElement("b", fail=True)])
+
+        with self.assertRaises(PipelineError):
+            union.generate(True, RunContext(executor=ThreadedExecutor(2)))
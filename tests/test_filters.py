@@ -1,4 +1,6 @@
+import random
 import unittest
+from collections import Counter
 
 import requests_mock
 
@@ -113,6 +115,50 @@ class TestArtistCreditLimiterElement(unittest.TestCase):
         assert plist[1].recordings[1].mbid == "73a9d0db-0ec7-490e-9a85-0525a5ccef8e"
 
 
+    def test_artist_credit_limiter_matches_sort(self):
+        rng = random.Random(1)
+        recordings = [Recording(mbid="%032x" % rng.getrandbits(128),
+                                artist_credit=ArtistCredit(artist_credit_id=rng.randint(0, 100)),
+                                ranking=rng.choice([.1, .2, .3, .4, .5])) for _ in range(2000)]
+
+        for exclude_lower_ranked in (True, False):
+            by_artist = {}
+            for r in sorted(recordings, key=lambda r: r.ranking, reverse=exclude_lower_ranked):
+                by_artist.setdefault(r.artist_credit.artist_credit_id, []).append(r)
+            keep = {r.mbid for recs in by_artist.values() for r in recs[:3]}
+
+            e = troi.filters.ArtistCreditLimiterElement(3, exclude_lower_ranked=exclude_lower_ranked)
+            assert e.read([recordings]) == [r for r in recordings if r.mbid in keep]
+
+        # Without rankings, a random selection of each artist's recordings is kept
+        for r in recordings[:10]:
+            r.ranking = None
+        flist = troi.filters.ArtistCreditLimiterElement(3).read([recordings])
+        counts = Counter(r.artist_credit.artist_credit_id for r in flist)
+        assert counts == Counter({ac: min(3, count) for ac, count in
+                                  Counter(r.artist_credit.artist_credit_id for r in recordings).items()})
+
+    def test_artist_credit_limiter_inputs(self):
+        rlist = [
+            Recording(mbid='8756f690-18ca-488d-a456-680fdaf234bd', artist_credit=ArtistCredit(artist_credit_id=65), ranking=1.0),
+            Recording(mbid='139654ae-2c02-4e0f-aee0-c47da6e59ff1', artist_credit=ArtistCredit(artist_credit_id=65), ranking=.5),
+        ]
+        e = troi.filters.ArtistCreditLimiterElement(1)
+        assert e.read([[]]) == []
+        assert [r.mbid for r in e.read([rlist, [], rlist[1:]])] == [rlist[0].mbid, rlist[1].mbid]
+
+        p = Playlist("test playlist", recordings=list(rlist))
+        p2 = Playlist("test playlist 2", recordings=list(rlist))
+        plist = e.read([[p], [p2]])
+        assert [pl.name for pl in plist] == [p.name, p2.name]
+        assert plist[0].recordings == rlist[:1] and plist[1].recordings == rlist[:1]
+        # The input playlists are not changed
+        assert p.recordings == rlist and p2.recordings == rlist
+
+        with self.assertRaises(troi.PipelineError):
+            e.read([[Recording(mbid='73a9d0db-0ec7-490e-9a85-0525a5ccef8e')]])
+
+
 class TestDuplicateRecordingMBIDFilterElement(unittest.TestCase):
 
     def test_duplicate_recording_filter_element(self):
@@ -262,3 +308,60 @@ class TestNeverListenedFilterElement(unittest.TestCase):
 
         assert flist[0].mbid == '73a9d0db-0ec7-490e-9a85-0525a5ccef8e'
         assert flist[1].mbid == 'c88b3490-35a0-460d-b3bc-bc50c8855d00'
+
+
+class TestFilterChainElement(unittest.TestCase):
+
+    def test_filter_chain(self):
+        from tests.test_batch import make_recordings
+
+        def chains():
+            return [
+                [troi.filters.NeverListenedFilterElement(keep_unlistened_if_empty=True),
+                 troi.filters.LatestListenedAtFilterElement(7, keep_unlistened_if_empty=True)],
+                [troi.filters.NeverListenedFilterElement(remove_unlistened=False),
+                 troi.filters.LatestListenedAtFilterElement(7)],
+                [troi.filters.HatedRecordingsFilterElement(),
+                 troi.filters.LatestListenedAtFilterElement(20, keep_unlistened_if_empty=True),
+                 troi.filters.YearRangeFilterElement(1980, 2000, inverse=True),
+                 troi.filters.NeverListenedFilterElement(keep_unlistened_if_empty=True),
+                 troi.filters.ArtistCreditFilterElement([2])],
+            ]
+
+        for count in (0, 6, 10, 20, 300):
+            for seed in range(5):
+                recordings = make_recordings(count, seed)
+                for filters, chained_filters in zip(chains(), chains()):
+                    expected_storage = DummyPatch()
+                    expected = recordings
+                    for f in filters:
+                        f.set_patch_object(expected_storage)
+                        expected = f.read([expected])
+
+                    chain = troi.filters.FilterChainElement(chained_filters)
+                    chain.set_patch_object(DummyPatch())
+                    assert chain.read([recordings]) == expected
+                    assert chain.local_storage == expected_storage.local_storage
+
+                    chain.set_patch_object(DummyPatch())
+                    assert list(chain.stream([iter(recordings)])) == expected
+                    assert chain.local_storage == expected_storage.local_storage
+
+    def test_filter_chain_stream(self):
+        from tests.test_batch import make_recordings
+
+        # Once the filters that can fall back have seen enough recordings, the rest are pulled one at a time
+        recordings = make_recordings(300, 1)
+        chain = troi.filters.FilterChainElement([troi.filters.HatedRecordingsFilterElement(),
+                                                 troi.filters.NeverListenedFilterElement(keep_unlistened_if_empty=True)])
+        chain.set_patch_object(DummyPatch())
+        source = iter(recordings)
+        stream = chain.stream([source])
+        first = next(stream)
+        assert first in chain.read([recordings])
+        assert len(list(source)) > 250
+        assert chain.local_storage["never_listened_was_empty"] is False
+
+    def test_unsupported_filter(self):
+        with self.assertRaises(troi.PipelineError):
+            troi.filters.FilterChainElement([troi.filters.DuplicateRecordingMBIDFilterElement()])
@@ -0,0 +1,138 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import requests_mock
+
+import troi.http_cache
+import troi.http_request
+from troi.http_cache import HTTPCache, configure_cache
+
+LOOKUP_URL = "https://api.listenbrainz.org/1/metadata/recording"
+
+
+class TestHTTPCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "http_cache.db")
+
+    def tearDown(self):
+        configure_cache(None)
+        self.dir.cleanup()
+
+    def test_key(self):
+        key = HTTPCache.key("POST", LOOKUP_URL, body=b'{"a": 1, "b": [1, 2]}')
+        assert key == HTTPCache.key("POST", LOOKUP_URL, body='{"b":[1,2],"a":1}')
+        assert key != HTTPCache.key("GET", LOOKUP_URL, body=b'{"a": 1, "b": [1, 2]}')
+        assert key != HTTPCache.key("POST", LOOKUP_URL, body=b'{"a": 2, "b": [1, 2]}')
+        assert key != HTTPCache.key("POST", LOOKUP_URL, body=b'{"a": 1, "b": [1, 2]}',
+                                    headers={"Authorization": "Token abc"})
+
+        assert HTTPCache.key("POST", LOOKUP_URL, body=[{"b": 1, "a": 2}]) == HTTPCache.key("POST", LOOKUP_URL, body='[{"a":2,"b":1}]')
+
+        url = "https://musicbrainz.org/ws/2/artist"
+        assert HTTPCache.key("GET", url + "?query=x&fmt=json") == HTTPCache.key("GET", url, {"fmt": "json", "query": "x"})
+
+    def test_ttl(self):
+        cache = HTTPCache(self.path)
+        assert cache.ttl("POST", LOOKUP_URL) == 7 * troi.http_cache.DAY
+        assert cache.ttl("GET", "https://musicbrainz.org/ws/2/area?query=x&fmt=json") is not None
+        assert cache.ttl("POST", "https://api.listenbrainz.org/1/playlist/create") is None
+        assert cache.ttl("GET", "https://musicbrainz.org/ws/2/recording?query=x") is None
+
+    @requests_mock.Mocker()
+    def test_http_fetch(self, mock_requests):
+        cache = configure_cache(self.path)
+        mock_requests.post(LOOKUP_URL, json={"a": 1})
+
+        for _ in range(3):
+            r = troi.http_request.http_post(LOOKUP_URL, json={"recording_mbids": ["x"], "inc": "artist"})
+            assert r.json() == {"a": 1}
+            assert r.status_code == 200
+        assert mock_requests.call_count == 1
+        assert (cache.hits, cache.misses) == (2, 1)
+
+        # A different body is a different request, uncached endpoints are never cached
+        troi.http_request.http_post(LOOKUP_URL, json={"recording_mbids": ["y"], "inc": "artist"})
+        mock_requests.post("https://api.listenbrainz.org/1/playlist/create", json={})
+        troi.http_request.http_post("https://api.listenbrainz.org/1/playlist/create", json={})
+        troi.http_request.http_post("https://api.listenbrainz.org/1/playlist/create", json={})
+        assert mock_requests.call_count == 4
+        assert (cache.hits, cache.misses) == (2, 2)
+
+        # The cache is kept on disk for the next run
+        cache = configure_cache(self.path)
+        troi.http_request.http_post(LOOKUP_URL, json={"inc": "artist", "recording_mbids": ["x"]})
+        assert mock_requests.call_count == 4
+        assert cache.hits == 1
+
+    @requests_mock.Mocker()
+    def test_revalidation(self, mock_requests):
+        cache = configure_cache(self.path, rules=[("GET", "/ws/2/artist", 60)])
+        url = "https://example.org/ws/2/artist/x"
+        headers = {"Accept": "application/json"}
+        mock_requests.get(url, json={"name": "Portishead"}, headers={"ETag": '"v1"'})
+        troi.http_request.http_get(url, headers=headers)
+
+        # Once stale, the server is asked whether the response changed
+        mock_requests.get(url, status_code=304)
+        with patch("troi.http_cache.time", return_value=troi.http_cache.time() + 120):
+            r = troi.http_request.http_get(url, headers=headers)
+        assert r.status_code == 200
+        assert r.json() == {"name": "Portishead"}
+        assert mock_requests.last_request.headers["If-None-Match"] == '"v1"'
+        # The validators are not added to the caller's headers, which may be reused for other requests
+        assert headers == {"Accept": "application/json"}
+        assert (cache.hits, cache.revalidations, cache.misses) == (0, 1, 1)
+
+        # And it is fresh again
+        troi.http_request.http_get(url)
+        assert mock_requests.call_count == 2
+        assert cache.hits == 1
+
+        # Error responses are not saved
+        mock_requests.get(url, status_code=404)
+        with patch("troi.http_cache.time", return_value=troi.http_cache.time() + 300):
+            assert troi.http_request.http_get(url).status_code == 404
+            assert troi.http_request.http_get(url).status_code == 404
+        assert mock_requests.call_count == 4
+
+    @requests_mock.Mocker()
+    def test_eviction(self, mock_requests):
+        cache = configure_cache(self.path, max_size=250, rules=[("GET", "example.com", 60)])
+        for i in range(4):
+            mock_requests.get("https://example.com/%d" % i, content=b"x" * 100)
+
+        troi.http_request.http_get("https://example.com/0")
+        troi.http_request.http_get("https://example.com/1")
+        troi.http_request.http_get("https://example.com/0")
+        troi.http_request.http_get("https://example.com/2")
+        assert cache.evictions == 1
+        assert cache.size == 200
+
+        # /1 was the least recently used
+        troi.http_request.http_get("https://example.com/0")
+        troi.http_request.http_get("https://example.com/2")
+        assert mock_requests.call_count == 3
+        troi.http_request.http_get("https://example.com/1")
+        assert mock_requests.call_count == 4
+        assert cache.stats() == {"hits": 3, "revalidations": 0, "misses": 4, "evictions": 2, "size": 200}
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+    def test_fork(self):
+        cache = configure_cache(self.path)
+        key = HTTPCache.key("POST", LOOKUP_URL, body={"a": 1})
+        parent_conn = cache.conn
+
+        pid = os.fork()
+        if pid == 0:
+            # The child has its own connection to the same database
+            ok = cache.conn is not parent_conn and cache.lookup(key) is None
+            os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+        assert cache.conn is parent_conn
+        assert cache.lookup(key) is None
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+import signal
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import troi.http_request
+import requests
+
+from troi import Deadline
+from troi.deadline import scope
+from troi.http_request import http_get, ahttp_get, get_session, close_sessions, configure_sessions, coalescing_stats, \
+    close_async_sessions
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # called once per connection
+        with self.server.lock:
+            self.server.connections += 1
+        super().handle()
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.delay)
+        body = json.dumps({"path": self.path}).encode("utf-8")
+        self.send_response(503 if self.path.startswith("/unavailable") else 200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+        self.server.connections = 0
+        self.server.requests = 0
+        self.server.delay = 0.0
+        self.server.lock = threading.Lock()
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        close_sessions()
+
+    def tearDown(self):
+        close_sessions()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        for i in range(20):
+            assert http_get(self.url + "/%d" % i).json()["path"] == "/%d" % i
+        assert self.server.connections == 1
+
+        assert get_session(self.url + "/a") is get_session(self.url + "/b")
+        assert get_session(self.url) is not get_session(self.url, retries=0)
+        assert get_session(self.url) is not get_session("http://localhost:%d" % self.server.server_port)
+
+    def test_threads_share_pool(self):
+        pool_maxsize = troi.http_request.POOL_MAXSIZE
+        configure_sessions(pool_maxsize=4)
+        try:
+            with ThreadPoolExecutor(4) as pool:
+                results = list(pool.map(lambda i: http_get(self.url + "/%d" % i).status_code, range(100)))
+            assert results == [200] * 100
+            assert self.server.connections <= 4
+        finally:
+            configure_sessions(pool_maxsize=pool_maxsize)
+
+    def test_coalescing(self):
+        self.server.delay = .2
+        before = coalescing_stats()
+        with ThreadPoolExecutor(8) as pool:
+            responses = list(pool.map(lambda _: http_get(self.url + "/slow"), range(8)))
+        after = coalescing_stats()
+
+        # One request is made, the other 7 calls share its response
+        assert self.server.requests == 1
+        assert all(r is responses[0] for r in responses)
+        assert after["requests"] - before["requests"] == 1
+        assert after["coalesced"] - before["coalesced"] == 7
+
+        # Once the request has landed, the next call makes a new one
+        http_get(self.url + "/slow")
+        assert self.server.requests == 2
+
+        # Different requests are not coalesced
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(lambda i: http_get(self.url + "/slow", params={"i": i}), range(4)))
+        assert self.server.requests == 6
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+    def test_coalescing_after_fork(self):
+        self.server.delay = .5
+        with ThreadPoolExecutor(1) as pool:
+            parent = pool.submit(http_get, self.url + "/slow")
+            while not troi.http_request._in_flight:
+                time.sleep(.01)
+
+            pid = os.fork()
+            if pid == 0:
+                # The child makes its own request rather than waiting for the one in flight in the parent
+                signal.alarm(5)
+                os._exit(0 if http_get(self.url + "/slow").status_code == 200 else 1)
+
+            _, status = os.waitpid(pid, 0)
+            assert os.waitstatus_to_exitcode(status) == 0
+            assert parent.result().status_code == 200
+
+    def test_coalescing_async(self):
+        self.server.delay = .2
+
+        async def fetch_all():
+            try:
+                return await asyncio.gather(*[ahttp_get(self.url + "/slow") for _ in range(4)])
+            finally:
+                await close_async_sessions()
+
+        responses = asyncio.run(fetch_all())
+        assert self.server.requests == 1
+        assert [r.json()["path"] for r in responses] == ["/slow"] * 4
+
+    def test_coalesce_key(self):
+        coalesce_key = troi.http_request._coalesce_key
+        assert coalesce_key("GET", self.url, None, None, None) is not None
+        assert coalesce_key("POST", "https://labs.api.listenbrainz.org/similar-artists/json", None, None, [{}]) is not None
+        assert coalesce_key("POST", "https://api.listenbrainz.org/1/playlist/create", None, None, {}) is None
+
+    @unittest.skipUnless(troi.http_request.have_aiohttp, "aiohttp is not installed")
+    def test_async_connections_are_reused(self):
+
+        async def fetch_all():
+            try:
+                return [(await ahttp_get(self.url + "/%d" % i)).json()["path"] for i in range(10)]
+            finally:
+                await close_async_sessions()
+
+        assert asyncio.run(fetch_all()) == ["/%d" % i for i in range(10)]
+        assert self.server.connections == 1
+
+    def test_no_retries_with_deadline(self):
+
+        async def fetch():
+            try:
+                with scope(Deadline(5)):
+                    return await ahttp_get(self.url + "/unavailable")
+            finally:
+                await close_async_sessions()
+
+        with scope(Deadline(5)), self.assertRaises(requests.exceptions.RetryError):
+            http_get(self.url + "/unavailable")
+        assert self.server.requests == 1
+
+        with self.assertRaises(requests.exceptions.RetryError):
+            asyncio.run(fetch())
+        assert self.server.requests == 2
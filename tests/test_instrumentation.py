@@ -0,0 +1,103 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+import requests_mock
+
+import troi
+from troi import Recording
+from troi.http_request import http_get
+from troi.instrumentation import Instrumentation, record_http_request
+from troi.patch import Patch
+from troi.playlist import PlaylistMakerElement
+
+
+class FetchRecordingsElement(troi.Element):
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        r = http_get("https://api.listenbrainz.org/1/test")
+        return [Recording(mbid=mbid) for mbid in r.json()]
+
+
+class DummyInstrumentedPatch(Patch):
+
+    @staticmethod
+    def slug():
+        return None
+
+    def create(self, inputs):
+        source = FetchRecordingsElement()
+        pl_maker = PlaylistMakerElement(name="test", desc="test", max_num_recordings=1)
+        pl_maker.set_sources(source)
+        return pl_maker
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    @requests_mock.Mocker()
+    def test_patch_stats(self, mock_requests):
+        mock_requests.get("https://api.listenbrainz.org/1/test", json=["a", "b"])
+
+        patch = DummyInstrumentedPatch({"quiet": True, "min_recordings": None})
+        assert patch.stats is None
+        patch.generate_playlist()
+
+        stats = patch.stats
+        assert stats["total_wall_time"] > 0
+        elements = stats["elements"]
+        assert list(elements) == [
+            "PlaylistElement",
+            "PlaylistElement/PlaylistMakerElement",
+            "PlaylistElement/PlaylistMakerElement/FetchRecordingsElement",
+        ]
+
+        fetch = elements["PlaylistElement/PlaylistMakerElement/FetchRecordingsElement"]
+        assert fetch["element"] == "PlaylistElement/PlaylistMakerElement/FetchRecordingsElement"
+        assert fetch["items_in"] == 0
+        assert fetch["items_out"] == 2
+        assert fetch["http_requests"] == 1
+        assert fetch["http_bytes_received"] == len(b'["a", "b"]')
+        assert fetch["wall_time"] > 0
+
+        maker = elements["PlaylistElement/PlaylistMakerElement"]
+        assert maker["items_in"] == 2
+        assert maker["items_out"] == 1
+        assert maker["http_requests"] == 0
+
+    @requests_mock.Mocker()
+    def test_patch_stats_streaming(self, mock_requests):
+        mock_requests.get("https://api.listenbrainz.org/1/test", json=["a", "b"])
+
+        patch = DummyInstrumentedPatch({"quiet": True, "min_recordings": None, "stream": True})
+        patch.generate_playlist()
+
+        elements = patch.stats["elements"]
+        fetch = elements["PlaylistElement/PlaylistMakerElement/FetchRecordingsElement"]
+        assert fetch["http_requests"] == 1
+        assert fetch["items_out"] == 1
+
+        maker = elements["PlaylistElement/PlaylistMakerElement"]
+        assert maker["items_in"] == 1
+        assert maker["items_out"] == 1
+        assert maker["http_requests"] == 0
+
+    def test_threaded_requests(self):
+        # Requests made from several threads on behalf of one element are all counted
+        element = FetchRecordingsElement()
+        instrumentation = Instrumentation()
+        instrumentation.add_element(element, "FetchRecordingsElement")
+
+        def requests():
+            for _ in range(10000):
+                record_http_request(1, 2, 0.0)
+
+        with instrumentation.measure(element) as stats:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                for future in [executor.submit(copy_context().run, requests) for _ in range(4)]:
+                    future.result()
+
+        assert (stats.http_requests, stats.http_bytes_sent, stats.http_bytes_received) == (40000, 40000, 80000)
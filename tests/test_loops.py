@@ -0,0 +1,107 @@
+import unittest
+from unittest import mock
+
+import requests_mock
+
+import troi
+from troi import Recording, User, PipelineError
+from troi.loops import ForLoopElement
+from troi.patch import Patch
+from troi.playlist import PlaylistMakerElement, LISTENBRAINZ_PLAYLIST_CREATE_URL
+
+
+class UserRecordingsElement(troi.Element):
+
+    def __init__(self, user_name):
+        super().__init__()
+        self.user_name = user_name
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        if self.user_name == "bad":
+            raise PipelineError("user %s does not exist" % self.user_name)
+        count = 1 if self.user_name == "few" else 3
+        return [Recording(mbid="%s-%d" % (self.user_name, i)) for i in range(count)]
+
+
+class DummyUserPatch(Patch):
+
+    @staticmethod
+    def slug():
+        return "dummy-user"
+
+    def create(self, inputs):
+        source = UserRecordingsElement(inputs["user_name"])
+        pl_maker = PlaylistMakerElement(name="test", desc="test")
+        pl_maker.set_sources(source)
+        return pl_maker
+
+
+class TestForLoop(unittest.TestCase):
+
+    USERS = [User(user_name=name) for name in ("rob", "bad", "few", "mayhem")]
+
+    def _run(self, **kwargs):
+        with mock.patch("troi.loops.discover_patches", return_value={"dummy-user": DummyUserPatch}):
+            loop = ForLoopElement(["dummy-user"], {"quiet": True, "min_recordings": 2}, **kwargs)
+            playlists = loop.read([self.USERS])
+
+        return loop, playlists
+
+    def test_serial(self):
+        loop, playlists = self._run()
+        assert [p.recordings[0].mbid for p in playlists] == ["rob-0", "mayhem-0"]
+        assert playlists[0].additional_metadata["algorithm_metadata"]["source_patch"] == "dummy-user"
+        assert [r["user_name"] for r in loop.report] == ["rob", "bad", "few", "mayhem"]
+        assert [r["status"] for r in loop.report] == ["generated", "failed", "skipped", "generated"]
+        assert "does not exist" in loop.report[1]["error"]
+        assert loop.report[0]["recordings"] == 3
+
+    def test_threads(self):
+        loop, playlists = self._run(concurrency=3)
+        assert [p.recordings[0].mbid for p in playlists] == ["rob-0", "mayhem-0"]
+        assert [r["status"] for r in loop.report] == ["generated", "failed", "skipped", "generated"]
+
+    def test_processes(self):
+        loop, playlists = self._run(concurrency=2, use_processes=True)
+        assert [p.recordings[0].mbid for p in playlists] == ["rob-0", "mayhem-0"]
+        assert [r["status"] for r in loop.report] == ["generated", "failed", "skipped", "generated"]
+
+    def test_patch_args(self):
+        # The patches are discovered once, and the patches run by the loop do not save their playlists
+        with mock.patch("troi.loops.discover_patches", return_value={"dummy-user": DummyUserPatch}) as discover:
+            loop = ForLoopElement(["dummy-user"], {"quiet": True, "save": True})
+            with mock.patch("troi.playlist.PlaylistElement.save") as save:
+                loop.read([self.USERS])
+                loop.read([self.USERS])
+
+        assert discover.call_count == 1
+        assert save.call_count == 0
+        assert [r["status"] for r in loop.report] == ["generated", "failed", "generated", "generated"]
+
+    def test_unknown_patch(self):
+        with mock.patch("troi.loops.discover_patches", return_value={}), self.assertRaises(PipelineError):
+            ForLoopElement(["nope"], {})
+
+    @requests_mock.Mocker()
+    def test_upload(self, mock_requests):
+        mock_requests.post(LISTENBRAINZ_PLAYLIST_CREATE_URL, [
+            {"json": {"playlist_mbid": "a"}},
+            {"status_code": 500, "json": {"error": "oops"}},
+        ])
+
+        with mock.patch("troi.loops.discover_patches", return_value={"dummy-user": DummyUserPatch}):
+            with self.assertRaisesRegex(PipelineError, "auth token"):
+                ForLoopElement(["dummy-user"], {"upload": True}).read([self.USERS])
+
+            loop = ForLoopElement(["dummy-user"], {"quiet": True, "min_recordings": 2, "upload": True, "token": "x"})
+            loop.read([self.USERS])
+
+        assert [r["status"] for r in loop.report] == ["submitted", "failed", "skipped", "failed"]
+        assert loop.report[0]["url"].endswith("/playlist/a")
+        assert "Failed to submit" in loop.report[3]["error"]
+        assert mock_requests.call_count == 2
+        assert mock_requests.request_history[0].json()["playlist"]["extension"]["https://musicbrainz.org/doc/jspf#playlist"]["created_for"] == "rob"
@@ -0,0 +1,49 @@
+import unittest
+
+import troi.filters
+import troi.operations
+from troi import Artist, Playlist, Recording, Release
+from troi.mbid import intern_mbid
+
+MBID = "8756f690-18ca-488d-a456-680fdaf234bd"
+
+
+class TestMBID(unittest.TestCase):
+
+    def test_intern_mbid(self):
+        a = intern_mbid(MBID)
+        assert a == MBID
+        assert intern_mbid(MBID.replace("-", "").upper()) is a
+        assert intern_mbid(MBID.upper()) is a
+        for value in (None, "", "a", "mbid-1", MBID[:-1], MBID[:-1] + "g", "0x" + MBID.replace("-", "")[2:], 5):
+            assert intern_mbid(value) == value
+
+    def test_entities_normalise_mbids(self):
+        a = intern_mbid(MBID)
+        for entity in (Recording(mbid=MBID.upper()), Artist(mbid=MBID.replace("-", "")), Release(mbid=MBID.upper()),
+                       Playlist(mbid=MBID.upper())):
+            assert entity.mbid is a
+        assert Recording(msid=MBID.upper()).msid is a
+        assert Recording(mbid="mbid-1").mbid == "mbid-1"
+        assert Recording().mbid is None
+
+        # MBIDs set after the entity is created are normalised too
+        r = Recording()
+        r.mbid = MBID.upper()
+        r.msid = MBID.replace("-", "")
+        assert r.mbid is a and r.msid is a
+
+    def test_elements_normalise_mbids(self):
+        recordings = [Recording(mbid=MBID), Recording(mbid=MBID.upper()), Recording(mbid="a"), Recording(mbid=MBID)]
+
+        e = troi.filters.DuplicateRecordingMBIDFilterElement()
+        assert e.read([recordings]) == recordings[:3:2]
+
+        e = troi.filters.ConsecutiveRecordingFilterElement()
+        assert e.read([recordings]) == recordings[:1] + recordings[2:]
+
+        e = troi.operations.UniqueElement()
+        assert len(e.read([recordings])) == 2
+
+        e = troi.operations.DifferenceElement()
+        assert e.read([recordings, [Recording(mbid=MBID.replace("-", ""))]]) == recordings[2:3]
@@ -2,6 +2,8 @@ import unittest
 
 from troi import Artist, ArtistCredit, Release, Recording
 import troi.operations 
+from troi import RunContext
+from tests.test_element import CountingSourceElement, FirstThreeElement, PullCountingSourceElement
 
 
 class TestOperations(unittest.TestCase):
@@ -177,3 +179,66 @@ class TestOperations(unittest.TestCase):
         assert len(dlist) == 2
         assert dlist[0].mbid == '8756f690-18ca-488d-a456-680fdaf234bd'
         assert dlist[1].mbid == '73a9d0db-0ec7-490e-9a85-0525a5ccef8e'
+
+    def test_unique_keeps_first(self):
+        rlist = [ Recording(mbid='8756f690-18ca-488d-a456-680fdaf234bd', name="a"),
+                  Recording(mbid='a1c35a51-d102-4ce7-aefb-79a361e843b6'),
+                  Recording(mbid='8756F690-18CA-488D-A456-680FDAF234BD', name="b") ]
+        e = troi.operations.UniqueElement()
+        assert e.read([rlist, rlist[1:]]) == rlist[:2]
+
+    def test_n_ary(self):
+        lists = [[Recording(mbid="%d" % i) for i in ids] for ids in ([1, 2, 3, 4, 2], [4, 2, 9], [2, 8, 4, 7, 6, 5])]
+
+        e = troi.operations.UnionElement()
+        assert [r.mbid for r in e.read(lists)] == ["1", "2", "3", "4", "2", "4", "2", "9", "2", "8", "4", "7", "6", "5"]
+        e = troi.operations.UnionElement("mbid")
+        assert [r.mbid for r in e.read(lists)] == ["1", "2", "3", "4", "9", "8", "7", "6", "5"]
+
+        e = troi.operations.IntersectionElement()
+        for inputs in (lists, [lists[0], lists[2], lists[1]], [lists[1], lists[0], lists[2]]):
+            assert sorted(set(r.mbid for r in e.read(inputs))) == ["2", "4"]
+        assert [r.mbid for r in e.read(lists)] == ["2", "4", "2"]
+        assert e.read(lists + [[]]) == []
+
+        e = troi.operations.DifferenceElement()
+        assert [r.mbid for r in e.read(lists)] == ["1", "3"]
+        assert [r.mbid for r in e.read([lists[1], lists[0][:1], lists[0][1:2]])] == ["4", "9"]
+        assert [r.mbid for r in e.read([lists[2], [], lists[1]])] == ["8", "7", "6", "5"]
+
+    def test_key_function(self):
+        a = ArtistCredit(artist_credit_id=1)
+        b = ArtistCredit(artist_credit_id=2)
+        alist = [ Recording(name="Yesterday", artist_credit=a, mbid="1"),
+                  Recording(name="yesterday ", artist_credit=b, mbid="2"),
+                  Recording(name="Let  It Be", artist_credit=a, mbid="3") ]
+        blist = [ Recording(name="YESTERDAY", artist_credit=a, mbid="4"),
+                  Recording(name="let it be", artist_credit=a, mbid="5") ]
+
+        e = troi.operations.UniqueElement(troi.operations.artist_credit_name_key)
+        assert [r.mbid for r in e.read([alist + blist])] == ["1", "2", "3"]
+        e = troi.operations.DifferenceElement(troi.operations.artist_credit_name_key)
+        assert [r.mbid for r in e.read([alist, blist])] == ["2"]
+        e = troi.operations.IntersectionElement(lambda r: r.artist_credit.artist_credit_id)
+        assert [r.mbid for r in e.read([alist, blist])] == ["1", "3"]
+
+    def test_streaming(self):
+        source = PullCountingSourceElement(100)
+        other = CountingSourceElement(["1", "3"])
+        diff = troi.operations.DifferenceElement()
+        diff.set_sources([source, other])
+        first = FirstThreeElement()
+        first.set_sources(diff)
+
+        result = first.generate(True, RunContext(streaming=True))
+        assert [r.mbid for r in result] == ["0", "2", "4"]
+        assert source.pulled == 5
+
+        for element, expected in ((troi.operations.IntersectionElement(), ["1", "3"]),
+                                  (troi.operations.UnionElement("mbid"), ["0", "1", "2"]),
+                                  (troi.operations.UniqueElement(), ["0", "1", "2"])):
+            element.set_sources([PullCountingSourceElement(100), other])
+            first.set_sources(element)
+            result = first.generate(True, RunContext(streaming=True))
+            assert [r.mbid for r in result] == expected
+            assert [r.mbid for r in result] == [r.mbid for r in first.generate(True)]
@@ -0,0 +1,241 @@
+import asyncio
+import unittest
+import unittest.mock
+
+import requests_mock
+
+import troi
+from troi import Recording, RunContext
+from troi.executor import ThreadedExecutor
+from troi.operations import UnionElement, DifferenceElement
+from troi.patch import Patch
+from troi.pipeline import Pipeline
+from troi.playlist import PlaylistMakerElement
+from tests.test_element import CountingSourceElement, RenameElement
+from tests.test_instrumentation import DummyInstrumentedPatch
+
+
+class UserSourceElement(CountingSourceElement):
+
+    RUNTIME_ARGUMENTS = ("user_name",)
+
+    def __init__(self, user_name):
+        super().__init__([])
+        self.user_name = user_name
+
+    def read(self, inputs):
+        self.reads += 1
+        return [Recording(mbid=self.user_name)]
+
+
+class FeedbackElement(troi.Element):
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        self.local_storage["user_feedback"].append("read")
+        return [Recording(mbid="a")]
+
+
+class FeedbackPatch(Patch):
+
+    @staticmethod
+    def slug():
+        return None
+
+    def create(self, inputs):
+        self.local_storage["user_feedback"] = []
+        pl_maker = PlaylistMakerElement(name="test", desc="test")
+        pl_maker.set_sources(FeedbackElement())
+        return pl_maker
+
+
+class OnceSourceElement(troi.Element):
+    """ Returns a recording on the first read and None after that. """
+
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        self.reads += 1
+        return [Recording(mbid="a")] if self.reads == 1 else None
+
+
+class OncePatch(Patch):
+
+    @staticmethod
+    def slug():
+        return None
+
+    def create(self, inputs):
+        pl_maker = PlaylistMakerElement(name="test", desc="test")
+        pl_maker.set_sources(OnceSourceElement())
+        return pl_maker
+
+
+class EmptySourceElement(troi.Element):
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        return None
+
+
+class TestPipeline(unittest.TestCase):
+
+    def _shared_pipeline(self):
+        shared = CountingSourceElement(["a", "b"])
+        other = CountingSourceElement(["b"])
+
+        diff = DifferenceElement()
+        diff.set_sources([shared, other])
+
+        union = UnionElement()
+        union.set_sources([shared, diff])
+
+        return shared, other, diff, union
+
+    def test_compile(self):
+        shared, other, diff, union = self._shared_pipeline()
+        pipeline = Pipeline(union).compile()
+
+        assert pipeline.elements == [shared, other, diff, union]
+        assert pipeline.levels == [[0, 1], [2], [3]]
+        assert pipeline.steps[2].sources == [0, 1]
+        assert pipeline.steps[3].sources == [0, 2]
+        assert pipeline.steps[0].path == "UnionElement/CountingSourceElement[0]"
+        assert pipeline.steps[0].shared
+        assert not pipeline.steps[1].shared
+
+    def test_cycle(self):
+        first = RenameElement()
+        second = RenameElement()
+        first.set_sources(second)
+        second.set_sources(first)
+
+        with self.assertRaisesRegex(RuntimeError, "RenameElement -> RenameElement -> RenameElement"):
+            Pipeline(first).compile()
+
+    def test_type_mismatch(self):
+        source = CountingSourceElement(["a"])
+        maker = PlaylistMakerElement()
+        rename = RenameElement()
+        maker.set_sources(source)
+        # bypass the check in set_sources()
+        rename.sources = [maker]
+
+        with self.assertRaises(RuntimeError):
+            Pipeline(rename).compile()
+
+    def test_run(self):
+        shared, other, diff, union = self._shared_pipeline()
+        pipeline = Pipeline(union).compile()
+
+        for context in (None, RunContext(executor=ThreadedExecutor(2)), RunContext(streaming=True)):
+            result = pipeline.run(True, context)
+            assert [r.mbid for r in result] == ["a", "b", "a"]
+        assert shared.reads == 3
+        assert other.reads == 3
+
+    def test_run_copy_on_write(self):
+        shared = CountingSourceElement(["a"])
+        rename = RenameElement()
+        rename.set_sources(shared)
+        union = UnionElement()
+        union.set_sources([shared, rename])
+
+        result = Pipeline(union).run()
+        assert result[0].name is None
+        assert result[1].name == "renamed"
+
+    def test_run_none(self):
+        union = UnionElement()
+        union.set_sources([CountingSourceElement(["a"]), EmptySourceElement()])
+        assert Pipeline(union).run() is None
+
+        # A source that returns None stops its siblings from being read, as in Element.generate()
+        first = CountingSourceElement(["a"])
+        rename = RenameElement()
+        rename.set_sources(EmptySourceElement())
+        last = CountingSourceElement(["b"])
+        union = UnionElement()
+        union.set_sources([first, rename, last])
+        assert Pipeline(union).run() is None
+        assert (first.reads, last.reads) == (1, 0)
+
+    def test_arguments(self):
+        source = UserSourceElement("rob")
+        rename = RenameElement()
+        rename.set_sources(source)
+        pipeline = Pipeline(rename).compile()
+
+        assert pipeline.run()[0].mbid == "rob"
+        assert pipeline.run(arguments={"user_name": "mayhem", "ignored": True})[0].mbid == "mayhem"
+        assert pipeline.run()[0].mbid == "mayhem"
+        assert not hasattr(source, "ignored")
+
+    @requests_mock.Mocker()
+    def test_patch_reuse(self, mock_requests):
+        mock_requests.get("https://api.listenbrainz.org/1/test", [{"json": ["a"]}, {"json": ["b"]}])
+
+        patch = DummyInstrumentedPatch({"quiet": True, "min_recordings": None})
+        first = patch.generate_playlist()
+        second = patch.generate_playlist(arguments={"name": "second"})
+
+        assert [r.mbid for r in first.playlists[0].recordings] == ["a"]
+        assert [r.mbid for r in second.playlists[0].recordings] == ["b"]
+        assert first.playlists[0].name == "test"
+        assert second.playlists[0].name == "second"
+
+    def test_patch_local_storage_reset(self):
+        patch = FeedbackPatch({"quiet": True, "min_recordings": None})
+        patch.generate_playlist()
+        patch.generate_playlist()
+        assert patch.user_feedback() == ["read"]
+
+        asyncio.run(patch.agenerate_playlist())
+        assert patch.user_feedback() == ["read"]
+
+    @requests_mock.Mocker()
+    def test_patch_async_reuse(self, mock_requests):
+        mock_requests.get("https://api.listenbrainz.org/1/test", [{"json": ["a"]}, {"json": ["b"]}])
+
+        with unittest.mock.patch("troi.http_request.have_aiohttp", False):
+            patch = DummyInstrumentedPatch({"quiet": True, "min_recordings": None})
+            first = asyncio.run(patch.agenerate_playlist())
+            second = asyncio.run(patch.agenerate_playlist(arguments={"name": "second"}))
+
+        assert [r.mbid for r in first.playlists[0].recordings] == ["a"]
+        assert [r.mbid for r in second.playlists[0].recordings] == ["b"]
+        assert first is not patch.plan.root and second is not patch.plan.root
+        assert second.playlists[0].name == "second"
+
+    def test_patch_no_stale_playlists(self):
+        patch = OncePatch({"quiet": True, "min_recordings": None})
+        assert len(patch.generate_playlist().playlists) == 1
+        assert patch.generate_playlist().playlists == []
+
+        patch = OncePatch({"quiet": True, "min_recordings": 1})
+        patch.generate_playlist()
+        with self.assertRaises(RuntimeError):
+            patch.generate_playlist()
+
+    def test_patch_concurrent_runs(self):
+        patch = FeedbackPatch({"quiet": True, "min_recordings": None})
+
+        async def run_both():
+            return await asyncio.gather(patch.agenerate_playlist(), patch.agenerate_playlist(), return_exceptions=True)
+
+        results = asyncio.run(run_both())
+        assert sum([isinstance(result, RuntimeError) for result in results]) == 1
+        # The patch can be used again once the run is over
+        asyncio.run(patch.agenerate_playlist())
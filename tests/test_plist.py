@@ -1,3 +1,4 @@
+import random
 import unittest
 
 from troi.plist import plist
@@ -23,3 +24,57 @@ class TestSplitter(unittest.TestCase):
         pl = plist([0,1,2,3,4,5,6,7,8,9])
         rlist = pl.random_item(count=9)
         assert len(rlist) == len(set(rlist))
+
+    def test_plist_random_item(self):
+        pl = plist(range(1000))
+        items = pl.random_item(50, 60, count=200, rng=random.Random(1))
+        assert sorted(items) == list(range(500, 600))
+
+        assert pl.random_item(10, 20, count=5, rng=random.Random(2)) == pl.random_item(10, 20, count=5, rng=random.Random(2))
+        assert 0 <= pl.random_item(rng=random.Random(3)) < 990
+        assert plist().random_item(count=3) == []
+        assert pl.random_item(50, 50, count=3) == []
+
+    def test_plist_weighted_random_items(self):
+        pl = plist(range(1000))
+        rng = random.Random(4)
+        items = pl.weighted_random_items([(0, 30, 3), (30, 100, 1), (50, 60, 0)], count=200, rng=rng)
+        assert len(items) == len(set(items)) == 200
+        top = len([i for i in items if i < 300])
+        assert 120 < top < 180
+
+        # The top slice runs out after 100 items
+        items = pl.weighted_random_items([(0, 10, 1)], count=150, rng=rng)
+        assert sorted(items) == list(range(100))
+
+        with self.assertRaises(ValueError):
+            pl.weighted_random_items([(0, 10, 0)])
+
+    def test_plist_view(self):
+        pl = plist([0,1,2,3,4,5,6,7,8,9])
+
+        view = pl.view(50, 100)
+        assert len(view) == 5
+        assert view == [5,6,7,8,9] == pl[50:100]
+        assert list(view) == [5,6,7,8,9]
+        assert view[0] == 5 and view[-1] == 9
+        assert 7 in view and 2 not in view
+        assert view[1:3] == [6,7]
+        assert view[::-1].tolist() == [9,8,7,6,5]
+        assert view.tolist() == [5,6,7,8,9] and isinstance(view.tolist(), list)
+        assert view + [10] == [5,6,7,8,9,10]
+        assert [4] + view == [4,5,6,7,8,9]
+        assert view.index(6) == 1
+        assert pl.view(.2, .4) == pl.uslice(.2, .4)
+        assert pl.view() == pl
+        assert plist().view(0, 50) == []
+
+        with self.assertRaises(IndexError):
+            view[5]
+
+        assert view.random_item(rng=random.Random(1)) in view
+        assert sorted(view.random_item(count=10)) == [5,6,7,8,9]
+
+        # A view refers to the list, it doesn't copy it
+        pl[5] = 50
+        assert view[0] == 50
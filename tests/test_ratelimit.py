@@ -0,0 +1,131 @@
+import asyncio
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import requests_mock
+
+import troi.http_request
+import troi.ratelimit
+from troi.ratelimit import TokenBucket, get_bucket, configure_host
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_unlimited(self):
+        bucket = TokenBucket()
+        assert all(bucket.reserve() == 0.0 for _ in range(100))
+
+    def test_queued_reservations(self):
+        bucket = TokenBucket(rate=10.0, capacity=2)
+        waits = [bucket.reserve() for _ in range(5)]
+        assert waits[:2] == [0.0, 0.0]
+        # Each queued request waits one more token than the one before it, not the whole window
+        for wait, expected in zip(waits[2:], (.1, .2, .3)):
+            self.assertAlmostEqual(wait, expected, delta=.01)
+
+    def test_release(self):
+        bucket = TokenBucket(rate=10.0, capacity=1)
+        assert bucket.reserve() == 0.0
+        assert bucket.reserve() > 0
+        bucket.release()
+        self.assertAlmostEqual(bucket.reserve(), .1, delta=.01)
+
+    def test_update(self):
+        # 10 calls per 10 seconds, in a fresh window: all 10 can be made, then they refill over the window
+        bucket = TokenBucket()
+        bucket.update(10, 10, 10)
+        assert bucket.rate == 1.0
+        assert bucket.capacity == 10
+        assert all(bucket.reserve() == 0.0 for _ in range(10))
+        self.assertAlmostEqual(bucket.reserve(), 1.0, delta=.01)
+
+        # 4 calls left with 5 seconds until the reset: the 4 calls are made right away and the bucket refills
+        # at 4 calls per 5 seconds, rather than waiting for tokens the rest of the window has not used yet
+        bucket.update(10, 4, 5)
+        assert all(bucket.reserve() == 0.0 for _ in range(4))
+        self.assertAlmostEqual(bucket.reserve(), 1.25, delta=.01)
+
+        # No calls left: the next call waits for the reset
+        bucket.update(10, 0, 5)
+        self.assertAlmostEqual(bucket.reserve(), 5.0, delta=.01)
+
+    def test_update_ignored(self):
+        bucket = TokenBucket(rate=1.0, use_headers=False)
+        bucket.update(100, 0, 1)
+        assert bucket.rate == 1.0
+        assert bucket.reserve() == 0.0
+
+    def test_threads_share_budget(self):
+        bucket = TokenBucket(rate=100.0, capacity=5)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            waits = sorted(pool.map(lambda _: bucket.reserve(), range(40)))
+        elapsed = time.monotonic() - start
+
+        # Every reservation gets its own slot: 5 at once, then one every 10ms, less the tokens added while
+        # the threads were reserving.
+        assert waits[:5] == [0.0] * 5
+        assert .35 - elapsed - .001 <= waits[-1] <= .35 + .001
+
+
+class TestHostRateLimits(unittest.TestCase):
+
+    def tearDown(self):
+        troi.ratelimit.HOST_RATE_LIMITS.pop("example.com", None)
+        troi.ratelimit.reset()
+
+    def test_get_bucket(self):
+        bucket = get_bucket("https", "api.listenbrainz.org")
+        assert get_bucket("https", "api.listenbrainz.org") is bucket
+        assert get_bucket("http", "api.listenbrainz.org") is not bucket
+
+        assert get_bucket("https", "musicbrainz.org").rate == 1.0
+        assert get_bucket("https", "musicbrainz.org:443").rate == 1.0
+
+    def test_configure_host(self):
+        bucket = get_bucket("https", "example.com")
+        assert bucket.rate is None
+
+        configure_host("example.com", 5.0, capacity=2)
+        bucket = get_bucket("https", "example.com")
+        assert (bucket.rate, bucket.capacity, bucket.use_headers) == (5.0, 2, False)
+
+    @requests_mock.Mocker()
+    def test_http_fetch(self, mock_requests):
+        url = "https://example.com/1/test"
+        headers = {"X-RateLimit-Limit": "100", "X-RateLimit-Remaining": "100", "X-RateLimit-Reset-In": "1"}
+        mock_requests.get(url, json=[], headers=headers)
+
+        troi.http_request.http_get(url)
+        bucket = get_bucket("https", "example.com")
+        assert bucket.rate == 100.0
+
+        assert bucket.tokens == 100.0
+
+        # 20 concurrent calls fit in the 100 calls that remain, so none of them wait
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            list(pool.map(lambda i: troi.http_request.http_get(url, params={"page": i}), range(20)))
+        elapsed = time.monotonic() - start
+        assert elapsed < .5
+        assert mock_requests.call_count == 21
+
+    @requests_mock.Mocker()
+    def test_ahttp_fetch(self, mock_requests):
+        url = "https://example.com/1/test"
+        mock_requests.get(url, json=[])
+        configure_host("example.com", 50.0)
+
+        async def fetch_all():
+            return await asyncio.gather(*[troi.http_request.ahttp_get(url, params={"page": i}) for i in range(10)])
+
+        if troi.http_request.have_aiohttp:
+            self.skipTest("requests_mock does not intercept aiohttp")
+
+        # The first call is made right away, the other 9 one every 20ms
+        start = time.monotonic()
+        asyncio.run(fetch_all())
+        elapsed = time.monotonic() - start
+        assert .15 < elapsed < .5
+        assert mock_requests.call_count == 10
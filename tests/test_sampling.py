@@ -0,0 +1,35 @@
+import random
+import unittest
+from collections import Counter
+
+from troi.sampling import AliasTable, sample_indexes
+
+
+class TestSampling(unittest.TestCase):
+
+    def test_sample_indexes(self):
+        rng = random.Random(1)
+        indexes = sample_indexes(10 ** 9, 5, rng)
+        assert len(set(indexes)) == 5
+        assert all(0 <= i < 10 ** 9 for i in indexes)
+
+        assert sorted(sample_indexes(20, 50, rng)) == list(range(20))
+        assert sample_indexes(0, 3, rng) == []
+
+        # Each index is as likely to be picked first
+        counts = Counter(sample_indexes(4, 2, rng)[0] for _ in range(4000))
+        assert all(900 < counts[i] < 1100 for i in range(4))
+
+    def test_alias_table(self):
+        table = AliasTable([1, 0, 2, 5], random.Random(2))
+        assert len(table) == 4
+        counts = Counter(table.pick() for _ in range(8000))
+        assert counts[1] == 0
+        for i, expected in ((0, 1000), (2, 2000), (3, 5000)):
+            assert abs(counts[i] - expected) < expected * .1
+
+        assert AliasTable([3]).pick() == 0
+
+        for weights in ([], [0, 0], [1, -1]):
+            with self.assertRaises(ValueError):
+                AliasTable(weights)
@@ -0,0 +1,86 @@
+import os
+import random
+import tempfile
+import unittest
+
+import requests_mock
+
+import troi
+from troi import Recording, RunContext
+from troi.pipeline import Pipeline
+from troi.snapshot import SnapshotStore
+from tests.test_element import CountingSourceElement
+from tests.test_instrumentation import DummyInstrumentedPatch
+
+
+class RandomSourceElement(troi.Element):
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def read(self, inputs):
+        return [Recording(mbid=str(random.random()))]
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, "snapshots")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            SnapshotStore(self.directory, "rewind")
+
+    def test_record_replay(self):
+        source = CountingSourceElement(["a", "b"])
+        pipeline = Pipeline(source)
+
+        store = SnapshotStore(self.directory, SnapshotStore.RECORD)
+        pipeline.run(True, RunContext(snapshots=store))
+        assert source.reads == 1
+        assert len(os.listdir(self.directory)) == 1
+
+        store = SnapshotStore(self.directory, SnapshotStore.REPLAY)
+        for result in (pipeline.run(True, RunContext(snapshots=store)), source.generate(True, RunContext(snapshots=store))):
+            assert [r.mbid for r in result] == ["a", "b"]
+        assert source.reads == 1
+        assert store.hits == 2
+
+        # a live element is read, and different arguments are a different snapshot
+        store = SnapshotStore(self.directory, SnapshotStore.REPLAY, live=["CountingSourceElement"])
+        source.generate(True, RunContext(snapshots=store))
+        assert source.reads == 2
+
+        store = SnapshotStore(self.directory, SnapshotStore.REPLAY)
+        other = CountingSourceElement(["c"])
+        other.name = "other"
+        assert [r.mbid for r in other.generate(True, RunContext(snapshots=store))] == ["c"]
+        assert store.misses == 1
+
+    def test_seed(self):
+        source = RandomSourceElement()
+        store = SnapshotStore(self.directory, SnapshotStore.RECORD, seed=42)
+        first = source.generate(True, RunContext(snapshots=store))
+        second = source.generate(True, RunContext(snapshots=store))
+        assert first[0].mbid == second[0].mbid
+
+    @requests_mock.Mocker()
+    def test_patch(self, mock_requests):
+        mock_requests.get("https://api.listenbrainz.org/1/test", json=["a", "b"])
+
+        patch = DummyInstrumentedPatch({"quiet": True, "min_recordings": None, "record": self.directory})
+        patch.generate_playlist()
+        assert mock_requests.call_count == 1
+
+        patch = DummyInstrumentedPatch({"quiet": True, "min_recordings": None, "replay": self.directory})
+        playlist = patch.generate_playlist()
+        assert mock_requests.call_count == 1
+        assert [r.mbid for r in playlist.playlists[0].recordings] == ["a"]
+
+        with self.assertRaises(RuntimeError):
+            DummyInstrumentedPatch({"record": self.directory, "replay": self.directory})
@@ -1,3 +1,4 @@
+import random
 import unittest
 
 from troi import Artist, Recording
@@ -27,3 +28,33 @@ class TestYearSortElement(unittest.TestCase):
         assert flist[1].mbid == '88b433b3-2c4f-4c8b-839b-77a203ec950f'
         assert flist[2].mbid == '8756f690-18ca-488d-a456-680fdaf234bd'
         assert flist[3].mbid == '73a9d0db-0ec7-490e-9a85-0525a5ccef8e'
+
+
+class TestRankSortElement(unittest.TestCase):
+
+    def test_rank_sort_element(self):
+        rng = random.Random(3)
+        rlist = []
+        for i in range(500):
+            r = Recording(mbid=str(i), ranking=rng.choice([None, .1, .2, .3, .4]))
+            if rng.random() < .7:
+                r.listenbrainz["listen_count"] = rng.randint(0, 5)
+            rlist.append(r)
+
+        def reference(r):
+            count = r.listenbrainz.get("listen_count")
+            return (r.ranking is None, -(r.ranking or 0), count is None, -(count or 0))
+
+        expected = sorted(rlist, key=reference)
+        for count in (None, 0, 1, 50, 499, 500, 1000):
+            e = troi.sorts.RankSortElement(["ranking", "listenbrainz.listen_count"], count=count)
+            assert e.read([rlist]) == expected[:count]
+
+        # Ties keep the input order
+        e = troi.sorts.RankSortElement("ranking", count=50)
+        assert e.read([rlist]) == sorted(rlist, key=lambda r: (r.ranking is None, -(r.ranking or 0)))[:50]
+
+        e = troi.sorts.RankSortElement(lambda r: int(r.mbid) % 7, count=10, ascending=True)
+        assert [int(r.mbid) for r in e.read([rlist])] == [0, 7, 14, 21, 28, 35, 42, 49, 56, 63]
+
+        assert troi.sorts.RankSortElement(count=10).read([[]]) == []
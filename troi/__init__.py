@@ -1,8 +1,18 @@
+import asyncio
+import copy
 import logging
 import random
+import threading
 from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
 from typing import Dict
 
+from troi.batch import RecordingBatch
+from troi.deadline import Deadline, DeadlineExceeded, scope as deadline_scope
+from troi.executor import SerialExecutor
+from troi.instrumentation import Instrumentation, measure_await
+from troi.mbid import intern_mbid
 from troi.utils import recursively_update_dict
 
 logger = logging.getLogger(__name__)
@@ -17,15 +27,200 @@ DEVELOPMENT_SERVER_URL = "https://datasets.listenbrainz.org"
 TARGET_NUMBER_OF_RECORDINGS = 50
 
 
+class RunContext:
+    """
+        Per-run state that is shared by all the elements taking part in one call to Element.generate().
+
+        Unless memoize is False, each element is evaluated only once per run, even if it is the source for
+        more than one element, and every consumer receives the same result. Elements that modify the entities
+        they are given should set COPY_ON_WRITE = True, so that they receive a private copy of any input that
+        may be shared with another consumer.
+
+        If streaming is True, elements pull items from their sources on demand using Element.stream(), so
+        that upstream work stops as soon as the consumers have all the items they need.
+
+        Timing, item and HTTP counters for each element are collected in instrumentation; call
+        instrumentation.stats() once the run is complete to fetch them.
+
+        :param executor: The executor used to evaluate the sources of an element. Defaults to a SerialExecutor.
+        :param memoize: If True (the default), evaluate each element only once per run.
+        :param streaming: If True, run the pipeline in pull-based streaming mode. Default False.
+        :param snapshots: A troi.snapshot.SnapshotStore to record the output of each element to, or to replay it from.
+        :param deadline: A troi.deadline.Deadline by which the run must be complete. HTTP requests made by the elements
+                         are limited to the time that is left; once it has passed, optional elements output no items
+                         and other elements that make requests fail with DeadlineExceeded.
+    """
+
+    def __init__(self, executor=None, memoize=True, streaming=False, snapshots=None, deadline=None):
+        self.executor = executor or SerialExecutor()
+        self.memoize = memoize
+        self.streaming = streaming
+        self.snapshots = snapshots
+        self.deadline = deadline
+        self.consumers = None
+        self.paths = {}
+        self.instrumentation = Instrumentation()
+        self._shared = {}
+        self._results = {}
+        self._tasks = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def start(self, root, plan=None):
+        """
+            Walk the pipeline below root once, naming each element by its path from the root and counting
+            the number of consumers of each element. Called automatically by the root element when generate()
+            starts. If a compiled plan (see troi.pipeline) for root is given, its paths and consumer counts
+            are used instead of walking the pipeline again.
+        """
+
+        if plan is not None:
+            paths, consumers = plan.paths, plan.consumers
+        else:
+            paths, consumers = self.walk(root)
+
+        self.consumers = defaultdict(int, consumers)
+        for element, path in paths.items():
+            self.paths[element] = path
+            self._shared[element] = None
+            self.instrumentation.add_element(element, path)
+
+        for element in self.paths:
+            self._is_shared(element)
+
+        if self.snapshots is not None:
+            self.snapshots.start()
+
+    @staticmethod
+    def walk(root):
+        """
+            Return a tuple (paths, consumers) of dicts that map each element below root to its path from the
+            root and to the number of elements that read from it, in depth first order.
+        """
+
+        paths = {}
+        consumers = defaultdict(int)
+        stack = [(root, type(root).__name__)]
+        while stack:
+            element, path = stack.pop()
+            if element in paths:
+                continue
+            paths[element] = path
+
+            sources = []
+            for i, source in enumerate(element.sources):
+                consumers[source] += 1
+                name = type(source).__name__
+                if len(element.sources) > 1:
+                    name += "[%d]" % i
+                sources.append((source, path + "/" + name))
+            stack.extend(reversed(sources))
+
+        return paths, consumers
+
+    def _is_shared(self, element):
+        if self._shared[element] is None:
+            self._shared[element] = self.consumers[element] > 1 or \
+                any([self._is_shared(source) for source in element.sources])
+
+        return self._shared[element]
+
+    def is_shared(self, element):
+        """
+            Return True if the output of this element, or any element upstream of it, is read by more
+            than one consumer in this run.
+        """
+
+        return self.memoize and self._shared.get(element, False)
+
+    @contextmanager
+    def measure(self, element):
+        """
+            Charge the work done inside this block to the given element and make the deadline of the
+            run the current one, so that it applies to any HTTP requests made.
+        """
+
+        with deadline_scope(self.deadline), self.instrumentation.measure(element) as stats:
+            yield stats
+
+    def timed_out(self):
+        """ Return True if the run has a deadline and it has passed. """
+
+        return self.deadline is not None and self.deadline.expired()
+
+    def element_lock(self, element):
+        """ Return the lock that guards the evaluation of the given element. """
+
+        with self._lock:
+            return self._locks.setdefault(element, threading.Lock())
+
+    def get_result(self, element):
+        """ Return a tuple (found, result) for the memoized output of the given element. """
+
+        if element in self._results:
+            return True, self._results[element]
+
+        return False, None
+
+    def set_result(self, element, result):
+        """ Save the output of the given element for any other consumer in this run. """
+
+        self._results[element] = result
+
+    def get_task(self, element):
+        """ Return the asyncio task evaluating the given element in an async run, or None. """
+
+        return self._tasks.get(element)
+
+    def set_task(self, element, task):
+        """ Save the asyncio task evaluating the given element, for any other consumer in this run. """
+
+        self._tasks[element] = task
+
+
 class Element(ABC):
     """
         Base class for elements
     """
 
+    # Set to True in elements that modify the entities they are passed, so that they work on a private
+    # copy of their inputs if those inputs are shared with another consumer.
+    COPY_ON_WRITE = False
+
+    # The names of the attributes of this element that may be changed between runs of a compiled pipeline,
+    # e.g. ("user_name", "auth_token"). See set_arguments().
+    RUNTIME_ARGUMENTS = ()
+
+    # Set to False in elements whose read() has side effects that must not be skipped when a run
+    # is replayed from snapshots. See troi.snapshot.
+    SNAPSHOT = True
+
+    # Set to True (on the class or on an instance) for elements that a run can do without: if the deadline of
+    # the run passes before or while such an element executes, it outputs no items instead of failing the run.
+    optional = False
+
+    # Set to True in elements that implement read_batch(), to have inputs that are columnar RecordingBatch
+    # objects passed to them as such, rather than as lists. See troi.batch.
+    BATCH = False
+
     def __init__(self, patch=None):
         self.sources = []
         self.patch = patch
 
+    def set_arguments(self, arguments):
+        """
+            Set the runtime arguments of this element before a run, so that a compiled pipeline can be reused
+            for different users or tokens. Only the attributes named in RUNTIME_ARGUMENTS are set; other keys
+            in the arguments dict are ignored. Elements that keep state derived from these attributes should
+            override this method and reset it.
+
+            :param arguments: A dict of argument name to value.
+        """
+
+        for name in self.RUNTIME_ARGUMENTS:
+            if name in arguments:
+                setattr(self, name, arguments[name])
+
     def set_patch_object(self, patch):
         """
             Set patch object -- this is so that each element has a reference to the 
@@ -56,16 +251,23 @@ class Element(ABC):
         self.sources = sources
 
         # type check the source
+        for source in sources:
+            self.check_source(source)
+
+    def check_source(self, source):
+        """
+           Raise a RuntimeError if this element cannot accept the output of the given source element.
+        """
+
         if len(self.inputs()) > 0:
-            for source in sources:
-                matched = False if len(source.outputs()) > 0 else True
-                for output_type in source.outputs() or []:
-                    if output_type in self.inputs():
-                        matched = True
-                        break
+            matched = False if len(source.outputs()) > 0 else True
+            for output_type in source.outputs() or []:
+                if output_type in self.inputs():
+                    matched = True
+                    break
 
-                if not matched:
-                    raise RuntimeError("Element %s cannot accept any of %s as input." % (type(self).__name__, self.inputs()))
+            if not matched:
+                raise RuntimeError("Element %s cannot accept any of %s as input." % (type(self).__name__, self.inputs()))
 
     def check(self):
         """
@@ -79,41 +281,291 @@ class Element(ABC):
         for source in self.sources:
             source.check()
 
-    def generate(self, quiet):
+    def generate(self, quiet, context=None):
         """
             Generate output from the pipeline. This should be called on
             the last element in the pipeline and no where else. At the root
             node generate returns the results, but on interior nodes it
             returns data to be used as input in the next level.
+
+            :param quiet: Do not log the number of items each element produced.
+            :param context: The RunContext for this run. If not given, a new one that evaluates sources serially is used.
         """
 
+        if context is None:
+            context = RunContext()
+        if context.consumers is None:
+            context.start(self)
+
+        if not context.memoize:
+            return self._generate(quiet, context)
+
+        with context.element_lock(self):
+            found, items = context.get_result(self)
+            if not found:
+                items = self._generate(quiet, context)
+                context.set_result(self, items)
+
+        return items
+
+    def _generate(self, quiet, context):
+        """
+            Evaluate the sources of this element and then read from them.
+        """
+
+        if context.streaming:
+            try:
+                return list(self._iterate(quiet, context))
+            except _PipelineStopped:
+                return None
+
+        found, items = self._replay(quiet, context)
+        if found:
+            return items
+
         source_lists = []
         if self.sources:
-            for source in self.sources:
-                result = source.generate(quiet)
+            results = context.executor.map(lambda source: source.generate(quiet, context), self.sources)
+            for source, result in zip(self.sources, results):
                 if result is None:
                     return None
 
-                if len(self.inputs()) > 0 and \
-                    len(result) > 0 and type(result[0]) not in self.inputs() and \
-                    len(source.outputs()) > 0:
-                    raise RuntimeError("Element %s was expected to output %s, but actually output %s" %
-                                       (type(source).__name__, source.outputs()[0], type(result[0])))
+                source_lists.append(self._prepare_input(source, result, context))
 
-                source_lists.append(result)
+        return self._read_inputs(source_lists, quiet, context)
 
-        items = self.read(source_lists)
-        if items is None:
-            return None
+    def _read_inputs(self, source_lists, quiet, context):
+        """
+            Read from the prepared outputs of the sources, measuring and logging the result.
+        """
+
+        if self.optional and context.timed_out():
+            return self._skip(quiet)
+
+        try:
+            with context.measure(self) as stats:
+                stats.items_in += sum([len(source_list) for source_list in source_lists])
+                items = self._read(source_lists)
+                if items is None:
+                    return None
+                stats.items_out += len(items)
+        except DeadlineExceeded:
+            if not self.optional:
+                raise
+            return self._skip(quiet)
+
+        self._log_items(items, quiet)
+        if context.snapshots is not None and self.SNAPSHOT:
+            context.snapshots.record(self, context.paths[self], items)
+
+        return items
+
+    def _read(self, source_lists):
+        """
+            Call read_batch() if this element supports batches and all its inputs already are RecordingBatch
+            objects, or read() with the inputs as lists otherwise. Lists are never converted to batches, since
+            the conversion costs more than the batch path saves on the lists filters usually get.
+        """
+
+        if self._reads_batches(source_lists):
+            return self.read_batch(source_lists)
+
+        return self.read(self._unbatch(source_lists))
+
+    def _reads_batches(self, source_lists):
+        return self.BATCH and len(source_lists) > 0 and \
+            all([isinstance(source_list, RecordingBatch) for source_list in source_lists])
+
+    @staticmethod
+    def _unbatch(source_lists):
+        return [source_list.to_recordings() if isinstance(source_list, RecordingBatch) else source_list
+                for source_list in source_lists]
+
+    def _skip(self, quiet):
+        """
+            Return the output of an optional element that ran out of time: no items.
+        """
+
+        if not quiet:
+            logger.info("  %-50s skipped, out of time" % type(self).__name__[:49])
+
+        return []
+
+    def _replay(self, quiet, context):
+        """
+            Return a tuple (found, items) with the recorded output of this element, if the run is replaying
+            snapshots and one was recorded.
+        """
+
+        if context.snapshots is None or not self.SNAPSHOT:
+            return False, None
+
+        found, items = context.snapshots.replay(self, context.paths[self])
+        if found and items is not None:
+            self._log_items(items, quiet)
+
+        return found, items
+
+    def _prepare_input(self, source, result, context):
+        """
+            Check the type of a source's output and copy it if this element modifies its inputs and the
+            output may be shared with another consumer.
+        """
+
+        if len(self.inputs()) > 0 and \
+            len(result) > 0 and type(result[0]) not in self.inputs() and \
+            len(source.outputs()) > 0:
+            raise RuntimeError("Element %s was expected to output %s, but actually output %s" %
+                               (type(source).__name__, source.outputs()[0], type(result[0])))
+
+        if self.COPY_ON_WRITE and context.is_shared(source):
+            result = copy.deepcopy(result)
 
+        return result
+
+    def _log_items(self, items, quiet):
         if not quiet:
             if len(items) > 0 and type(items[0]) == Playlist:
                 logger.info("  %-50s %d items" % (type(self).__name__[:49], len(items[0].recordings or [])))
             else:
                 logger.info("  %-50s %d items" % (type(self).__name__[:49], len(items or [])))
 
+    async def agenerate(self, quiet, context=None):
+        """
+            The asyncio counterpart to generate(): sources are evaluated concurrently as tasks on the running
+            event loop and each element is read with aread(). Streaming mode and the context's executor
+            are not used.
+
+            :param quiet: Do not log the number of items each element produced.
+            :param context: The RunContext for this run. If not given, a new one is used.
+        """
+
+        if context is None:
+            context = RunContext()
+        if context.consumers is None:
+            context.start(self)
+
+        if not context.memoize:
+            return await self._agenerate(quiet, context)
+
+        task = context.get_task(self)
+        if task is None:
+            task = asyncio.ensure_future(self._agenerate(quiet, context))
+            context.set_task(self, task)
+
+        return await task
+
+    async def _agenerate(self, quiet, context):
+        found, items = self._replay(quiet, context)
+        if found:
+            return items
+
+        source_lists = []
+        if self.sources:
+            results = await asyncio.gather(*[source.agenerate(quiet, context) for source in self.sources])
+            for source, result in zip(self.sources, results):
+                if result is None:
+                    return None
+
+                source_lists.append(self._prepare_input(source, result, context))
+
+        if self.optional and context.timed_out():
+            return self._skip(quiet)
+
+        try:
+            with context.measure(self) as stats:
+                stats.items_in += sum([len(source_list) for source_list in source_lists])
+                if self._reads_batches(source_lists):
+                    items = self.read_batch(source_lists)
+                else:
+                    items = await measure_await(self.aread(self._unbatch(source_lists)))
+                if items is None:
+                    return None
+                stats.items_out += len(items)
+        except DeadlineExceeded:
+            if not self.optional:
+                raise
+            return self._skip(quiet)
+
+        self._log_items(items, quiet)
+        if context.snapshots is not None and self.SNAPSHOT:
+            context.snapshots.record(self, context.paths[self], items)
+
         return items
 
+    def iterate(self, quiet, context):
+        """
+            Return an iterator over the output of this element for a streaming run. Items are pulled from
+            the sources only as they are needed. Elements with more than one consumer are evaluated once
+            (see generate()) and their output is replayed to each consumer.
+
+            :param quiet: Do not log the number of items each element produced.
+            :param context: The RunContext for this run.
+        """
+
+        if context.memoize and context.consumers[self] > 1:
+            items = self.generate(quiet, context)
+            if items is None:
+                raise _PipelineStopped()
+            return iter(items)
+
+        return self._iterate(quiet, context)
+
+    def _iterate(self, quiet, context):
+        stats = context.instrumentation.get(self)
+        source_iterators = []
+        for source in self.sources:
+            iterator = source.iterate(quiet, context)
+            if self.COPY_ON_WRITE and context.is_shared(source):
+                iterator = map(copy.deepcopy, iterator)
+            source_iterators.append(self._count_stream(iterator, stats))
+
+        return self._measure_stream(self.stream(source_iterators), quiet, context)
+
+    @staticmethod
+    def _count_stream(iterator, stats):
+        for item in iterator:
+            stats.items_in += 1
+            yield item
+
+    def _measure_stream(self, iterator, quiet, context):
+        """
+            Pass through the items of a stream, charging the time spent producing them to this element and
+            logging the number of items produced once the stream is exhausted or closed by its consumer.
+        """
+
+        iterator = iter(iterator)
+        count = 0
+        first = None
+        exhausted = False
+        try:
+            while True:
+                if self.optional and context.timed_out():
+                    break
+                try:
+                    with context.measure(self) as stats:
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            break
+                        stats.items_out += 1
+                except DeadlineExceeded:
+                    # an optional element keeps the items it produced in time
+                    if not self.optional:
+                        raise
+                    break
+
+                if count == 0:
+                    first = item
+                count += 1
+                yield item
+            exhausted = True
+        finally:
+            if type(first) == Playlist:
+                count = len(first.recordings or [])
+            if not quiet:
+                logger.info("  %-50s %d items%s" % (type(self).__name__[:49], count, "" if exhausted else " (stopped early)"))
+
     def run(self):
         """
             This function should be called on the very last element of the
@@ -121,7 +573,7 @@ class Element(ABC):
             check the pipeline first, and then generate output if it can.
         """
         self.check()
-        return self.generate()
+        return self.generate(False)
 
     @staticmethod
     def inputs():
@@ -157,6 +609,51 @@ class Element(ABC):
 
         pass
 
+    def read_batch(self, batches):
+        '''
+            The columnar counterpart to read(), called instead of read() in elements that set BATCH = True
+            when all of their inputs are RecordingBatch objects. Given a RecordingBatch for each source, return a
+            RecordingBatch, usually by selecting rows from an input with RecordingBatch.take(). Elements that modify
+            the recordings must update the columns to match with RecordingBatch.replace(). The default passes the
+            recordings of the batches to read().
+
+            Note: This function should not be called directly by the user.
+        '''
+
+        return self.read([batch.to_recordings() for batch in batches])
+
+    async def aread(self, source_data_list):
+        '''
+            The asyncio counterpart to read(), used by agenerate(). Elements that do I/O should override
+            this with a native implementation, e.g. using troi.http_request.ahttp_fetch.
+
+            The default implementation runs read() in the default thread pool executor, so that elements
+            that only implement read() never block the event loop.
+
+            Note: This function should not be called directly by the user.
+        '''
+
+        return await asyncio.to_thread(self.read, source_data_list)
+
+    def stream(self, source_iterators):
+        '''
+            The streaming counterpart to read(): given a list of iterators, one for each source, return
+            an iterator over the output of this element. Elements that implement this should pull items
+            from their sources only as they need them, so that work upstream stops as soon as the downstream
+            consumer stops asking for items.
+
+            The default implementation collects all the items from the sources and passes them to read(), so
+            elements that only implement read() work unchanged in streaming pipelines.
+
+            Note: This function should not be called directly by the user.
+        '''
+
+        items = self.read([list(iterator) for iterator in source_iterators])
+        if items is None:
+            raise _PipelineStopped()
+
+        yield from items
+
 
 class Entity(ABC):
     """
@@ -165,20 +662,82 @@ class Entity(ABC):
         three dicts named musicbrainz, listenbrainz and acousticbrainz that will
         contain collected metadata respective of each project.
 
+        MBIDs are normalised to their canonical form (see troi.mbid.intern_mbid) whenever
+        they are set, so that they can be compared as plain strings.
+
         For instance, the musicbrainz dict might have keys that shows the type
         of an artist or the listenbrainz dict might contain the BPM for a track.
         How exactly these dicts will be organized is TDB.
+
+        Since pipelines can hold many thousands of entities, the entity classes use
+        __slots__ and only attributes they declare can be set. The metadata dicts and
+        the notes list are created when they are first accessed.
     """
 
+    __slots__ = ("name", "_mbid", "ranking", "_musicbrainz", "_listenbrainz", "_acousticbrainz", "_notes")
+
     def __init__(self, mbid=None, ranking=None, musicbrainz=None, listenbrainz=None, acousticbrainz=None):
         self.name = None
         self.mbid = mbid
-        self.musicbrainz = musicbrainz or {}
-        self.listenbrainz = listenbrainz or {}
-        self.acousticbrainz = acousticbrainz or {}
-        self.notes = []
+        self._musicbrainz = musicbrainz or None
+        self._listenbrainz = listenbrainz or None
+        self._acousticbrainz = acousticbrainz or None
+        self._notes = None
         self.ranking = ranking
 
+    @property
+    def mbid(self):
+        return self._mbid
+
+    @mbid.setter
+    def mbid(self, value):
+        self._mbid = intern_mbid(value)
+
+    @property
+    def musicbrainz(self):
+        if self._musicbrainz is None:
+            self._musicbrainz = {}
+        return self._musicbrainz
+
+    @musicbrainz.setter
+    def musicbrainz(self, value):
+        self._musicbrainz = value
+
+    @property
+    def listenbrainz(self):
+        if self._listenbrainz is None:
+            self._listenbrainz = {}
+        return self._listenbrainz
+
+    @listenbrainz.setter
+    def listenbrainz(self, value):
+        self._listenbrainz = value
+
+    def has_listenbrainz(self):
+        """ Return True if the listenbrainz dict holds any data, without creating it. """
+
+        return bool(self._listenbrainz)
+
+    @property
+    def acousticbrainz(self):
+        if self._acousticbrainz is None:
+            self._acousticbrainz = {}
+        return self._acousticbrainz
+
+    @acousticbrainz.setter
+    def acousticbrainz(self, value):
+        self._acousticbrainz = value
+
+    @property
+    def notes(self):
+        if self._notes is None:
+            self._notes = []
+        return self._notes
+
+    @notes.setter
+    def notes(self, value):
+        self._notes = value
+
     @property
     def mb(self):
         return self.musicbrainz
@@ -220,6 +779,8 @@ class Artist(Entity):
         The class that represents an artist.
     """
 
+    __slots__ = ("artist_id", "join_phrase")
+
     def __init__(self,
                  name=None,
                  mbid=None,
@@ -244,6 +805,8 @@ class ArtistCredit(Entity):
         The class that represents an artist credit.
     """
 
+    __slots__ = ("artists", "artist_credit_id")
+
     def __init__(self,
                  name=None,
                  artists=None,
@@ -271,6 +834,8 @@ class Release(Entity):
         The class that represents a release.
     """
 
+    __slots__ = ("artist_credit", "caa_id", "caa_release_mbid")
+
     def __init__(self,
                  name=None,
                  mbid=None,
@@ -301,6 +866,8 @@ class Recording(Entity):
         The class that represents a recording.
     """
 
+    __slots__ = ("duration", "artist_credit", "release", "_msid", "year", "spotify_id", "apple_music_id", "soundcloud_id")
+
     def __init__(self,
                  name=None,
                  mbid=None,
@@ -328,6 +895,14 @@ class Recording(Entity):
         self.apple_music_id = apple_music_id
         self.soundcloud_id = soundcloud_id
 
+    @property
+    def msid(self):
+        return self._msid
+
+    @msid.setter
+    def msid(self, value):
+        self._msid = intern_mbid(value)
+
     def __str__(self):
         return "<Recording('%s', %s, %s)>" % (self.name, self.mbid, self.msid)
 
@@ -398,6 +973,13 @@ class User(Entity):
         return "<User('%s', %d)>" % (self.user_name, self.user_id or -1)
 
 
+class _PipelineStopped(Exception):
+    """
+        Raised inside a streaming run when an element's read() returns None, which stops the whole pipeline.
+    """
+    pass
+
+
 class PipelineError(RuntimeError):
     """
         An exception to be thrown when the pipeline encounters an erorr that is a runtime error and not a
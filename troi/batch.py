@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_NAT = np.iinfo(np.int64).min
+
+
+def datetime64_column(values):
+    """ Return a datetime64[us] array of naive datetimes or None (NaT). Much faster than np.array(values, dtype="datetime64[us]"). """
+
+    return np.array([_NAT if value is None else (value - _EPOCH) // _MICROSECOND for value in values],
+                    dtype=np.int64).view("datetime64[us]")
+
+
+class RecordingBatch:
+    """
+        A columnar representation of a list of Recordings, for elements that filter and sort large numbers
+        of recordings with NumPy rather than one Python object at a time.
+
+        The batch keeps the Recording objects themselves in the recordings array and copies the fields that
+        filters and sorts look at into one array each:
+
+        * mbid: the recording MBIDs, which entities hold as canonical strings (see troi.mbid.intern_mbid), "" if not set.
+        * artist_credit_id: the artist credit ids, 0 if the recording has no artist credit or id.
+        * year: the release years, 0 if not set.
+        * ranking: the rankings, NaN if not set.
+        * score: the feedback score of the user (listenbrainz["score"]), 0 if not set.
+        * latest_listened_at: the time the user last listened to the recording (listenbrainz["latest_listened_at"]), NaT if not set.
+
+        Batches are created with from_recordings() and turned back into a list with to_recordings(); both are
+        a single pass over the recordings. Selecting rows with take() keeps the columns in step with the recordings;
+        an element that changes a field of the recordings must also replace its column with replace(), so that
+        the columns stay in step. A batch also behaves like a read-only list of
+        Recordings: it supports len(), iteration and indexing.
+
+        Batches are made by source elements that produce many recordings, such as
+        troi.listenbrainz.recs.UserRecordingRecommendationsElement, which return a batch made with from_recordings()
+        instead of a list. Elements that set BATCH = True receive such inputs in read_batch() and return batches,
+        so that consecutive batch elements pass batches to each other without converting; other elements receive
+        the inputs as lists, which to_recordings() makes cheaply. Lists are never converted to batches by the
+        pipeline, since for the list sizes filters usually see the conversion costs more than it saves.
+    """
+
+    COLUMNS = ("mbid", "artist_credit_id", "year", "ranking", "score", "latest_listened_at")
+
+    def __init__(self, recordings, mbid, artist_credit_id, year, ranking, score, latest_listened_at):
+        self.recordings = recordings
+        self.mbid = mbid
+        self.artist_credit_id = artist_credit_id
+        self.year = year
+        self.ranking = ranking
+        self.score = score
+        self.latest_listened_at = latest_listened_at
+
+    @classmethod
+    def from_recordings(cls, recordings):
+        """ Create a batch from a list of Recordings. """
+
+        count = len(recordings)
+        mbids = [None] * count
+        artist_credit_ids = [0] * count
+        years = [0] * count
+        rankings = [np.nan] * count
+        scores = [0] * count
+        latest_listened_at = [None] * count
+        for i, r in enumerate(recordings):
+            mbids[i] = r.mbid or ""
+            if r.artist_credit is not None and r.artist_credit.artist_credit_id:
+                artist_credit_ids[i] = r.artist_credit.artist_credit_id
+            if r.year:
+                years[i] = r.year
+            if r.ranking is not None:
+                rankings[i] = r.ranking
+            if r.has_listenbrainz():
+                scores[i] = r.listenbrainz.get("score") or 0
+                latest_listened_at[i] = r.listenbrainz.get("latest_listened_at")
+
+        objects = np.empty(count, dtype=object)
+        objects[:] = recordings
+        return cls(objects,
+                   np.array(mbids, dtype=str),
+                   np.array(artist_credit_ids, dtype=np.int64),
+                   np.array(years, dtype=np.int64),
+                   np.array(rankings, dtype=np.float64),
+                   np.array(scores, dtype=np.float64),
+                   datetime64_column(latest_listened_at))
+
+    def to_recordings(self):
+        """ Return the recordings in the batch as a list. """
+
+        return self.recordings.tolist()
+
+    def replace(self, **columns):
+        """ Return a new batch with the same recordings and the given columns replaced, e.g. replace(year=years). """
+
+        return RecordingBatch(self.recordings, *[columns.get(column, getattr(self, column)) for column in self.COLUMNS])
+
+    def take(self, index):
+        """
+            Return a new batch with the rows selected by index, which is a boolean mask or an array of
+            row numbers, as for indexing a NumPy array.
+        """
+
+        return RecordingBatch(*[getattr(self, column)[index] for column in ("recordings", ) + self.COLUMNS])
+
+    def __len__(self):
+        return len(self.recordings)
+
+    def __iter__(self):
+        return iter(self.recordings)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.recordings[index]
+
+        return self.take(index)
@@ -0,0 +1,286 @@
+import base64
+import json
+import os
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, monotonic
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from troi.http_cache import HTTPCache
+
+RECORD = "record"
+REPLAY = "replay"
+PASSTHROUGH = "passthrough"
+
+# Headers that describe how a response was sent rather than what it is. They are not recorded, since the
+# content saved on a cassette is already decoded.
+_TRANSPORT_HEADERS = {"connection", "content-encoding", "content-length", "keep-alive", "transfer-encoding"}
+
+
+class CassetteMiss(requests.exceptions.RequestException):
+    """ Raised when a cassette is replayed and the request that was made is not on it. """
+
+
+class Cassette:
+    """
+        A recording of the HTTP responses received during one or more runs, saved as a JSON file, so that the
+        runs can be repeated without a network connection. Requests are matched by method, URL (with its query
+        sorted) and normalized body, as for troi.http_cache. When the same request was made several times, its
+        responses are replayed in the order they were recorded, and the last one is repeated after that.
+
+        The Authorization header is not part of the match and is not saved, so that a cassette does not contain
+        user tokens and can be replayed without them.
+
+        The counters requests and http_time (the number of calls to http_fetch and the total time spent in them)
+        are kept in every mode, for benchmarking.
+
+        :param path: The path of the JSON file, which is read if it exists.
+        :param mode: RECORD to save the responses of the requests that are made, REPLAY to return saved responses
+                     instead of making requests, or PASSTHROUGH to only count requests.
+    """
+
+    def __init__(self, path, mode=REPLAY):
+        if mode not in (RECORD, REPLAY, PASSTHROUGH):
+            raise ValueError("mode must be one of %s, %s or %s" % (RECORD, REPLAY, PASSTHROUGH))
+
+        self.path = path
+        self.mode = mode
+        self.interactions = {}
+        self.positions = {}
+        self.requests = 0
+        self.http_time = 0.0
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for interaction in json.load(f)["interactions"]:
+                    self.interactions.setdefault(interaction["key"], []).append(interaction)
+
+    def __len__(self):
+        return sum(len(interactions) for interactions in self.interactions.values())
+
+    def play(self, method, url, params=None, body=None):
+        """ Return the next recorded response to the request as a requests.Response, or raise CassetteMiss. """
+
+        key = HTTPCache.key(method, url, params, body)
+        with self.lock:
+            interactions = self.interactions.get(key)
+            if not interactions:
+                raise CassetteMiss("%s %s is not on cassette %s" % (method, url, self.path))
+
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+
+        interaction = interactions[min(position, len(interactions) - 1)]
+        r = requests.Response()
+        r.status_code = interaction["status"]
+        r.reason = interaction["reason"]
+        r.headers = CaseInsensitiveDict(interaction["headers"])
+        r.url = interaction["url"]
+        r.encoding = get_encoding_from_headers(r.headers)
+        if "text" in interaction:
+            r._content = interaction["text"].encode("utf-8")
+        else:
+            r._content = base64.b64decode(interaction["base64"])
+        return r
+
+    def record(self, method, url, params, body, response):
+        """ Save the response to a request. """
+
+        interaction = {
+            "key": HTTPCache.key(method, url, params, body),
+            "method": method,
+            "url": response.url or url,
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {k: v for k, v in response.headers.items() if k.lower() not in _TRANSPORT_HEADERS},
+        }
+        try:
+            interaction["text"] = response.content.decode("utf-8")
+        except UnicodeDecodeError:
+            interaction["base64"] = base64.b64encode(response.content).decode("ascii")
+
+        with self.lock:
+            self.interactions.setdefault(interaction["key"], []).append(interaction)
+
+    def count(self, elapsed):
+        """ Count a call to http_fetch that took elapsed seconds. """
+
+        with self.lock:
+            self.requests += 1
+            self.http_time += elapsed
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.http_time = 0.0
+            self.positions.clear()
+
+    def save(self):
+        """ Write the recorded interactions to the file of the cassette. """
+
+        with self.lock:
+            interactions = [i for interactions in self.interactions.values() for i in interactions]
+
+        with open(self.path, "w") as f:
+            json.dump({"interactions": interactions}, f, indent=2)
+
+
+# The cassette used by http_fetch, if any, and the base URL of the stand-in server that requests are sent to.
+_cassette = None
+_stand_in_url = None
+
+
+def current():
+    """ Return the cassette used by http_fetch, or None. """
+
+    return _cassette
+
+
+@contextmanager
+def use_cassette(path, mode=REPLAY):
+    """
+        Use the cassette at path for all calls to http_fetch in this block. In RECORD mode the cassette is saved
+        at the end of the block.
+    """
+
+    global _cassette
+
+    cassette = Cassette(path, mode)
+    previous, _cassette = _cassette, cassette
+    try:
+        yield cassette
+    finally:
+        _cassette = previous
+        if mode == RECORD:
+            cassette.save()
+
+
+def route(url):
+    """ Return the URL to send a request for url to: the stand-in server, if one is running, or url itself. """
+
+    if _stand_in_url is None:
+        return url
+
+    parts = urlsplit(url)
+    return "%s/%s/%s%s" % (_stand_in_url, parts.scheme, parts.netloc, url[len(parts.scheme) + 3 + len(parts.netloc):])
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._replay("GET")
+
+    def do_POST(self):
+        self._replay("POST")
+
+    def _replay(self, method):
+        server = self.server
+        _, scheme, rest = self.path.split("/", 2)
+        netloc = rest.split("/", 1)[0].split("?", 1)[0]
+        url = "%s://%s" % (scheme, rest)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else None
+
+        if server.latency > 0:
+            sleep(server.latency)
+
+        headers = {}
+        if server.rate_limit is not None:
+            limit, remaining, reset_in = server.take_token(netloc)
+            headers = {
+                "X-RateLimit-Limit": str(limit),
+                "X-RateLimit-Remaining": str(max(remaining, 0)),
+                "X-RateLimit-Reset-In": "%.3f" % reset_in,
+            }
+            if remaining < 0:
+                self._send(429, "Too Many Requests", headers, b"")
+                return
+
+        try:
+            r = server.cassette.play(method, url, body=body)
+        except CassetteMiss as err:
+            self._send(404, "Not Found", headers, str(err).encode("utf-8"))
+            return
+
+        for name, value in r.headers.items():
+            if not name.lower().startswith("x-ratelimit-"):
+                headers.setdefault(name, value)
+        self._send(r.status_code, r.reason, headers, r.content)
+
+    def _send(self, status, reason, headers, content):
+        self.send_response(status, reason)
+        for name, value in headers.items():
+            if name.lower() not in _TRANSPORT_HEADERS:
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+        A local HTTP server that stands in for the web services troi calls, replaying the responses on a cassette.
+        While the server is running (use it as a context manager), http_fetch sends all requests to it instead, so
+        that the whole HTTP stack (connection pools, rate limits, caching and coalescing) is exercised without a
+        network connection.
+
+        :param cassette: The Cassette to replay. Requests that are not on it get a 404 response.
+        :param latency: The number of seconds to wait before each response.
+        :param rate_limit: If given, the number of requests per host the server allows in each window, which it
+                           reports in X-RateLimit headers. Requests over the limit get a 429 response.
+        :param rate_window: The length of the rate limit window in seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, cassette, latency=0.0, rate_limit=None, rate_window=1.0):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.cassette = cassette
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_port
+
+    def take_token(self, host):
+        """ Count a request to host and return the limit, the requests remaining and the seconds until the reset. """
+
+        with self.lock:
+            now = monotonic()
+            start, count = self.windows.get(host, (now, 0))
+            if now - start >= self.rate_window:
+                start, count = now, 0
+            self.windows[host] = (start, count + 1)
+
+        return self.rate_limit, self.rate_limit - count - 1, start + self.rate_window - now
+
+    def __enter__(self):
+        global _stand_in_url
+
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        _stand_in_url = self.url
+        return self
+
+    def __exit__(self, *args):
+        global _stand_in_url
+
+        _stand_in_url = None
+        self.shutdown()
+        self.server_close()
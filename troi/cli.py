@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
+import json
 import logging
+import random
+import statistics
 import sys
+from contextlib import ExitStack
+from time import perf_counter
 
 import click
 
+import troi.cassette
+import troi.http_cache
+import troi.http_request
+import troi.ratelimit
 from troi.logging_utils import set_log_level
 from troi.utils import discover_patches
 from troi.core import list_patches, patch_info, convert_patch_to_command
@@ -82,10 +91,41 @@ cli.add_command(resolver_cli, name="db")
               type=str,
               required=False,
               multiple=True)
+@click.option('--concurrency',
+              help="The number of pipeline sources that may be evaluated at the same time",
+              type=click.IntRange(min=1),
+              default=1,
+              required=False)
+@click.option('--stream',
+              help="Pull recordings through the pipeline only as they are needed, stopping lookups once the playlist is full",
+              required=False,
+              is_flag=True)
+@click.option('--stats-file',
+              help="Write the timing and counters collected for each pipeline element to this file as JSON",
+              type=click.Path(dir_okay=False, writable=True),
+              required=False)
+@click.option('--record',
+              help="Save the output of each pipeline element to this directory, so that the run can be replayed",
+              type=click.Path(file_okay=False),
+              required=False)
+@click.option('--replay',
+              help="Use the output of each pipeline element saved in this directory by --record instead of reading from the element",
+              type=click.Path(file_okay=False, exists=True),
+              required=False)
+@click.option('--http-cache',
+              help="Cache the responses of slow-changing web service endpoints in this SQLite file, to reuse them in later runs",
+              type=click.Path(dir_okay=False, writable=True),
+              required=False)
+@click.option('--seed', help="Seed the random number generator with this value, to make a run repeatable", type=int, required=False)
+@click.option('--timeout',
+              help="The time budget in seconds for generating the playlist. Optional parts of the pipeline are skipped once it runs out",
+              type=click.FloatRange(min=0, min_open=True),
+              required=False)
 @click.argument('args', nargs=-1, type=click.UNPROCESSED)
 def playlist(patch, quiet, save, token, upload, args, created_for, name, desc, min_recordings,
              spotify_token, spotify_url, soundcloud_token, soundcloud_url,
-             apple_music_developer_token, apple_music_user_token, apple_music_url):
+             apple_music_developer_token, apple_music_user_token, apple_music_url, concurrency, stream, stats_file,
+             record, replay, http_cache, seed, timeout):
     """
     Generate a global MBID based playlist using a patch
     """
@@ -106,6 +146,12 @@ def playlist(patch, quiet, save, token, upload, args, created_for, name, desc, m
         "desc": desc,
         "min_recordings": min_recordings,
         "quiet": quiet,
+        "concurrency": concurrency,
+        "stream": stream,
+        "record": record,
+        "replay": replay,
+        "seed": seed,
+        "timeout": timeout,
     }
     if spotify_token:
         patch_args["spotify"] = {
@@ -144,12 +190,21 @@ def playlist(patch, quiet, save, token, upload, args, created_for, name, desc, m
             "This is a local patch and should be invoked via the specific troi function, rather than the playlist function.")
         return None
 
+    cache = troi.http_cache.configure_cache(http_cache) if http_cache else None
+
     try:
         ret = patch.generate_playlist()
     except RuntimeError as err:
         logger.error(err)
         ret = 0
 
+    if stats_file and patch.stats is not None:
+        stats = patch.stats
+        if cache is not None:
+            stats = dict(stats, http_cache=cache.stats())
+        with open(stats_file, "w") as f:
+            json.dump(stats, f, indent=4)
+
     user_feedback = patch.user_feedback()
     if len(user_feedback) > 0:
         logger.info("User feedback:")
@@ -253,6 +308,75 @@ def periodic_jams(db_file, threshold, upload_to_subsonic, subsonic_id, save_to_m
     output_playlist(db, playlist, upload_to_subsonic, save_to_m3u, save_to_jspf, dont_ask, subsonic_id)
 
 
+@cli.command(context_settings=dict(ignore_unknown_options=True, ))
+@click.option('--cassette', '-c', 'cassette_file', help="The JSON file to record the HTTP responses to, or replay them from",
+              type=click.Path(dir_okay=False), required=True)
+@click.option('--record', help="Make the HTTP requests and save their responses to the cassette, rather than replaying it", is_flag=True)
+@click.option('--stand-in', help="Replay the cassette from a local HTTP server, rather than inside the process", is_flag=True)
+@click.option('--latency', help="With --stand-in, the number of seconds the server waits before each response",
+              type=click.FloatRange(min=0), default=0.0)
+@click.option('--rate-limit', help="With --stand-in, the number of requests per second the server allows for each host",
+              type=click.IntRange(min=1), required=False)
+@click.option('--runs', '-n', help="The number of times to run the command", type=click.IntRange(min=1), default=5)
+@click.option('--seed', help="Seed the random number generator with this value before each run", type=int, default=0)
+@click.argument('command', nargs=-1, type=click.UNPROCESSED, required=True)
+def bench(cassette_file, record, stand_in, latency, rate_limit, runs, seed, command):
+    """
+    Time a troi command, with recorded HTTP responses
+
+    \b
+    First record the responses of the web services that the command calls:
+      troi bench --record -c lb-radio.json playlist -q lb-radio easy 'artist:(Portishead)'
+    Then replay them as often as needed, without a network connection:
+      troi bench -c lb-radio.json -n 10 playlist -q lb-radio easy 'artist:(Portishead)'
+      troi bench -c jams.json --stand-in --latency .05 --rate-limit 10 playlist -q periodic-jams rob
+      troi bench -c metadata.json db metadata -q -d music.db
+    """
+
+    if record and stand_in:
+        raise click.UsageError("--record makes real HTTP requests, it cannot be combined with --stand-in.")
+    if record:
+        runs = 1
+    mode = troi.cassette.RECORD if record else troi.cassette.PASSTHROUGH if stand_in else troi.cassette.REPLAY
+
+    times = []
+    with ExitStack() as stack:
+        tape = stack.enter_context(troi.cassette.use_cassette(cassette_file, mode))
+        server = None
+        if stand_in:
+            server = stack.enter_context(
+                troi.cassette.StandInServer(troi.cassette.Cassette(cassette_file), latency, rate_limit))
+
+        for run in range(runs):
+            # Every run starts from scratch, without connections or rate limits left over from the one before
+            troi.http_request.close_sessions()
+            troi.ratelimit.reset()
+            tape.reset_counters()
+            if server is not None:
+                server.cassette.reset_counters()
+            random.seed(seed)
+
+            start = perf_counter()
+            try:
+                cli.main(args=list(command), prog_name="troi", standalone_mode=False)
+            except SystemExit:
+                pass
+            except troi.cassette.CassetteMiss as err:
+                raise click.ClickException("%s. Record it again with --record." % err)
+            elapsed = perf_counter() - start
+            times.append(elapsed)
+
+            http_latency = tape.http_time / tape.requests * 1000 if tape.requests else 0.0
+            click.echo("run %d: %.3fs, %d HTTP requests, %.1fms per request" % (run + 1, elapsed, tape.requests, http_latency))
+
+    if record:
+        click.echo("recorded %d responses to %s" % (len(tape), cassette_file))
+        return
+
+    click.echo("runs: %d min: %.3fs median: %.3fs mean: %.3fs max: %.3fs runs/s: %.2f" %
+               (runs, min(times), statistics.median(times), statistics.mean(times), max(times), runs / sum(times)))
+
+
 @cli.command(context_settings=dict(ignore_unknown_options=True, ))
 @click.argument('args', nargs=-1, type=click.UNPROCESSED)
 def test(args):
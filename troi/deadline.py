@@ -0,0 +1,80 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+
+# The deadline of the pipeline run that the element executing in this thread/task belongs to, if any.
+_current = ContextVar("troi_deadline", default=None)
+
+
+class DeadlineExceeded(RuntimeError):
+    """
+        Raised when a pipeline run, or an HTTP request made by one of its elements, cannot complete
+        within the time budget of the run.
+    """
+    pass
+
+
+class Deadline:
+    """
+        The time by which a pipeline run must be complete. The deadline of a run is made current for
+        each element while it executes, so that troi.http_request can limit its timeouts, rate limit
+        waits and retries to the time that is left.
+
+        :param timeout: The time budget of the run, in seconds from now.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires_at = monotonic() + timeout
+
+    def remaining(self):
+        """ Return the number of seconds left before the deadline, or 0 if it has passed. """
+
+        return max(0.0, self.expires_at - monotonic())
+
+    def expired(self):
+        return monotonic() >= self.expires_at
+
+    def check(self):
+        """ Raise DeadlineExceeded if the deadline has passed. """
+
+        if self.expired():
+            raise DeadlineExceeded("The time budget of %.1f seconds for this run has been exceeded." % self.timeout)
+
+
+@contextmanager
+def scope(deadline):
+    """ Make the given deadline (which may be None) the current one inside this block. """
+
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def current():
+    """ Return the deadline of the run the calling element belongs to, or None. """
+
+    return _current.get()
+
+
+def remaining():
+    """ Return the number of seconds left for the current run, or None if it has no deadline. """
+
+    deadline = _current.get()
+    if deadline is None:
+        return None
+
+    return deadline.remaining()
+
+
+def check():
+    """
+        Raise DeadlineExceeded if the current run has a deadline that has passed. Elements that loop over
+        many requests, e.g. pages of listens, should call this between iterations.
+    """
+
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.check()
@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SerialExecutor:
+    """
+        Evaluate the sources of an element one after another in the calling thread. This is
+        the default executor and it matches how troi always evaluated pipelines: if a source
+        returns None, the remaining sources are never evaluated.
+    """
+
+    def map(self, fn, items):
+        """
+            Lazily apply fn to each item, yielding the results in input order.
+        """
+        for item in items:
+            yield fn(item)
+
+
+class ThreadedExecutor:
+    """
+        Evaluate the sources of an element concurrently on a pool of threads. Nearly all of the
+        time a troi pipeline spends is spent waiting on HTTP requests, so running sibling sources
+        on threads makes the latency of an element the latency of its slowest source, rather than the
+        sum of all of them.
+
+        A new pool is created for each fan out, which means that nested fan outs can never deadlock
+        waiting for a worker that is held by a parent element.
+
+        :param max_workers: The maximum number of sources that will be evaluated at the same time.
+    """
+
+    def __init__(self, max_workers=4):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1.")
+        self.max_workers = max_workers
+
+    def map(self, fn, items):
+        """
+            Apply fn to each item concurrently and return a list of results in input order. If
+            any call raises an exception, work that has not started yet is cancelled and the
+            exception of the first failing item (in input order) is raised.
+        """
+
+        items = list(items)
+        if len(items) < 2 or self.max_workers == 1:
+            return [fn(item) for item in items]
+
+        pool = ThreadPoolExecutor(max_workers=min(self.max_workers, len(items)), thread_name_prefix="troi")
+        try:
+            futures = [pool.submit(fn, item) for item in items]
+            return [future.result() for future in futures]
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def get_executor(concurrency):
+    """
+        Return the executor to use for the given concurrency: 1 (or None) returns a SerialExecutor,
+        anything larger a ThreadedExecutor with that many workers.
+    """
+
+    if concurrency is None or concurrency <= 1:
+        return SerialExecutor()
+
+    return ThreadedExecutor(max_workers=concurrency)
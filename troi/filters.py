@@ -1,7 +1,12 @@
 from collections import defaultdict
+import copy
 import datetime
+from heapq import nlargest, nsmallest
+from itertools import chain
 from operator import itemgetter
-from random import shuffle
+from random import sample
+
+import numpy as np
 
 import troi
 from troi import PipelineError, Recording, Playlist
@@ -15,6 +20,8 @@ class ArtistCreditFilterElement(troi.Element):
         :param include: If true, include all tracks with the given artist_credit_id, otherwise remove them.
     '''
 
+    BATCH = True
+
     def __init__(self, artist_credit_ids, include=False):
         '''
             Filter a list of Recordings based on their artist_credit_id.
@@ -35,29 +42,26 @@ class ArtistCreditFilterElement(troi.Element):
     def outputs():
         return [Recording, Playlist]
 
-    def read(self, inputs):
+    def predicate(self):
+        ac_index = set(self.artist_credit_ids)
+        include = self.include
 
-        recordings = inputs[0]
-        ac_index = {}
-        for ac in self.artist_credit_ids:
-            try:
-                ac_index[ac] = 1
-            except KeyError:
-                raise PipelineError(self.__name__ + " needs to have all input recordings to have artist.artist_credit_id defined!")
-
-        results = []
-        for r in recordings:
+        def keep(r):
             if not r.artist_credit or not r.artist_credit.artist_credit_id:
-                continue
+                return False
 
-            if self.include:
-                if r.artist_credit.artist_credit_id in ac_index:
-                    results.append(r)
-            else:
-                if r.artist_credit.artist_credit_id not in ac_index:
-                    results.append(r)
+            return (r.artist_credit.artist_credit_id in ac_index) == include
 
-        return results
+        return keep
+
+    def read(self, inputs):
+        keep = self.predicate()
+        return [r for r in inputs[0] if keep(r)]
+
+    def read_batch(self, batches):
+        batch = batches[0]
+        member = np.isin(batch.artist_credit_id, np.array(list(self.artist_credit_ids), dtype=np.int64))
+        return batch.take((batch.artist_credit_id != 0) & (member if self.include else ~member))
 
 
 class ArtistCreditLimiterElement(troi.Element):
@@ -81,60 +85,59 @@ class ArtistCreditLimiterElement(troi.Element):
 
     @staticmethod
     def inputs():
-        return [Recording]
+        return [Recording, Playlist]
 
     @staticmethod
     def outputs():
-        return [Recording]
+        return [Recording, Playlist]
 
     def _filter(self, recordings):
         """
-            Carry out the actual artist limiting.
+            Carry out the actual artist limiting, in linear time: the recordings to keep are picked for each
+            artist credit with a heap, rather than by sorting all of the artist credit's recordings.
         """
 
         ac_index = defaultdict(list)
         all_have_rankings = True
         for rec in recordings:
-            try:
-                ac_index[rec.artist_credit.artist_credit_id].append((rec.mbid, rec.ranking))
-                if rec.ranking is None:
-                    all_have_rankings = False
-            except KeyError:
-                raise PipelineError(self.__name__ + " needs to have all input recordings to have artist.artist_credit_id defined!")
-
-        for key in ac_index:
-            if all_have_rankings:
-                ac_index[key] = sorted(ac_index[key], key=itemgetter(1), reverse=self.exclude_lower_ranked)
+            if rec.artist_credit is None:
+                raise PipelineError(type(self).__name__ + " needs to have all input recordings to have artist.artist_credit_id defined!")
+            ac_index[rec.artist_credit.artist_credit_id].append((rec.mbid, rec.ranking))
+            if rec.ranking is None:
+                all_have_rankings = False
+
+        pass_recs = set()
+        for recs in ac_index.values():
+            if len(recs) <= self.count:
+                top = recs
+            elif not all_have_rankings:
+                top = sample(recs, self.count)
+            elif self.exclude_lower_ranked:
+                top = nlargest(self.count, recs, key=itemgetter(1))
             else:
-                shuffle(ac_index[key])
-            ac_index[key] = ac_index[key][:self.count]
-
-        pass_recs = []
-        for key in ac_index:
-            for mbid, ranking in ac_index[key]:
-                pass_recs.append(mbid)
-
-        results = []
-        for r in recordings:
-            if r.mbid in pass_recs:
-                results.append(r)
-
-        return results
+                top = nsmallest(self.count, recs, key=itemgetter(1))
+            pass_recs.update(mbid for mbid, ranking in top)
 
+        return [r for r in recordings if r.mbid in pass_recs]
 
     def read(self, inputs):
         """
             Determine if recordings or playlists are passed in and call the internal _filter
-            function accordingly.
+            function accordingly. Recordings of all inputs are returned in a single list.
         """
 
         outputs = []
         for input in inputs:
+            if not input:
+                continue
+
             if isinstance(input[0], Recording):
-                return self._filter(input)
+                outputs.extend(self._filter(input))
             elif isinstance(input[0], Playlist):
                 for playlist in input:
-                    playlist.recordings = self._filter(playlist.recordings)
+                    # The input playlists may be shared with other elements, so filter a copy
+                    playlist = copy.copy(playlist)
+                    playlist.recordings = self._filter(playlist.recordings or [])
                     outputs.append(playlist)
             else:
                 raise PipelineError("ArtistCreditLimiter passed incorrect input types.")
@@ -148,6 +151,8 @@ class DuplicateRecordingMBIDFilterElement(troi.Element):
         based on the recording's MBID, preserving the input order.
     """
 
+    BATCH = True
+
     @staticmethod
     def inputs():
         return [Recording]
@@ -161,12 +166,18 @@ class DuplicateRecordingMBIDFilterElement(troi.Element):
         output = []
         seen = set()
         for rec in recordings:
-            if rec.mbid not in seen:
-                seen.add(rec.mbid)
+            key = rec.mbid
+            if key not in seen:
+                seen.add(key)
                 output.append(rec)
 
         return output
 
+    def read_batch(self, batches):
+        batch = batches[0]
+        _, first = np.unique(batch.mbid, return_index=True)
+        return batch.take(np.sort(first))
+
 
 class DuplicateRecordingArtistCreditFilterElement(troi.Element):
     """
@@ -203,6 +214,8 @@ class ConsecutiveRecordingFilterElement(troi.Element):
     For example, a sequence A, A, A, B, B, A, C will be reduced to A, B, A, C
     """
 
+    BATCH = True
+
     @staticmethod
     def inputs():
         return [Recording]
@@ -214,14 +227,21 @@ class ConsecutiveRecordingFilterElement(troi.Element):
     def read(self, inputs):
         recordings = inputs[0]
         output = []
-        last_mbid = None
+        last_key = None
         for rec in recordings:
-            if rec.mbid != last_mbid:
+            key = rec.mbid
+            if key != last_key:
                 output.append(rec)
-            last_mbid = rec.mbid
+            last_key = key
 
         return output
 
+    def read_batch(self, batches):
+        batch = batches[0]
+        keep = np.ones(len(batch), dtype=bool)
+        keep[1:] = batch.mbid[1:] != batch.mbid[:-1]
+        return batch.take(keep)
+
 
 class EmptyRecordingFilterElement(troi.Element):
     """This Element takes a list of recordings and removes ones that have an empty name
@@ -236,14 +256,12 @@ class EmptyRecordingFilterElement(troi.Element):
     def outputs():
         return [Recording]
 
-    def read(self, input):
-        recordings = input[0]
-        output = []
-        for rec in recordings:
-            if rec.name is not None and (rec.artist and rec.artist.name is not None) and rec.mbid is not None:
-                output.append(rec)
+    def predicate(self):
+        return lambda rec: rec.name is not None and (rec.artist and rec.artist.name is not None) and rec.mbid is not None
 
-        return output
+    def read(self, input):
+        keep = self.predicate()
+        return [rec for rec in input[0] if keep(rec)]
 
 
 class YearRangeFilterElement(troi.Element):
@@ -259,6 +277,8 @@ class YearRangeFilterElement(troi.Element):
         :param inverse: If inverse is True, exclude everything in the year range.
     '''
 
+    BATCH = True
+
     def __init__(self, start_year, end_year=None, inverse=False):
         troi.Element.__init__(self)
         self.start_year = start_year
@@ -273,28 +293,37 @@ class YearRangeFilterElement(troi.Element):
     def outputs():
         return [Recording]
 
-    def read(self, inputs):
+    def predicate(self):
+        start_year = self.start_year
+        end_year = self.end_year
+        inverse = self.inverse
 
-        recordings = inputs[0]
-
-        results = []
-        for r in recordings:
+        def keep(r):
             if not r.year:
-                continue
+                return False
 
-            if self.inverse:
-                if r.year < self.start_year:
-                    results.append(r)
-                elif self.end_year and r.year > self.end_year:
-                    results.append(r)
-            else:
-                if r.year >= self.start_year:
-                    if not self.end_year:
-                        results.append(r)
-                    elif r.year <= self.end_year:
-                        results.append(r)
+            in_range = r.year >= start_year and (not end_year or r.year <= end_year)
+            return in_range != inverse
 
-        return results
+        return keep
+
+    def read(self, inputs):
+        keep = self.predicate()
+        return [r for r in inputs[0] if keep(r)]
+
+    def read_batch(self, batches):
+        batch = batches[0]
+        year = batch.year
+        if self.inverse:
+            keep = year < self.start_year
+            if self.end_year:
+                keep |= year > self.end_year
+        else:
+            keep = year >= self.start_year
+            if self.end_year:
+                keep &= year <= self.end_year
+
+        return batch.take(keep & (year != 0))
 
 
 class GenreFilterElement(troi.Element):
@@ -317,21 +346,20 @@ class GenreFilterElement(troi.Element):
     def outputs():
         return [Recording]
 
-    def read(self, inputs):
+    def predicate(self):
+        genre_list = self.genre_list
 
-        recordings = inputs[0]
-
-        results = []
-        for r in recordings:
+        def keep(r):
             if "tags" not in r.musicbrainz:
-                continue
+                return False
 
-            for genre in self.genre_list:
-                if genre in r.musicbrainz["tags"]:
-                    results.append(r)
-                    break
+            return any(genre in r.musicbrainz["tags"] for genre in genre_list)
+
+        return keep
 
-        return results
+    def read(self, inputs):
+        keep = self.predicate()
+        return [r for r in inputs[0] if keep(r)]
 
 
 class LatestListenedAtFilterElement(troi.Element):
@@ -344,6 +372,7 @@ class LatestListenedAtFilterElement(troi.Element):
     '''
 
     MIN_ITEMS_REQUIRED = 5
+    BATCH = True
 
     def __init__(self, min_number_of_days=14, keep_unlistened_if_empty=False):
         troi.Element.__init__(self)
@@ -358,27 +387,38 @@ class LatestListenedAtFilterElement(troi.Element):
     def outputs():
         return [Recording]
 
-    def read(self, inputs):
+    def predicate(self):
+        now = datetime.datetime.now()
+        min_number_of_days = self.min_number_of_days
 
-        recordings = inputs[0]
+        def keep(r):
+            latest_listened_at = r.listenbrainz.get("latest_listened_at")
+            return latest_listened_at is None or (now - latest_listened_at).days > min_number_of_days
 
-        results = []
-        now = datetime.datetime.now()
-        for r in recordings:
-            if "latest_listened_at" in r.listenbrainz and r.listenbrainz["latest_listened_at"] is not None:
-                td = now - r.listenbrainz["latest_listened_at"]
-                if td.days > self.min_number_of_days:
-                    results.append(r)
-            else:
-                results.append(r)
+        return keep
 
-        if len(results) < self.MIN_ITEMS_REQUIRED and self.keep_unlistened_if_empty:
-            self.local_storage["latest_listened_was_empty"] = True
-            return recordings
+    def fall_back(self, count):
+        """
+            Given the number of recordings that passed the filter, return True if the filter should keep all
+            of its input recordings instead, and note the outcome in local_storage.
+        """
 
-        self.local_storage["latest_listened_was_empty"] = False
+        was_empty = count < self.MIN_ITEMS_REQUIRED and self.keep_unlistened_if_empty
+        self.local_storage["latest_listened_was_empty"] = was_empty
+        return was_empty
 
-        return results
+    def read(self, inputs):
+        recordings = inputs[0]
+        keep = self.predicate()
+        results = [r for r in recordings if keep(r)]
+        return recordings if self.fall_back(len(results)) else results
+
+    def read_batch(self, batches):
+        batch = batches[0]
+        # timedelta.days > n is the same as timedelta >= n + 1 days
+        age = np.datetime64(datetime.datetime.now(), "us") - batch.latest_listened_at
+        results = batch.take(np.isnat(batch.latest_listened_at) | (age >= np.timedelta64(self.min_number_of_days + 1, "D")))
+        return batch if self.fall_back(len(results)) else results
 
 
 class NeverListenedFilterElement(troi.Element):
@@ -387,6 +427,7 @@ class NeverListenedFilterElement(troi.Element):
     '''
 
     MIN_ITEMS_REQUIRED = 5
+    BATCH = True
 
     def __init__(self, remove_unlistened=True, keep_unlistened_if_empty=False):
         '''
@@ -406,35 +447,40 @@ class NeverListenedFilterElement(troi.Element):
     def outputs():
         return [Recording]
 
-    def read(self, inputs):
+    def predicate(self):
+        remove_unlistened = self.remove_unlistened
 
-        recordings = inputs[0]
+        # has this track been listened to before?
+        return lambda r: bool(r.listenbrainz.get("latest_listened_at")) == remove_unlistened
 
-        results = []
-        for r in recordings:
-            # has this track never been listened to before?
-            if "latest_listened_at" in r.listenbrainz and r.listenbrainz["latest_listened_at"]:
-                if self.remove_unlistened:
-                    results.append(r)
-                else:
-                    continue
-            else:
-                if self.remove_unlistened:
-                    continue
-                else:
-                    results.append(r)
+    def fall_back(self, count):
+        """
+            Given the number of recordings that passed the filter, return True if the filter should keep all
+            of its input recordings instead, and note the outcome in local_storage.
+        """
 
-        if len(results) < self.MIN_ITEMS_REQUIRED and self.keep_unlistened_if_empty:
-            self.local_storage["never_listened_was_empty"] = True
-            return recordings
+        was_empty = count < self.MIN_ITEMS_REQUIRED and self.keep_unlistened_if_empty
+        self.local_storage["never_listened_was_empty"] = was_empty
+        return was_empty
+
+    def read(self, inputs):
+        recordings = inputs[0]
+        keep = self.predicate()
+        results = [r for r in recordings if keep(r)]
+        return recordings if self.fall_back(len(results)) else results
 
-        self.local_storage["never_listened_was_empty"] = False
-        return results
+    def read_batch(self, batches):
+        batch = batches[0]
+        listened = ~np.isnat(batch.latest_listened_at)
+        results = batch.take(listened if self.remove_unlistened else ~listened)
+        return batch if self.fall_back(len(results)) else results
 
 
 class HatedRecordingsFilterElement(troi.Element):
     """ Remove recordings that have been hated by the user """
 
+    BATCH = True
+
     @staticmethod
     def inputs():
         return [Recording]
@@ -444,10 +490,121 @@ class HatedRecordingsFilterElement(troi.Element):
         return [Recording]
 
     def read(self, inputs):
-        results = []
-        for r in inputs[0]:
-            score = r.listenbrainz.get("score", 0)
-            if score < 0:
-                continue
-            results.append(r)
-        return results
+        return list(self.stream([iter(inputs[0])]))
+
+    def predicate(self):
+        return lambda r: r.listenbrainz.get("score", 0) >= 0
+
+    def stream(self, source_iterators):
+        return filter(self.predicate(), source_iterators[0])
+
+    def read_batch(self, batches):
+        batch = batches[0]
+        return batch.take(batch.score >= 0)
+
+
+class FilterChainElement(troi.Element):
+    '''
+        Apply a sequence of filters to a list of recordings in a single pass over the recordings, rather than
+        have each filter build a new list. The result is the same as that of chaining the filters one after
+        another, including the fallback of filters that keep all of their input if too few recordings pass
+        them (keep_unlistened_if_empty) and the flags these filters set in local_storage.
+
+        Filters that implement predicate() can be chained: ArtistCreditFilterElement, EmptyRecordingFilterElement,
+        YearRangeFilterElement, GenreFilterElement, LatestListenedAtFilterElement, NeverListenedFilterElement
+        and HatedRecordingsFilterElement.
+
+        :param filters: The filter elements to apply, in order.
+    '''
+
+    BATCH = True
+
+    def __init__(self, filters):
+        troi.Element.__init__(self)
+        for f in filters:
+            if not hasattr(f, "predicate"):
+                raise PipelineError("%s cannot be used in a FilterChainElement" % type(f).__name__)
+        self.filters = list(filters)
+
+    @staticmethod
+    def inputs():
+        return [Recording]
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    def set_patch_object(self, patch):
+        super().set_patch_object(patch)
+        for f in self.filters:
+            f.set_patch_object(patch)
+
+    def read(self, inputs):
+        recordings = inputs[0]
+        filters = [(1 << bit, f.predicate(), hasattr(f, "fall_back")) for bit, f in enumerate(self.filters)]
+
+        # For each recording, a bit mask of the filters it passes. A recording that fails a filter that can't
+        # fall back is rejected whatever the other filters say, so the remaining filters are not evaluated.
+        masks = []
+        mask_counts = defaultdict(int)
+        for r in recordings:
+            mask = 0
+            for bit, keep, can_fall_back in filters:
+                if keep(r):
+                    mask |= bit
+                elif not can_fall_back:
+                    break
+            masks.append(mask)
+            mask_counts[mask] += 1
+
+        # The input of each filter is made up of the recordings that pass all the filters before it that
+        # did not fall back
+        required = 0
+        for (bit, _, can_fall_back), f in zip(filters, self.filters):
+            passed = sum(count for mask, count in mask_counts.items() if mask & required == required and mask & bit)
+            if not can_fall_back or not f.fall_back(passed):
+                required |= bit
+
+        return [r for r, mask in zip(recordings, masks) if mask & required == required]
+
+    def stream(self, source_iterators):
+        """
+            Pass on the recordings that pass all the filters as they are pulled downstream. A filter that may fall
+            back decides only once it has seen enough recordings, so the recordings are held back until no
+            filter can fall back any more; if the input runs out first, the held recordings are passed to read().
+        """
+
+        recordings = iter(source_iterators[0])
+        predicates = [f.predicate() for f in self.filters]
+        pending = [i for i, f in enumerate(self.filters) if hasattr(f, "fall_back")]
+
+        # The number of held recordings that pass each filter and all the filters before it
+        counts = [0] * len(self.filters)
+        held = []
+        while pending:
+            r = next(recordings, None)
+            if r is None:
+                yield from self.read([held])
+                return
+
+            held.append(r)
+            for i, keep in enumerate(predicates):
+                if not keep(r):
+                    break
+                counts[i] += 1
+            pending = [i for i in pending if self.filters[i].fall_back(counts[i])]
+
+        for r in chain(held, recordings):
+            if all(keep(r) for keep in predicates):
+                yield r
+
+    def read_batch(self, batches):
+        if not all([f.BATCH for f in self.filters]):
+            return troi.Element.read_batch(self, batches)
+
+        # Filtering the batch one filter after another gives the same result as read()
+        batch = batches[0]
+        for f in self.filters:
+            batch = f.read_batch([batch])
+
+        return batch
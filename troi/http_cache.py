@@ -0,0 +1,352 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from time import time
+from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from troi.instrumentation import record_http_cache
+
+DAY = 24 * 60 * 60
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# The endpoints whose responses may be cached, and for how long. Each rule is a tuple of the HTTP method,
+# a regular expression that is searched for in the URL and the number of seconds a response stays fresh.
+# The first matching rule applies; responses from endpoints that match no rule are never cached. Stale
+# responses are revalidated with their ETag or Last-Modified headers, if the server sent any.
+DEFAULT_TTL_RULES = [
+    ("POST", r"//api\.listenbrainz\.org/1/metadata/recording", 7 * DAY),
+    ("GET", r"//api\.listenbrainz\.org/1/metadata/recording", 7 * DAY),
+    ("POST", r"//labs\.api\.listenbrainz\.org/(tag-similarity|similar-artists)/json", DAY),
+    ("POST", r"/popular-recordings-by-country/json", DAY),
+    ("GET", r"//musicbrainz\.org/ws/2/(artist|area)\b", 7 * DAY),
+]
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS response (
+        key           TEXT PRIMARY KEY,
+        url           TEXT NOT NULL,
+        status        INTEGER NOT NULL,
+        reason        TEXT,
+        headers       TEXT NOT NULL,
+        content       BLOB NOT NULL,
+        size          INTEGER NOT NULL,
+        expires       REAL NOT NULL,
+        etag          TEXT,
+        last_modified TEXT,
+        accessed      REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS response_accessed_ndx ON response (accessed);
+"""
+
+
+def _normalize_body(body):
+    """ Return a canonical bytes representation of a request body, so that equal JSON documents
+        and form data in a different key order map to the same cache key. """
+
+    if body is None:
+        return b""
+    if isinstance(body, (bytes, bytearray, str)):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            return body.encode("utf-8") if isinstance(body, str) else bytes(body)
+
+    return json.dumps(body, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def _normalize_url(url, params):
+    """ Return the URL with the given query params merged in and the query sorted. """
+
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if params:
+        items = params.items() if isinstance(params, dict) else params
+        for name, value in items:
+            if isinstance(value, (list, tuple)):
+                query.extend((name, str(v)) for v in value)
+            elif value is not None:
+                query.append((name, str(value)))
+
+    return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path, urlencode(sorted(query)), ""))
+
+
+class CachedEntry:
+    """ A response read from the cache. """
+
+    def __init__(self, url, status, reason, headers, content, expires, etag, last_modified):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def is_fresh(self):
+        return self.expires > time()
+
+    def response(self):
+        """ Return the entry as a requests.Response, just like the one originally received. """
+
+        r = requests.Response()
+        r.status_code = self.status
+        r.reason = self.reason
+        r.headers = CaseInsensitiveDict(json.loads(self.headers))
+        r.url = self.url
+        r.encoding = get_encoding_from_headers(r.headers)
+        r._content = self.content
+        return r
+
+
+class HTTPCache:
+    """
+        A size-bounded cache of HTTP responses, stored in an SQLite database so that it is shared between runs
+        and processes. Responses are keyed by method, URL (with its query sorted) and normalized body. When the
+        total size of the cached content goes over max_size, the least recently used responses are evicted.
+
+        The cache can be used from several threads at once. The counters hits, revalidations (stale responses
+        that the server confirmed with a 304), misses and evictions are kept for the lifetime of the object.
+
+        :param path: The path of the SQLite database file, which is created if needed.
+        :param max_size: The maximum total size in bytes of the cached response bodies.
+        :param rules: The TTL rules, see DEFAULT_TTL_RULES.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, rules=None):
+        self.path = path
+        self.max_size = max_size
+        self.rules = [(method, re.compile(pattern), ttl) for method, pattern, ttl in (rules or DEFAULT_TTL_RULES)]
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._connect()
+
+    def _connect(self):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM response").fetchone()[0]
+
+    def ttl(self, method, url):
+        """ Return the number of seconds responses to this request stay fresh, or None if they should not be cached. """
+
+        for rule_method, pattern, ttl in self.rules:
+            if rule_method == method and pattern.search(url):
+                return ttl
+
+        return None
+
+    @staticmethod
+    def key(method, url, params=None, body=None, headers=None):
+        """ Return the cache key for a request. The Authorization header is part of the key, so that responses
+            for one user are never returned to another. """
+
+        digest = hashlib.sha256()
+        digest.update(method.encode("utf-8") + b"\0")
+        digest.update(_normalize_url(url, params).encode("utf-8") + b"\0")
+        digest.update(_normalize_body(body) + b"\0")
+        if headers:
+            digest.update(CaseInsensitiveDict(headers).get("Authorization", "").encode("utf-8"))
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """ Return the CachedEntry for the key, fresh or stale, or None if there is none. """
+
+        with self.lock:
+            row = self.conn.execute(
+                """SELECT url, status, reason, headers, content, expires, etag, last_modified
+                     FROM response
+                    WHERE key = ?""", (key,)).fetchone()
+            if row is None:
+                return None
+
+            self.conn.execute("UPDATE response SET accessed = ? WHERE key = ?", (time(), key))
+
+        return CachedEntry(*row)
+
+    def store(self, key, response, ttl):
+        """ Save a response under the key for ttl seconds, then evict the least recently used responses
+            if the cache is over its size bound. """
+
+        content = response.content
+        if len(content) > self.max_size:
+            return
+
+        now = time()
+        headers = json.dumps(dict(response.headers))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM response WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                """INSERT OR REPLACE INTO response (key, url, status, reason, headers, content, size, expires,
+                                                    etag, last_modified, accessed)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (key, response.url, response.status_code, response.reason, headers, content, len(content),
+                 now + ttl, response.headers.get("ETag"), response.headers.get("Last-Modified"), now))
+            self.size += len(content) - (old[0] if old else 0)
+            self._evict()
+
+    def refresh(self, key, ttl):
+        """ Mark the response saved under the key as fresh for another ttl seconds. """
+
+        now = time()
+        with self.lock:
+            self.conn.execute("UPDATE response SET expires = ?, accessed = ? WHERE key = ?", (now + ttl, now, key))
+
+    def _evict(self):
+        while self.size > self.max_size:
+            rows = self.conn.execute("SELECT key, size FROM response ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                self.size = 0
+                break
+
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.conn.execute("DELETE FROM response WHERE key = ?", (key,))
+                self.size -= size
+                self.evictions += 1
+
+    def clear(self):
+        """ Remove all responses from the cache. """
+
+        with self.lock:
+            self.conn.execute("DELETE FROM response")
+            self.size = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def stats(self):
+        """ Return the counters of the cache as a dict. """
+
+        return {
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": self.size,
+        }
+
+
+class CachedRequest:
+    """
+        The cache state of one request made by http_fetch: the cached response, if any, and the key and TTL
+        under which to save the new one.
+    """
+
+    def __init__(self, cache, key, ttl):
+        self.cache = cache
+        self.key = key
+        self.ttl = ttl
+        self.entry = cache.lookup(key)
+
+    def fresh_response(self):
+        """ Return the cached response if it is still fresh, otherwise None. """
+
+        if self.entry is not None and self.entry.is_fresh():
+            with self.cache.lock:
+                self.cache.hits += 1
+            record_http_cache(hit=True)
+            return self.entry.response()
+
+        return None
+
+    def add_validators(self, headers):
+        """ Add the headers that ask the server to only send the response if it has changed since the cached one. """
+
+        if self.entry is None:
+            return
+        if self.entry.etag:
+            headers["If-None-Match"] = self.entry.etag
+        if self.entry.last_modified:
+            headers["If-Modified-Since"] = self.entry.last_modified
+
+    def finish(self, response):
+        """ Save a new response, or return the cached response if the server says it has not changed. """
+
+        if response.status_code == 304 and self.entry is not None:
+            self.cache.refresh(self.key, self.ttl)
+            with self.cache.lock:
+                self.cache.revalidations += 1
+            record_http_cache(hit=True)
+            return self.entry.response()
+
+        with self.cache.lock:
+            self.cache.misses += 1
+        record_http_cache(hit=False)
+        if response.status_code == 200 and "no-store" not in response.headers.get("Cache-Control", ""):
+            self.cache.store(self.key, response, self.ttl)
+
+        return response
+
+
+# The cache used by http_fetch, if any. Set with configure_cache().
+_cache = None
+
+
+def configure_cache(path, max_size=DEFAULT_MAX_SIZE, rules=None):
+    """
+        Cache the responses of http_fetch in the SQLite database at path, or stop caching if path is None.
+        Returns the new HTTPCache.
+
+        :param path: The path of the SQLite database file.
+        :param max_size: The maximum total size in bytes of the cached response bodies.
+        :param rules: The TTL rules, see DEFAULT_TTL_RULES.
+    """
+
+    global _cache
+
+    old = _cache
+    _cache = HTTPCache(path, max_size, rules) if path is not None else None
+    if old is not None:
+        old.close()
+
+    return _cache
+
+
+def get_cache():
+    """ Return the HTTPCache used by http_fetch, or None if responses are not cached. """
+
+    return _cache
+
+
+def cached_request(method, url, params=None, body=None, headers=None):
+    """ Return a CachedRequest for the request, or None if the cache is off or the request should not be cached. """
+
+    cache = _cache
+    if cache is None:
+        return None
+
+    ttl = cache.ttl(method, url)
+    if ttl is None:
+        return None
+
+    return CachedRequest(cache, cache.key(method, url, params, body, headers), ttl)
+
+
+# The connections inherited from the parent process, which a child must neither use nor close.
+_inherited_connections = []
+
+
+def _reopen_after_fork():
+    # SQLite connections must not be used across a fork, so a child process opens its own. The connection
+    # inherited from the parent is kept referenced, so that it isn't closed when it is garbage collected.
+    if _cache is not None:
+        _inherited_connections.append(_cache.conn)
+        _cache._connect()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reopen_after_fork)
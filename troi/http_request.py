@@ -1,18 +1,65 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import weakref
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 import requests
-from time import time, sleep
+from time import time, sleep, perf_counter
 from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
 from urllib3.util.retry import Retry
 from urllib.parse import urlparse
 
-# Index keep track of rate limits of the various services 
-# we may call. key: scheme, domain value: RateLimit-Limit, Remaining, Reset
-domain_ratelimit_lookup = {}
+from troi import cassette, deadline, http_cache, ratelimit
+from troi.deadline import DeadlineExceeded
+from troi.instrumentation import record_http_request, record_http_coalesced
+
+try:
+    import aiohttp
+    have_aiohttp = True
+except ImportError:
+    have_aiohttp = False
+
+USER_AGENT = "ListenBrainz Troi (rob@meb)"
+RETRIES = 3
+BACKOFF_FACTOR = 0.3
+RETRY_STATUS_CODES = (500, 502, 504, 503, 429)
+# The number of connection pools (one per host) and connections per pool of the shared sessions
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+
+# POST requests to these URLs are lookups that can be shared by identical concurrent calls, like GET requests
+COALESCE_POST_URLS = [
+    re.compile(r"//labs\.api\.listenbrainz\.org/"),
+    re.compile(r"//datasets\.listenbrainz\.org/"),
+    re.compile(r"//api\.listenbrainz\.org/1/metadata/"),
+]
+
+# The requests that are in flight, from all threads and event loops. key: request key value: Future of the response
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+# The number of requests made for coalesced calls, and the number of calls that shared the response of another call
+_coalescing_stats = {"requests": 0, "coalesced": 0}
+
+# The sessions shared by all threads of the process, so that connections are kept alive and reused.
+# key: scheme, domain, retries value: requests.Session
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# The aiohttp sessions of each event loop, since they cannot be shared between loops.
+# key: event loop value: dict of scheme, domain -> aiohttp.ClientSession
+_async_sessions = weakref.WeakKeyDictionary()
 
 def requests_retry_session(
-    retries=3,
-    backoff_factor=0.3,
-    status_forcelist=(500, 502, 504, 503, 429),
+    retries=RETRIES,
+    backoff_factor=BACKOFF_FACTOR,
+    status_forcelist=RETRY_STATUS_CODES,
     session=None,
+    pool_connections=POOL_CONNECTIONS,
+    pool_maxsize=POOL_MAXSIZE,
 ):
     """ Create the session object for retry handling """
 
@@ -24,11 +71,94 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
+def get_session(url, retries=RETRIES):
+    """ Return the shared session for the host of the given URL, with the given number of retries. The
+        session is created on first use and reused by all threads, so that requests to the same host
+        reuse its open connections rather than each making a new connection (and TLS handshake). """
+
+    parse = urlparse(url)
+    key = (parse.scheme, parse.netloc, retries)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests_retry_session(retries=retries, pool_connections=POOL_CONNECTIONS,
+                                                 pool_maxsize=POOL_MAXSIZE)
+                _sessions[key] = session
+
+    return session
+
+def _get_async_session(url):
+    """ Return the aiohttp session for the host of the given URL on the running event loop, so that requests
+        to the same host reuse its open connections, as get_session does for the blocking functions. """
+
+    loop = asyncio.get_running_loop()
+    parse = urlparse(url)
+    key = (parse.scheme, parse.netloc)
+    with _sessions_lock:
+        sessions = _async_sessions.setdefault(loop, {})
+        session = sessions.get(key)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=POOL_MAXSIZE))
+            sessions[key] = session
+
+    return session
+
+async def close_async_sessions():
+    """ Close the aiohttp sessions of the running event loop and their connections. Call this before the
+        event loop is closed, for instance at the end of the coroutine passed to asyncio.run(). """
+
+    with _sessions_lock:
+        sessions = _async_sessions.pop(asyncio.get_running_loop(), {})
+
+    for session in sessions.values():
+        await session.close()
+
+def configure_sessions(pool_connections=None, pool_maxsize=None):
+    """ Set the pool sizes of the shared sessions. Existing sessions are closed, so that the
+        new sizes apply to all sessions from now on.
+
+        :param pool_connections: the number of hosts to keep connection pools for.
+        :param pool_maxsize: the maximum number of connections to keep open to each host, which should
+                             be at least the number of threads that make requests to the same host. """
+
+    global POOL_CONNECTIONS, POOL_MAXSIZE
+
+    if pool_connections is not None:
+        POOL_CONNECTIONS = pool_connections
+    if pool_maxsize is not None:
+        POOL_MAXSIZE = pool_maxsize
+    close_sessions()
+
+def close_sessions():
+    """ Close the shared sessions and their connections. New sessions are created as needed. """
+
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+
+    for session in sessions:
+        session.close()
+
+def _reset_sessions_after_fork():
+    # A child process must not share the connections of its parent, nor wait for the requests in flight
+    # there, whose responses it will never see. Locks held by other threads of the parent are never released.
+    global _sessions_lock, _async_sessions, _in_flight_lock
+    _sessions.clear()
+    _async_sessions = weakref.WeakKeyDictionary()
+    _sessions_lock = threading.Lock()
+    _in_flight.clear()
+    _in_flight_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_sessions_after_fork)
+
 
 def http_get(url, headers=None, params=None, **kwargs):
     """ Convenience function for http get"""
@@ -42,58 +172,318 @@ def http_put(url, headers=None, params=None, **kwargs):
     """ Convenience function for http put"""
     return http_fetch(url, "PUT", headers=headers, params=params, **kwargs)
 
+async def ahttp_get(url, headers=None, params=None, **kwargs):
+    """ Convenience function for async http get"""
+    return await ahttp_fetch(url, "GET", headers=headers, params=params, **kwargs)
+
+async def ahttp_post(url, headers=None, params=None, **kwargs):
+    """ Convenience function for async http post"""
+    return await ahttp_fetch(url, "POST", headers=headers, params=params, **kwargs)
+
+def _update_ratelimit(bucket, headers):
+    """ Seed the rate limit bucket of a domain from the RateLimit headers of one of its responses """
+
+    try:
+        limit = int(headers["X-RateLimit-Limit"])
+        remaining = int(headers["X-RateLimit-Remaining"])
+        if "X-RateLimit-Reset-In" in headers:
+            reset_in = float(headers["X-RateLimit-Reset-In"])
+        else:
+            reset_in = int(headers["X-RateLimit-Reset"]) - time()
+    except (KeyError, ValueError):
+        return
+
+    bucket.update(limit, remaining, reset_in)
+
+def _reserve(url, bucket, timeout, delay=0.0):
+    """ Take a token from the rate limit bucket of a domain and return the number of seconds to wait
+        before the request and the timeout to use for it. If the deadline of the current run would pass
+        before then, the token is given back and DeadlineExceeded is raised. """
+
+    wait = bucket.reserve() + delay
+    try:
+        return wait, _deadline_timeout(url, timeout, wait)
+    except DeadlineExceeded:
+        bucket.release()
+        raise
+
+def _deadline_timeout(url, timeout, wait=0.0):
+    """ Return the timeout to use for a request that first waits for the given number of seconds, limited
+        to the time left before the deadline of the current run. Raises DeadlineExceeded if the wait alone
+        would take longer than that. """
+
+    remaining = deadline.remaining()
+    if remaining is None:
+        return timeout
+
+    remaining -= wait
+    if remaining <= 0:
+        raise DeadlineExceeded("Out of time for a request to %s" % url)
+
+    return remaining if timeout is None else min(timeout, remaining)
+
+def _coalesce_key(method, url, headers, params, body):
+    """ Return the key under which identical concurrent calls share one request, or None if this request
+        must not be shared. """
+
+    if method == "GET" or (method == "POST" and any(pattern.search(url) for pattern in COALESCE_POST_URLS)):
+        return http_cache.HTTPCache.key(method, url, params, body, headers)
+
+    return None
+
+def _join_flight(key):
+    """ Return a tuple (leader, future) for the request with the given key. The leader must make the request
+        and set the result of the future; the other calls wait for it. """
+
+    with _in_flight_lock:
+        flight = _in_flight.get(key)
+        if flight is None:
+            flight = _in_flight[key] = Future()
+            _coalescing_stats["requests"] += 1
+            return True, flight
+
+        _coalescing_stats["coalesced"] += 1
+
+    record_http_coalesced()
+    return False, flight
+
+def _land_flight(key, flight, response=None, error=None):
+    with _in_flight_lock:
+        del _in_flight[key]
+
+    if error is not None:
+        flight.set_exception(error)
+    else:
+        flight.set_result(response)
+
+def coalescing_stats():
+    """ Return a dict with the number of requests made for calls that could be coalesced ("requests") and the
+        number of calls that shared the response of an identical call already in flight ("coalesced"). """
+
+    with _in_flight_lock:
+        return dict(_coalescing_stats)
+
 def http_fetch(url, method, headers=None, params=None, **kwargs):
-    """ HTTP fetch wrapper that uses HTTPAdapter sessions with back-off retries
-        and support for delaying calls based on the RateLimit headers provided
-        by the API. Note: MusicBrainz' Rate Limit headers are busted, so we use a 1s
-        delay for that. Will need to remove after https://tickets.metabrainz.org/browse/MBH-589
-        is fixed. """
+    """ HTTP fetch wrapper that uses shared, pooled HTTPAdapter sessions (see get_session) with back-off retries
+        and support for delaying calls based on the RateLimit headers provided by the API. The calls to
+        each domain, from all threads and event loops, share one token bucket (see troi.ratelimit), so
+        concurrent calls are spread over the rate limit of the domain rather than each waiting for it.
+        Note: MusicBrainz' Rate Limit headers are busted, so we use a fixed 1 call per second for that.
+
+        If a response cache is configured (see troi.http_cache), responses from the endpoints it has TTL
+        rules for are returned from the cache while they are fresh and revalidated once they are stale.
+
+        Identical GET requests (and POST requests to the lookup endpoints in COALESCE_POST_URLS) that are
+        made while the same request is already in flight, from any thread or event loop, do not make a
+        request of their own: they wait for the one in flight and return the same response object, which
+        must therefore not be modified. See coalescing_stats().
+
+        If the calling element belongs to a run with a deadline (see troi.deadline), requests are not
+        retried, time out when the deadline passes and raise DeadlineExceeded if they would have to
+        wait for the rate limit past it.
 
-    if not headers:
-        headers = {}
-    headers["User-Agent"] = "ListenBrainz Troi (rob@meb)"
+        Inside troi.cassette.use_cassette(), responses are recorded to or replayed from a cassette. """
 
     if method not in ("GET", "POST"):
         raise ValueError("Only GET and POST are supported.")
 
-    session = requests_retry_session()
+    body = kwargs.get("json", kwargs.get("data"))
+    tape = cassette.current()
+    if tape is None:
+        return _coalesced_fetch(url, method, headers, params, **kwargs)
+
+    start = perf_counter()
+    if tape.mode == cassette.REPLAY:
+        r = tape.play(method, url, params, body)
+    else:
+        r = _coalesced_fetch(url, method, headers, params, **kwargs)
+        if tape.mode == cassette.RECORD:
+            tape.record(method, url, params, body, r)
+    tape.count(perf_counter() - start)
+
+    return r
+
+def _coalesced_fetch(url, method, headers, params, **kwargs):
+    key = _coalesce_key(method, url, headers, params, kwargs.get("json", kwargs.get("data")))
+    if key is None:
+        return _http_fetch(url, method, headers, params, **kwargs)
+
+    leader, flight = _join_flight(key)
+    if not leader:
+        try:
+            return flight.result(timeout=deadline.remaining())
+        except FutureTimeoutError as err:
+            raise DeadlineExceeded("Out of time waiting for a request to %s" % url) from err
+
+    try:
+        r = _http_fetch(url, method, headers, params, **kwargs)
+    except BaseException as err:
+        _land_flight(key, flight, error=err)
+        raise
+
+    _land_flight(key, flight, r)
+    return r
+
+def _http_fetch(url, method, headers, params, **kwargs):
+    # Copy the headers, since callers may reuse one dict for unrelated requests
+    headers = dict(headers) if headers else {}
+    headers["User-Agent"] = USER_AGENT
+
+    cached = http_cache.cached_request(method, url, params, kwargs.get("json", kwargs.get("data")), headers)
+    if cached is not None:
+        r = cached.fresh_response()
+        if r is not None:
+            return r
+        cached.add_validators(headers)
+
+    # With a deadline there is no time for back-off retries
+    request_url = cassette.route(url)
+    session = get_session(request_url, retries=0 if deadline.current() else RETRIES)
     parse = urlparse(url)
+    bucket = ratelimit.get_bucket(parse.scheme, parse.netloc)
+    timeout = kwargs.pop("timeout", None)
     while True:
-        _key = parse.scheme + parse.netloc
-        ratelimit = domain_ratelimit_lookup.get(_key, None)
-        if ratelimit is not None:
-            (limit, remaining, reset) = ratelimit
-
-            # MB's rate limit headers are borked, so for the time being, use nearly 1s
-            if parse.netloc.startswith("musicbrainz.org"):
-                time_left = .9
+        slept, request_timeout = _reserve(url, bucket, timeout)
+        if slept > 0:
+            sleep(slept)
+
+        try:
+            if method == "GET":
+                r = session.get(request_url, params=params, headers=headers, timeout=request_timeout, **kwargs)
             else:
-                time_left = reset - time()
+                r = session.post(request_url, params=params, headers=headers, timeout=request_timeout, **kwargs)
+        except requests.exceptions.Timeout as err:
+            if deadline.current() is not None and deadline.current().expired():
+                raise DeadlineExceeded("Request to %s timed out at the deadline of the run" % url) from err
+            raise
 
-            if remaining == 0:
-                remaining = 1
+        _update_ratelimit(bucket, r.headers)
 
-            if time_left > 0:
-                time_to_wait = time_left / remaining
-                sleep(time_to_wait)
+        body = r.request.body or b""
+        record_http_request(len(body), len(r.content), slept)
 
-            domain_ratelimit_lookup.pop(_key, None)
+        # This should never happen, but if it does, just retry
+        if r.status_code in (503, 429):
+            continue
 
-        if method == "GET":
-            r = session.get(url, params=params, headers=headers, **kwargs)
-        else:
-            r = session.post(url, params=params, headers=headers, **kwargs)
+        return r if cached is None else cached.finish(r)
+
+async def ahttp_fetch(url, method, headers=None, params=None, **kwargs):
+    """ asyncio version of http_fetch, with the same back-off retries and RateLimit handling. The
+        returned object is a requests.Response, so that code parsing responses can be shared between
+        the sync and async paths.
+
+        If aiohttp is installed, requests are made natively on the event loop, with one session per event loop
+        and host that keeps connections alive between requests (see close_async_sessions). Otherwise the blocking
+        http_fetch is run in the default thread pool executor, which keeps the event loop responsive,
+        but uses a worker thread for the duration of the request. """
 
+    if not have_aiohttp:
+        return await asyncio.to_thread(http_fetch, url, method, headers=headers, params=params, **kwargs)
+
+    if method not in ("GET", "POST"):
+        raise ValueError("Only GET and POST are supported.")
+
+    body = kwargs.get("json", kwargs.get("data"))
+    tape = cassette.current()
+    if tape is None:
+        return await _acoalesced_fetch(url, method, headers, params, **kwargs)
+
+    start = perf_counter()
+    if tape.mode == cassette.REPLAY:
+        r = tape.play(method, url, params, body)
+    else:
+        r = await _acoalesced_fetch(url, method, headers, params, **kwargs)
+        if tape.mode == cassette.RECORD:
+            tape.record(method, url, params, body, r)
+    tape.count(perf_counter() - start)
+
+    return r
+
+async def _acoalesced_fetch(url, method, headers, params, **kwargs):
+    key = _coalesce_key(method, url, headers, params, kwargs.get("json", kwargs.get("data")))
+    if key is None:
+        return await _ahttp_fetch(url, method, headers, params, **kwargs)
+
+    leader, flight = _join_flight(key)
+    if not leader:
+        # Shield the shared future, so that a timeout here does not cancel it for the other calls
         try:
-            reset = int(r.headers["X-RateLimit-Reset"])
-            remaining = int(r.headers["X-RateLimit-Remaining"])
-            limit = int(r.headers["X-RateLimit-Limit"])
-            domain_ratelimit_lookup[_key] = (limit, remaining, reset)
-        except KeyError:
-            pass
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(flight)), deadline.remaining())
+        except asyncio.TimeoutError as err:
+            raise DeadlineExceeded("Out of time waiting for a request to %s" % url) from err
 
-        # This should never happen, but if it does, just retry
-        if r.status_code in (503, 429):
+    try:
+        r = await _ahttp_fetch(url, method, headers, params, **kwargs)
+    except BaseException as err:
+        _land_flight(key, flight, error=err)
+        raise
+
+    _land_flight(key, flight, r)
+    return r
+
+async def _ahttp_fetch(url, method, headers, params, **kwargs):
+    # Copy the headers, since callers may reuse one dict for unrelated requests
+    headers = dict(headers) if headers else {}
+    headers["User-Agent"] = USER_AGENT
+
+    if "json" in kwargs:
+        body = json.dumps(kwargs.pop("json")).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+    else:
+        body = kwargs.pop("data", None)
+
+    cached = http_cache.cached_request(method, url, params, body, headers)
+    if cached is not None:
+        r = cached.fresh_response()
+        if r is not None:
+            return r
+        cached.add_validators(headers)
+
+    timeout = kwargs.pop("timeout", None)
+
+    # With a deadline there is no time for back-off retries, as in http_fetch
+    max_retries = 0 if deadline.current() else RETRIES
+    request_url = cassette.route(url)
+    session = _get_async_session(request_url)
+    parse = urlparse(url)
+    bucket = ratelimit.get_bucket(parse.scheme, parse.netloc)
+    retries = 0
+    while True:
+        backoff = BACKOFF_FACTOR * (2 ** (retries - 1)) if retries > 0 else 0.0
+        slept, request_timeout = _reserve(url, bucket, timeout, backoff)
+        if request_timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=request_timeout)
+        if slept > 0:
+            await asyncio.sleep(slept)
+
+        try:
+            async with session.request(method, request_url, params=params, headers=headers, data=body, **kwargs) as response:
+                content = await response.read()
+                r = requests.Response()
+                r.status_code = response.status
+                r.reason = response.reason
+                r.headers = CaseInsensitiveDict(response.headers)
+                r.url = str(response.url)
+                r.encoding = get_encoding_from_headers(r.headers)
+                r._content = content
+        except asyncio.TimeoutError as err:
+            if deadline.current() is not None and deadline.current().expired():
+                raise DeadlineExceeded("Request to %s timed out at the deadline of the run" % url) from err
+            raise
+        except aiohttp.ClientConnectionError as err:
+            if retries >= max_retries:
+                raise requests.exceptions.ConnectionError(err)
+            retries += 1
+            continue
+
+        _update_ratelimit(bucket, r.headers)
+        record_http_request(len(body or b""), len(r.content), slept)
+
+        if r.status_code in RETRY_STATUS_CODES:
+            if retries >= max_retries:
+                raise requests.exceptions.RetryError("Max retries exceeded for %s (HTTP %d)" % (url, r.status_code))
+            retries += 1
             continue
 
-        return r
+        return r if cached is None else cached.finish(r)
@@ -0,0 +1,220 @@
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter, thread_time
+
+# The measurement frame of the element that is currently executing in this thread/task, if any.
+_active_frame = ContextVar("troi_active_frame", default=None)
+
+
+class ElementStats:
+    """
+        Counters collected for one element during one pipeline run.
+
+        Times are exclusive: time an element spends waiting for its sources to produce items is
+        charged to the sources, not to the element. In asyncio runs, an element is charged only while
+        its own task is running (see measure_await()), not for the time other tasks run while it awaits
+        a response. The HTTP counters are updated under lock, since
+        an element may make requests from several threads at once.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.items_in = 0
+        self.items_out = 0
+        self.http_requests = 0
+        self.http_bytes_sent = 0
+        self.http_bytes_received = 0
+        self.http_sleep_time = 0.0
+        self.http_cache_hits = 0
+        self.http_cache_misses = 0
+        self.http_coalesced = 0
+
+    def to_dict(self):
+        return {
+            "element": self.name,
+            "wall_time": round(self.wall_time, 6),
+            "cpu_time": round(self.cpu_time, 6),
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "http_requests": self.http_requests,
+            "http_bytes_sent": self.http_bytes_sent,
+            "http_bytes_received": self.http_bytes_received,
+            "http_sleep_time": round(self.http_sleep_time, 6),
+            "http_cache_hits": self.http_cache_hits,
+            "http_cache_misses": self.http_cache_misses,
+            "http_coalesced": self.http_coalesced,
+        }
+
+
+class _Frame:
+    """ An active measurement of one element in one thread. """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.thread = threading.get_ident()
+        self.resume()
+
+    def resume(self):
+        self.wall_start = perf_counter()
+        self.cpu_start = thread_time()
+
+    def charge(self):
+        self.stats.wall_time += perf_counter() - self.wall_start
+        self.stats.cpu_time += thread_time() - self.cpu_start
+
+
+class _TaskTimer:
+    """
+        Await a coroutine on behalf of a frame, pausing the frame's timer each time the coroutine
+        suspends and resuming it when the coroutine is resumed.
+    """
+
+    def __init__(self, awaitable, frame):
+        self.awaitable = awaitable
+        self.frame = frame
+
+    def __await__(self):
+        iterator = self.awaitable.__await__()
+        value, error = None, None
+        try:
+            while True:
+                self.frame.resume()
+                try:
+                    if error is not None:
+                        signal = iterator.throw(error)
+                    else:
+                        signal = iterator.send(value)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    self.frame.charge()
+
+                try:
+                    value, error = (yield signal), None
+                except GeneratorExit:
+                    iterator.close()
+                    raise
+                except BaseException as err:
+                    value, error = None, err
+        finally:
+            # The rest of the measured block is charged from here on
+            self.frame.resume()
+
+
+async def measure_await(awaitable):
+    """
+        Await the given awaitable inside an Instrumentation.measure() block, charging the element only
+        for the time its own task runs rather than for the time the event loop spends on other tasks
+        while it is suspended.
+    """
+
+    frame = _active_frame.get()
+    if frame is None:
+        return await awaitable
+
+    return await _TaskTimer(awaitable, frame)
+
+
+class Instrumentation:
+    """
+        Collects an ElementStats object for each element in a pipeline run. Use stats() to
+        fetch the collected data as a dict, keyed by the path of the element in the pipeline.
+    """
+
+    def __init__(self):
+        self.elements = {}
+        self.start_time = perf_counter()
+        self.end_time = None
+
+    def add_element(self, element, path):
+        self.elements[element] = ElementStats(path)
+
+    def get(self, element):
+        return self.elements[element]
+
+    @contextmanager
+    def measure(self, element):
+        """
+            Charge the wall and CPU time spent inside this block, as well as any HTTP requests
+            made, to the given element. The timer of the enclosing element in the same thread is
+            paused while the block runs.
+        """
+
+        parent = _active_frame.get()
+        if parent is not None and parent.thread == threading.get_ident():
+            parent.charge()
+        else:
+            parent = None
+
+        frame = _Frame(self.elements[element])
+        token = _active_frame.set(frame)
+        try:
+            yield frame.stats
+        finally:
+            frame.charge()
+            _active_frame.reset(token)
+            if parent is not None:
+                parent.resume()
+
+    def finish(self):
+        self.end_time = perf_counter()
+
+    def stats(self):
+        """ Return the collected stats as a dict that can be serialized to JSON. """
+
+        end_time = self.end_time if self.end_time is not None else perf_counter()
+        return {
+            "total_wall_time": round(end_time - self.start_time, 6),
+            "elements": {stats.name: stats.to_dict() for stats in self.elements.values()}
+        }
+
+
+def record_http_request(bytes_sent, bytes_received, sleep_time):
+    """
+        Record an HTTP request against the element that is currently executing, if any. Called
+        by troi.http_request for every request it makes.
+    """
+
+    frame = _active_frame.get()
+    if frame is None:
+        return
+
+    stats = frame.stats
+    with stats.lock:
+        stats.http_requests += 1
+        stats.http_bytes_sent += bytes_sent
+        stats.http_bytes_received += bytes_received
+        stats.http_sleep_time += sleep_time
+
+
+def record_http_cache(hit):
+    """
+        Record a lookup in the HTTP response cache against the element that is currently executing, if
+        any. Called by troi.http_cache for every cacheable request.
+    """
+
+    frame = _active_frame.get()
+    if frame is None:
+        return
+
+    with frame.stats.lock:
+        if hit:
+            frame.stats.http_cache_hits += 1
+        else:
+            frame.stats.http_cache_misses += 1
+
+
+def record_http_coalesced():
+    """
+        Record an HTTP call that shared the response of an identical request already in flight against
+        the element that is currently executing, if any. Called by troi.http_request.
+    """
+
+    frame = _active_frame.get()
+    if frame is not None:
+        with frame.stats.lock:
+            frame.stats.http_coalesced += 1
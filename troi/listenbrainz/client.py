@@ -0,0 +1,49 @@
+from urllib.parse import urljoin
+
+import liblistenbrainz
+import liblistenbrainz.errors
+import requests
+
+import troi.http_request
+
+
+class ListenBrainzClient(liblistenbrainz.ListenBrainz):
+    '''
+        A liblistenbrainz client that makes its requests with troi.http_request, so that they share its
+        connection pools, rate limits, response cache, request coalescing and deadlines, and are recorded
+        and replayed by troi.cassette. The API methods and errors are those of liblistenbrainz.
+    '''
+
+    def _get(self, endpoint, params=None, headers=None):
+        response = troi.http_request.http_get(urljoin(self.api_base_url, endpoint), params=params,
+                                              headers=self._headers(headers))
+        self._check(response)
+        if response.status_code == 204:
+            raise liblistenbrainz.errors.ListenBrainzAPIException(status_code=204)
+
+        return response.json()
+
+    def _post(self, endpoint, data=None, headers=None):
+        response = troi.http_request.http_post(urljoin(self.api_base_url, endpoint), data=data,
+                                               headers=self._headers(headers))
+        self._check(response)
+        return response.json()
+
+    def _headers(self, headers):
+        headers = dict(headers) if headers else {}
+        if self._auth_token:
+            headers["Authorization"] = f"Token {self._auth_token}"
+        return headers
+
+    def _check(self, response):
+        """ Raise ListenBrainzAPIException for an error response, as liblistenbrainz does. """
+
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as err:
+            try:
+                message = response.json().get("error", "")
+            except Exception:
+                message = None
+            raise liblistenbrainz.errors.ListenBrainzAPIException(status_code=response.status_code,
+                                                                   message=message) from err
@@ -3,8 +3,12 @@ from datetime import datetime, timedelta
 from typing import Optional
 from time import sleep
 
+from more_itertools import chunked
+
+from troi import deadline
 from troi.http_request import http_get
 from troi import Element, Recording
+from troi.mbid import intern_mbid
 
 
 class ListensFeedbackLookup(Element):
@@ -13,6 +17,10 @@ class ListensFeedbackLookup(Element):
         :param user_name: The ListenBrainz user_name for whom to fetch feedback information.
     """
 
+    COPY_ON_WRITE = True
+    BATCH_SIZE = 50
+    RUNTIME_ARGUMENTS = ("user_name", "auth_token")
+
     def __init__(self, user_name, auth_token=None):
         super().__init__()
         self.user_name = user_name
@@ -26,22 +34,15 @@ class ListensFeedbackLookup(Element):
     def outputs():
         return [Recording]
 
-    def read(self, inputs):
-        recordings = inputs[0]
-        if not recordings:
-            return []
-
-        mbids = set()
-        for r in recordings:
-            mbids.add(r.mbid)
-        mbids = list(mbids)
+    def _fetch_feedback(self, mbids):
+        """ Fetch the user's feedback for the given recording mbids and return a dict canonical mbid -> score """
 
         headers = {"Authorization": f"Token {self.auth_token}"} if self.auth_token else {}
 
         feedback_map = {}
-        batch_size = 50
-        for idx in range(0, len(mbids), batch_size):
-            recording_mbids = mbids[idx: idx + batch_size]
+        for idx in range(0, len(mbids), self.BATCH_SIZE):
+            deadline.check()
+            recording_mbids = mbids[idx: idx + self.BATCH_SIZE]
 
             response = http_get(
                 f"https://api.listenbrainz.org/1/feedback/user/{self.user_name}/get-feedback-for-recordings",
@@ -54,10 +55,24 @@ class ListensFeedbackLookup(Element):
                 continue
 
             for feedback in data:
-                mbid = feedback["recording_mbid"]
-                feedback_map[mbid] = feedback["score"]
+                feedback_map[intern_mbid(feedback["recording_mbid"])] = feedback["score"]
 
+        return feedback_map
+
+    def read(self, inputs):
+        recordings = inputs[0]
+        if not recordings:
+            return []
+
+        mbids = list(dict.fromkeys([r.mbid for r in recordings]))
+        feedback_map = self._fetch_feedback(mbids)
         for r in recordings:
             r.listenbrainz["score"] = feedback_map.get(r.mbid, 0)
 
         return recordings
+
+    def stream(self, source_iterators):
+        """ Fetch feedback one batch at a time, only as recordings are pulled downstream. """
+
+        for recordings in chunked(source_iterators[0], self.BATCH_SIZE):
+            yield from self.read([recordings])
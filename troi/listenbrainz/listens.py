@@ -3,8 +3,11 @@ from datetime import datetime, timedelta
 from typing import Optional
 from time import sleep
 
+from troi import deadline
 from troi.http_request import http_get
 from troi import Element, Recording
+from troi.batch import datetime64_column
+from troi.mbid import intern_mbid
 
 
 class RecentListensTimestampLookup(Element):
@@ -19,12 +22,21 @@ class RecentListensTimestampLookup(Element):
         :param days: The number of days to check.
     """
 
+    COPY_ON_WRITE = True
+    BATCH = True
+    RUNTIME_ARGUMENTS = ("user_name", "auth_token")
+
     def __init__(self, user_name, days: int, auth_token=None):
         super().__init__()
         self.user_name = user_name
         self.days = days
         self.auth_token = auth_token
-        self.index: Optional[dict[str, int]] = None
+        self.index: Optional[dict[int, int]] = None
+
+    def set_arguments(self, arguments):
+        super().set_arguments(arguments)
+        # the cached listens belong to the previous user
+        self.index = None
 
     @staticmethod
     def inputs():
@@ -35,14 +47,16 @@ class RecentListensTimestampLookup(Element):
         return [Recording]
 
     def _fetch_recent_listens_index(self):
-        """ Return an index of recording mbids as key and the latest listened_at time of the corresponding
-        recording as values.
+        """ Return an index of canonical recording mbids (see troi.mbid.intern_mbid) as key and the latest listened_at
+        time of the corresponding recording as values.
         """
         index = defaultdict(int)
 
         min_dt = datetime.now() + timedelta(days=-self.days)
         min_ts = int(min_dt.timestamp())
         while True:
+            # Stop paging once the run is out of time
+            deadline.check()
             headers = {"Authorization": f"Token {self.auth_token}"} if self.auth_token else {}
             response = http_get(
                 f"https://api.listenbrainz.org/1/user/{self.user_name}/listens",
@@ -60,13 +74,13 @@ class RecentListensTimestampLookup(Element):
                 # add both user submitted mbid and mapped mbid to index
 
                 additional_info = listen["track_metadata"]["additional_info"]
-                user_submitted_mbid = additional_info.get("recording_mbid")
+                user_submitted_mbid = intern_mbid(additional_info.get("recording_mbid"))
                 if user_submitted_mbid:
                     index[user_submitted_mbid] = max(index[user_submitted_mbid], listened_at)
 
                 mbid_mapping = listen["track_metadata"].get("mbid_mapping")
                 if mbid_mapping:
-                    mapped_mbid = mbid_mapping.get("recording_mbid")
+                    mapped_mbid = intern_mbid(mbid_mapping.get("recording_mbid"))
                     index[mapped_mbid] = max(index[mapped_mbid], listened_at)
 
             min_ts = data["listens"][0]["listened_at"]
@@ -81,7 +95,7 @@ class RecentListensTimestampLookup(Element):
         ts2 = None
         if r.listenbrainz is not None and r.listenbrainz.get("canonical_recording_mbid"):
             canonical_mbid = r.listenbrainz.get("canonical_recording_mbid")
-            ts2 = self.index.get(canonical_mbid)
+            ts2 = self.index.get(intern_mbid(canonical_mbid))
 
         # if we have timestamp for both canonical and normal mbid take the maximum of two else whichever
         # one is available. if none is available continue ahead
@@ -111,3 +125,18 @@ class RecentListensTimestampLookup(Element):
             r.listenbrainz["latest_listened_at"] = latest_listened_at
 
         return recordings
+
+    def stream(self, source_iterators):
+        """ Look up the recordings as they are pulled downstream; the recent listens are fetched for the first one. """
+
+        for r in source_iterators[0]:
+            yield from self.read([[r]])
+
+    def read_batch(self, batches):
+        batch = batches[0]
+        recordings = self.read([batch.to_recordings()])
+        if not recordings:
+            return batch
+
+        return batch.replace(latest_listened_at=datetime64_column([r.listenbrainz.get("latest_listened_at")
+                                                                   for r in recordings]))
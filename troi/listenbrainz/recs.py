@@ -5,14 +5,17 @@ import requests
 import liblistenbrainz
 import liblistenbrainz.errors
 
-from troi import Element, Recording, PipelineError
+from troi import Element, Recording, PipelineError, deadline
+from troi.batch import RecordingBatch
+from troi.listenbrainz.client import ListenBrainzClient
 
 MAX_NUM_RECORDINGS_PER_REQUEST = 100
 
 
 class UserRecordingRecommendationsElement(Element):
     '''
-        Fetch recommended recordings for a user from ListenBrainz.
+        Fetch recommended recordings for a user from ListenBrainz. The recordings are returned as a RecordingBatch,
+        so that the filters that follow can work on its columns.
 
         :param user_name: The ListenBrainz user to fetch recs for.
         :param artist_type: The type of recs to fetch. Must be one of "top", "similar" or "raw".
@@ -20,10 +23,11 @@ class UserRecordingRecommendationsElement(Element):
     '''
 
     MAX_RECORDINGS_TO_FETCH = 2000
+    RUNTIME_ARGUMENTS = ("user_name",)
 
     def __init__(self, user_name, artist_type, count=25, offset=0, auth_token=None):
         super().__init__()
-        self.client = liblistenbrainz.ListenBrainz()
+        self.client = ListenBrainzClient()
         if auth_token is not None:
             self.client.set_auth_token(auth_token)
         self.user_name = user_name
@@ -32,6 +36,11 @@ class UserRecordingRecommendationsElement(Element):
         self.artist_type = artist_type
         self._last_updated = None
 
+    def set_arguments(self, arguments):
+        super().set_arguments(arguments)
+        if arguments.get("auth_token") is not None:
+            self.client.set_auth_token(arguments["auth_token"])
+
     def outputs(self):
         return [Recording]
 
@@ -44,6 +53,7 @@ class UserRecordingRecommendationsElement(Element):
 
         remaining = self.MAX_RECORDINGS_TO_FETCH if self.count < 0 else self.count
         while True:
+            deadline.check()
             try:
                 recordings = self.client.get_user_recommendation_recordings(self.user_name, 
                                                                             self.artist_type, 
@@ -76,4 +86,4 @@ class UserRecordingRecommendationsElement(Element):
         if recordings:
             self._last_updated = recordings['payload']['last_updated']
 
-        return recording_list
+        return RecordingBatch.from_recordings(recording_list)
@@ -3,6 +3,7 @@ import logging
 from troi import Element, Artist, ArtistCredit, Release, Recording
 import liblistenbrainz
 import liblistenbrainz.errors
+from troi.listenbrainz.client import ListenBrainzClient
 
 logger = logging.getLogger(__name__)
 
@@ -17,9 +18,11 @@ class UserArtistsElement(Element):
         :param offset: The offset into the results. Used for pagination.
     '''
 
+    RUNTIME_ARGUMENTS = ("user_name",)
+
     def __init__(self, user_name, count=25, offset=0, time_range='all_time', auth_token=None):
         super().__init__()
-        self.client = liblistenbrainz.ListenBrainz()
+        self.client = ListenBrainzClient()
         if auth_token:
             self.client.set_auth_token(auth_token)
         self.user_name = user_name
@@ -27,6 +30,11 @@ class UserArtistsElement(Element):
         self.offset = offset
         self.time_range = time_range
 
+    def set_arguments(self, arguments):
+        super().set_arguments(arguments)
+        if arguments.get("auth_token"):
+            self.client.set_auth_token(arguments["auth_token"])
+
     def outputs(self):
         return [ArtistCredit]
 
@@ -52,9 +60,11 @@ class UserReleasesElement(Element):
         :param offset: The offset into the results. Used for pagination.
     '''
 
+    RUNTIME_ARGUMENTS = ("user_name",)
+
     def __init__(self, user_name, count=25, offset=0, time_range='all_time', auth_token=None):
         super().__init__()
-        self.client = liblistenbrainz.ListenBrainz()
+        self.client = ListenBrainzClient()
         if auth_token:
             self.client.set_auth_token(auth_token)
         self.user_name = user_name
@@ -62,6 +72,11 @@ class UserReleasesElement(Element):
         self.offset = offset
         self.time_range = time_range
 
+    def set_arguments(self, arguments):
+        super().set_arguments(arguments)
+        if arguments.get("auth_token"):
+            self.client.set_auth_token(arguments["auth_token"])
+
     def outputs(self):
         return [Release]
 
@@ -89,9 +104,11 @@ class UserRecordingElement(Element):
         :param offset: The offset into the results. Used for pagination.
     '''
 
+    RUNTIME_ARGUMENTS = ("user_name",)
+
     def __init__(self, user_name, count=25, offset=0, time_range='all_time', auth_token=None):
         super().__init__()
-        self.client = liblistenbrainz.ListenBrainz()
+        self.client = ListenBrainzClient()
         if auth_token:
             self.client.set_auth_token(auth_token)
         self.user_name = user_name
@@ -99,6 +116,11 @@ class UserRecordingElement(Element):
         self.offset = offset
         self.time_range = time_range
 
+    def set_arguments(self, arguments):
+        super().set_arguments(arguments)
+        if arguments.get("auth_token"):
+            self.client.set_auth_token(arguments["auth_token"])
+
     def outputs(self):
         return [Recording]
 
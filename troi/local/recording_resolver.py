@@ -12,6 +12,8 @@ class RecordingResolverElement(Element):
         name set and resolves them to a local collection by using the ContentResolver class
     """
 
+    COPY_ON_WRITE = True
+
     def __init__(self, match_threshold, quiet):
         """ Match threshold: The value from 0 to 1.0 on how sure a match must be to be accepted.
         """
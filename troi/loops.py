@@ -1,27 +1,95 @@
 import logging
-from copy import copy
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import requests
 
 import troi
 from troi import PipelineError, User
+from troi.playlist import PlaylistElement
 from troi.utils import discover_patches
 
 logger = logging.getLogger(__name__)
 
 
+def _new_result(patch_slug, user_name, error=None):
+    return {
+        "patch": patch_slug,
+        "user_name": user_name,
+        "status": ForLoopElement.FAILED,
+        "recordings": 0,
+        "error": error,
+        "url": None
+    }
+
+
+def _generate_playlist(patch_class, patch_slug, patch_args):
+    """
+        Generate one playlist of a for loop. This runs in a worker thread or process, so that it
+        can't take down the loop, any error is returned in the result instead of being raised.
+
+        Returns a tuple (result, playlist), where playlist is the generated Playlist or None.
+    """
+
+    result = _new_result(patch_slug, patch_args["user_name"])
+    try:
+        patch = patch_class(patch_args)
+        playlist_element = patch.generate_playlist()
+    except Exception as err:
+        result["error"] = "Failed to generate playlist: %s" % err
+        return result, None
+
+    if not playlist_element.playlists:
+        result["status"] = ForLoopElement.SKIPPED
+        result["error"] = "No playlist was generated."
+        return result, None
+
+    playlist = playlist_element.playlists[0]
+    playlist.add_metadata({"algorithm_metadata": {"source_patch": patch_slug}})
+    result["status"] = ForLoopElement.GENERATED
+    result["recordings"] = len(playlist.recordings or [])
+
+    return result, playlist
+
+
 class ForLoopElement(troi.Element):
     '''
         An element that receives items from a pipeline and for each item in the pipeline it instantiates a new patch and executes that patch. A normal use case might include taking a list of users and running the specified patch for each user.
 
         As of right now, only User objects can be processed with this element.
 
+        Playlists can be generated for several users at the same time, in a pool of threads or, for patches that
+        are CPU bound, in a pool of processes. A failure to generate or submit the playlist of one user is logged
+        and does not stop the loop. Playlists are submitted one at a time from the thread that calls read(), so
+        that the rate limits of the ListenBrainz API are respected.
+
+        After the loop has run, the report attribute holds a dict for each patch and user, in input order, with the
+        keys patch, user_name, status (one of the GENERATED, SUBMITTED, SKIPPED or FAILED constants), recordings,
+        error and url.
+
         :param patch_slug: the slug of the patch to run inside the for loop
         :param pipeline_args: the arguments passed to top-level pipeline, so that they apply to dynamically created pipelines inside the for loop
+        :param concurrency: the number of playlists to generate at the same time. Default 1, one after another.
+        :param use_processes: if True, generate playlists in a pool of processes rather than threads. Default False.
     '''
 
-    def __init__(self, patch_slugs, patch_args):
+    GENERATED = "generated"
+    SUBMITTED = "submitted"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+    def __init__(self, patch_slugs, patch_args, concurrency=1, use_processes=False):
         super().__init__()
         self.patch_slugs = patch_slugs
         self.patch_args = patch_args
+        self.concurrency = concurrency
+        self.use_processes = use_processes
+        self.report = []
+
+        self.patches = discover_patches()
+        for patch_slug in self.patch_slugs:
+            if not patch_slug in self.patches:
+                raise PipelineError("ForLoop: Cannot load patch '%s'" % patch_slug)
 
     @staticmethod
     def inputs():
@@ -33,52 +101,83 @@ class ForLoopElement(troi.Element):
 
     def read(self, inputs):
 
-        patches = discover_patches()
+        upload = self.patch_args.get("upload", False)
+        token = self.patch_args.get("token")
+        if upload and not token:
+            raise PipelineError("In order to upload a playlist an auth token must be provided. Use --token")
 
-        outputs = []
+        jobs = []
         for patch_slug in self.patch_slugs:
-            if not patch_slug in patches:
-                raise PipelineError("ForLoop: Cannot load patch '%s'" % patch_slug)
-
-            patch = patches[patch_slug](False)
             for user in inputs[0]:
-                args = copy(self.patch_args)
-                args["user_name"] = user.user_name
-                pipeline = patch.create(args)
-                self.patch_args["created_for"] = user.user_name
-
-                try:
-                    logger.info("generate %s for %s" % (patch_slug, user.user_name))
-                    playlist = troi.playlist.PlaylistElement()
-                    playlist.set_sources(pipeline)
-                    playlist.generate()
-
-                    if self.patch_args["min_recordings"] is not None and \
-                        len(playlist.playlists[0].recordings) < self.patch_args["min_recordings"]:
-                        logger.info("Playlist does not have at least %d recordings, not submitting.\n" % self.patch_args["min_recordings"])
-                        continue
-
-                    if not self.patch_args["quiet"]:
-                        playlist.print()
-                    playlist.add_metadata({"algorithm_metadata": {"source_patch": patch_slug}})
-                    if self.patch_args["upload"]:
-                        if not self.patch_args["token"] or self.patch_args["token"] == "":
-                            raise PipelineError("In order to upload a playlist an auth token must be provided. Use --token")
-
-                        try:
-                            if self.patch_args["created_for"] and self.patch_args["created_for"] != "":
-                                playlist.submit(self.patch_args["token"], self.patch_args["created_for"])
-                            else:
-                                playlist.submit(self.patch_args["token"])
-                        except troi.PipelineError as err:
-                            logger.error("Failed to submit playlist: %s, continuing..." % err)
-                            continue
-
-                    outputs.append(playlist.playlists[0])
-                    logger.info("")
-                except troi.PipelineError as err:
-                    logger.info("Failed to generate playlist: %s" % err)
-                    raise
+                # Playlists are submitted by this element, once they have been checked, and are not saved
+                # to disk by each patch
+                args = {**self.patch_args, "user_name": user.user_name, "created_for": user.user_name,
+                        "upload": False, "save": False, "min_recordings": None}
+                jobs.append((self.patches[patch_slug], patch_slug, args))
+
+        self.report = [None] * len(jobs)
+        playlists = [None] * len(jobs)
+        for i, (result, playlist) in self._generate(jobs):
+            if playlist is not None:
+                playlist = self._check_playlist(result, playlist)
+            if playlist is not None and upload:
+                self._submit_playlist(result, playlist, token)
+
+            logger.info("%s for %s: %s%s" % (result["patch"], result["user_name"], result["status"],
+                                              ", " + result["error"] if result["error"] else ""))
+            self.report[i] = result
+            playlists[i] = playlist
+
+        counts = Counter([result["status"] for result in self.report])
+        logger.info("ForLoop: %d playlists generated, %d submitted, %d skipped, %d failed." %
+                    (counts[self.GENERATED], counts[self.SUBMITTED], counts[self.SKIPPED], counts[self.FAILED]))
 
         # Return None if you want to stop processing this pipeline
-        return outputs
+        return [playlist for playlist in playlists if playlist is not None]
+
+    def _generate(self, jobs):
+        """
+            Generate the playlists for the given jobs and yield tuples (index, (result, playlist)) in the
+            order in which they are completed.
+        """
+
+        if self.concurrency <= 1:
+            for i, job in enumerate(jobs):
+                logger.info("generate %s for %s" % (job[1], job[2]["user_name"]))
+                yield i, _generate_playlist(*job)
+            return
+
+        pool_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with pool_class(max_workers=self.concurrency) as pool:
+            futures = {pool.submit(_generate_playlist, *job): i for i, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    outcome = future.result()
+                except Exception as err:
+                    # e.g. a worker process died or the job could not be sent to it
+                    _, patch_slug, args = jobs[i]
+                    outcome = (_new_result(patch_slug, args["user_name"], "Failed to generate playlist: %s" % err), None)
+                yield i, outcome
+
+    def _check_playlist(self, result, playlist):
+        min_recordings = self.patch_args.get("min_recordings")
+        if min_recordings is not None and result["recordings"] < min_recordings:
+            result["status"] = self.SKIPPED
+            result["error"] = "Playlist does not have at least %d recordings, not submitting." % min_recordings
+            return None
+
+        return playlist
+
+    def _submit_playlist(self, result, playlist, token):
+        playlist_element = PlaylistElement()
+        playlist_element.playlists = [playlist]
+        try:
+            for url, _ in playlist_element.submit(token, result["user_name"]):
+                result["url"] = url
+        except (troi.PipelineError, requests.exceptions.RequestException) as err:
+            result["status"] = self.FAILED
+            result["error"] = "Failed to submit playlist: %s" % err
+            return
+
+        result["status"] = self.SUBMITTED
@@ -0,0 +1,29 @@
+import re
+import sys
+
+_HEX32 = re.compile("[0-9a-fA-F]{32}")
+_CANONICAL = re.compile("[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def intern_mbid(mbid):
+    """
+        Return the canonical, interned form of an MBID: lower case and hyphenated. Entities normalise
+        their MBIDs with this function when they are set, so that elements can compare and index
+        MBIDs as plain strings. All entities that hold the same MBID share a single string object, rather
+        than each holding a copy of the 36 character string. Values that are not UUIDs (such as None or
+        the made up MBIDs of tests) are returned unchanged, so they are never equal to a real MBID.
+    """
+
+    if not isinstance(mbid, str):
+        return mbid
+
+    if len(mbid) == 36 and _CANONICAL.fullmatch(mbid) is not None:
+        # The common case: an MBID as returned by the MusicBrainz and ListenBrainz APIs
+        return sys.intern(mbid)
+
+    h = mbid.replace("-", "")
+    if len(h) != 32 or _HEX32.fullmatch(h) is None:
+        return mbid
+
+    h = h.lower()
+    return sys.intern("%s-%s-%s-%s-%s" % (h[:8], h[8:12], h[12:16], h[16:20], h[20:]))
@@ -13,6 +13,8 @@ class MBIDMappingLookupElement(Element):
        :param remove_unmatched: If True (default False) do not return any Recordings that were not found using the mapping.
     '''
 
+    COPY_ON_WRITE = True
+
     SERVER_URL = "https://labs.api.listenbrainz.org/mbid-mapping/json"
 
     def __init__(self, remove_unmatched=False):
@@ -1,9 +1,13 @@
+import asyncio
 from collections import defaultdict
+from contextvars import copy_context
 from time import sleep
 
 import ujson
+from more_itertools import chunked
 
 from troi import Element, Artist, ArtistCredit, PipelineError, Recording, Playlist, Release
+from troi.executor import ThreadedExecutor
 import troi.http_request
 
 
@@ -11,11 +15,23 @@ class RecordingLookupElement(Element):
     '''
         Look up a musicbrainz data for a list of recordings, based on MBID.
 
+        Any number of recordings can be looked up: the MBIDs are split into chunks of CHUNK_SIZE, which are
+        looked up at the same time, up to MAX_PARALLEL_CHUNKS at once, under the shared rate limit of the
+        server. The recordings are returned in input order.
+
         :param skip_not_found: If skip_not_found is set to True (the default) then Recordings that cannot be found in MusicBrainz will not be returned from this Element.
     '''
 
+    COPY_ON_WRITE = True
+
     SERVER_URL = "https://api.listenbrainz.org/1/metadata/recording"
+    # The most MBIDs the server accepts in one request, which CHUNK_SIZE, the number sent in each request,
+    # must not exceed
     MAX_RECORDINGS = 1000
+    CHUNK_SIZE = 250
+    MAX_PARALLEL_CHUNKS = 4
+    STREAM_BATCH_SIZE = 100
+    RUNTIME_ARGUMENTS = ("auth_token",)
 
     def __init__(self, skip_not_found=True, lookup_tags=False, tag_threshold=None, auth_token=None):
         Element.__init__(self)
@@ -32,36 +48,94 @@ class RecordingLookupElement(Element):
     def outputs():
         return [ Recording, Playlist ]
 
-    def read(self, inputs):
-
+    def _get_recordings(self, inputs):
         if isinstance(inputs[0], Playlist):
-            recordings = inputs[0].recordings
-        else:
-            recordings = inputs[0]
-        if not recordings:
-            return []
+            return inputs[0].recordings
 
-        recording_mbids = []
-        for r in recordings:
-            recording_mbids.append(r.mbid)
+        return inputs[0]
+
+    @staticmethod
+    def _empty(inputs):
+        """ Return the output for inputs without recordings: a playlist without recordings is passed on as is. """
+
+        return inputs[0] if isinstance(inputs[0], Playlist) else []
 
-        if len(recording_mbids) > self.MAX_RECORDINGS:
-            raise PipelineError("Cannot fetch more than %d recordings from ListenBrainz." % self.MAX_RECORDINGS)
+    def _make_request(self, recording_mbids):
+        """ Return the keyword arguments for the metadata lookup POST for the given recording MBIDs """
 
         inc = "artist release"
         if self.lookup_tags:
             inc += " tag"
 
         headers = {"Authorization": f"Token {self.auth_token}"} if self.auth_token else {}
-        r = troi.http_request.http_post(self.SERVER_URL, json={"recording_mbids": recording_mbids, "inc": inc}, headers=headers)
+        return {"json": {"recording_mbids": recording_mbids, "inc": inc}, "headers": headers}
+
+    def _chunks(self, recordings):
+        """ Split the distinct MBIDs of the recordings into the lists to look up in each request """
+
+        recording_mbids = list(dict.fromkeys(r.mbid for r in recordings))
+        return list(chunked(recording_mbids, self.CHUNK_SIZE))
+
+    def _lookup(self, recording_mbids):
+        r = troi.http_request.http_post(self.SERVER_URL, **self._make_request(recording_mbids))
+        return self._parse_response(r)
+
+    async def _alookup(self, recording_mbids):
+        r = await troi.http_request.ahttp_post(self.SERVER_URL, **self._make_request(recording_mbids))
+        return self._parse_response(r)
+
+    def read(self, inputs):
+
+        recordings = self._get_recordings(inputs)
+        if not recordings:
+            return self._empty(inputs)
+
+        chunks = self._chunks(recordings)
+        if len(chunks) == 1:
+            return self._process_data(inputs, recordings, self._lookup(chunks[0]))
+
+        # Each chunk runs in a copy of this context, so that its requests keep to the deadline of the run
+        # and are counted against this element.
+        jobs = [(copy_context(), chunk) for chunk in chunks]
+        executor = ThreadedExecutor(max_workers=self.MAX_PARALLEL_CHUNKS)
+        data = {}
+        for chunk_data in executor.map(lambda job: job[0].run(self._lookup, job[1]), jobs):
+            data.update(chunk_data)
+
+        return self._process_data(inputs, recordings, data)
+
+    async def aread(self, inputs):
+
+        recordings = self._get_recordings(inputs)
+        if not recordings:
+            return self._empty(inputs)
+
+        semaphore = asyncio.Semaphore(self.MAX_PARALLEL_CHUNKS)
+
+        async def lookup(chunk):
+            async with semaphore:
+                return await self._alookup(chunk)
+
+        data = {}
+        for chunk_data in await asyncio.gather(*[lookup(chunk) for chunk in self._chunks(recordings)]):
+            data.update(chunk_data)
+
+        return self._process_data(inputs, recordings, data)
+
+    def _parse_response(self, r):
+        """ Return the data of a metadata lookup response, keyed by recording MBID """
+
         if r.status_code != 200:
             raise PipelineError("Cannot fetch recordings from ListenBrainz: HTTP code %d (%s)" % (r.status_code, r.text))
 
         try:
-            data = ujson.loads(r.text)
+            return ujson.loads(r.text)
         except ValueError as err:
             raise PipelineError("Cannot parse recordings: " + str(err))
 
+    def _process_data(self, inputs, recordings, data):
+        """ Fill in the looked up data for each recording """
+
         output = []
         for r in recordings:
             # Check if some tracks didn't resolve
@@ -152,3 +226,16 @@ class RecordingLookupElement(Element):
             output = inputs[0]
 
         return output
+
+    def stream(self, source_iterators):
+        """
+            Look up recordings in batches of STREAM_BATCH_SIZE, so that no more lookups are made once
+            the downstream elements have all the recordings they need.
+        """
+
+        for batch in chunked(source_iterators[0], self.STREAM_BATCH_SIZE):
+            if isinstance(batch[0], Playlist):
+                for playlist in batch:
+                    yield self.read([playlist])
+            else:
+                yield from self.read([batch])
@@ -1,5 +1,5 @@
-import copy
-from itertools import zip_longest
+from itertools import chain, zip_longest
+from operator import attrgetter
 
 import troi
 
@@ -17,17 +17,18 @@ def is_homogeneous(entities):
     return len(type_set) == 1
 
 
-def _ensure_conformity(entities_0, entities_1):
-    """ Check that both entity lists are homogenous and of the same type. """
+def _ensure_conformity(*entity_lists):
+    """ Check that all entity lists are homogenous and of the same type. """
 
-    if not is_homogeneous(entities_0):
-        raise TypeError("entities_0 list not homogenous")
-
-    if not is_homogeneous(entities_1):
-        raise TypeError("entities_1 list not homogenous")
+    entity_type = None
+    for i, entities in enumerate(entity_lists):
+        if not is_homogeneous(entities):
+            raise TypeError("entities_%d list not homogenous" % i)
 
-    if entities_0 and entities_1 and type(entities_0[0]) != type(entities_1[0]):
-        raise TypeError("entities_0 and entities_1 must both be homogenous with all the same type")
+        if entities:
+            if entity_type is not None and type(entities[0]) != entity_type:
+                raise TypeError("entity lists must all be homogenous with all the same type")
+            entity_type = type(entities[0])
 
     return True
 
@@ -48,155 +49,239 @@ def _check_key_for_set_op(entities, key):
             raise ValueError("key must be one of mbid or name.")
 
 
-class UniqueElement(troi.Element):
+def normalize_name(name):
+    """ Return a name in lower case, with runs of whitespace collapsed, for comparing names. """
+
+    if not name:
+        return ""
+
+    return " ".join(name.casefold().split())
+
+
+def artist_credit_name_key(recording):
+    """
+        A key function for set operations that considers recordings with the same artist credit and
+        (normalized) name to be the same, whatever their MBIDs.
     """
-        Make this passed list of entities unique base on the passed key
-        (must be one of name or mbid) and return the unique list. recordings also allow
-        msid as key and artists allow artist_credit_id as key. Currently the order of the
-        list is not preserved. This should be improved on...
 
-        :param key: Which key to use for making the list unique. Defaults to "mbid".
+    artist_credit_id = recording.artist_credit.artist_credit_id if recording.artist_credit is not None else None
+    return (artist_credit_id, normalize_name(recording.name))
+
+
+def key_function(key):
+    """
+        Return the function that computes the key of an entity for a set operation. The key is either
+        a callable that is given the entity, or the name of an attribute of the entity. MBIDs and MSIDs
+        are compared as the canonical strings the entities hold (see troi.mbid.intern_mbid),
+        and lists (such as the artists of an artist credit) by their contents.
     """
 
-    def __init__(self, key="mbid"):
-        troi.Element.__init__(self)
-        self.key = key
+    if callable(key):
+        return key
 
-    @staticmethod
-    def inputs():
-        return []
+    if key in ("mbid", "msid"):
+        return attrgetter(key)
 
-    def read(self, entities_arg):
-        entities = entities_arg[0]
+    def get_key(entity):
+        value = getattr(entity, key)
+        return tuple(value) if isinstance(value, list) else value
 
-        if not entities:
-            return []
+    return get_key
 
-        if not is_homogeneous(entities):
-            raise TypeError("entity list not homogenous")
-        _check_key_for_set_op(entities, self.key)
 
-        entity_dict = {}
-        for e in entities:
-            if isinstance(e, troi.ArtistCredit) and self.key == "artists":
-                entity_dict[",".join(getattr(e, self.key))] = e
-            else:
-                entity_dict[getattr(e, self.key)] = e
+def _unique(entities, key):
+    """ Yield the entities whose key has not been seen before, in order. """
 
-        return list(entity_dict.values())
+    seen = set()
+    for e in entities:
+        k = key(e)
+        if k not in seen:
+            seen.add(k)
+            yield e
 
 
-class UnionElement(troi.Element):
-    """ Combine both entities lists into one """
+class _SetOperationElement(troi.Element):
+    """
+        The base class of the set operation elements: the entities are compared by the key given to the
+        constructor, which is the name of an attribute or a function (see key_function()).
+    """
 
-    def __init__(self):
+    def __init__(self, key):
         troi.Element.__init__(self)
+        self.key = key
 
     def inputs(self):
         return []
 
-    def read(self, entities):
-        entities_0 = entities[0]
-        entities_1 = entities[1]
+    def outputs(self):
+        return []
 
-        if not entities_0:
-            return entities_1
+    def _key_function(self, entity_lists):
+        """ Check that the given lists can be combined and return the key function. """
 
-        if not entities_1:
-            return entities_0
+        _ensure_conformity(*entity_lists)
+        if isinstance(self.key, str):
+            for entities in entity_lists:
+                if entities:
+                    _check_key_for_set_op(entities, self.key)
+                    break
+
+        return key_function(self.key)
+
+
+class UniqueElement(_SetOperationElement):
+    """
+        Make this passed list of entities unique base on the passed key
+        (must be one of name or mbid, or a key function) and return the unique list. recordings
+        also allow msid as key and artists allow artist_credit_id as key. The first entity with
+        a given key is kept, in the order of the input. If several inputs are given, the result
+        contains the unique entities of all of them.
+
+        :param key: Which key to use for making the list unique. Defaults to "mbid".
+    """
 
-        _ensure_conformity(entities_0, entities_1)
+    def __init__(self, key="mbid"):
+        super().__init__(key)
 
-        result = copy.copy(entities_0)
-        result.extend(entities_1)
+    def read(self, entities_arg):
+        entity_lists = [entities for entities in entities_arg if entities]
+        if not entity_lists:
+            return []
 
-        return result
+        key = self._key_function(entity_lists)
+        return list(_unique(chain.from_iterable(entity_lists), key))
 
+    def stream(self, source_iterators):
+        return _unique(chain.from_iterable(source_iterators), key_function(self.key))
 
-class IntersectionElement(troi.Element):
+
+class UnionElement(_SetOperationElement):
     """
-        Return the list of entities that exist in both entities lists.
+        Combine any number of entity lists into one, in order. If a key is given, only the
+        first entity with any given key is kept.
+
+        :param key: Which key to use to remove duplicates, or None to keep all entities. Defaults to None.
     """
 
-    def __init__(self, key="mbid"):
-        troi.Element.__init__(self)
-        self.key = key
+    def __init__(self, key=None):
+        super().__init__(key)
 
-    def inputs(self):
-        return []
+    def read(self, entities):
+        entity_lists = [e for e in entities if e]
+        if not entity_lists:
+            return []
+
+        if self.key is None:
+            _ensure_conformity(*entity_lists)
+            if len(entity_lists) == 1:
+                return entity_lists[0]
+            return list(chain.from_iterable(entity_lists))
+
+        key = self._key_function(entity_lists)
+        return list(_unique(chain.from_iterable(entity_lists), key))
+
+    def stream(self, source_iterators):
+        entities = chain.from_iterable(source_iterators)
+        if self.key is None:
+            return entities
+
+        return _unique(entities, key_function(self.key))
+
+
+class IntersectionElement(_SetOperationElement):
+    """
+        Return the entities of the first input whose key is found in all the other inputs, in the
+        order of the first input. Only the keys of the smallest input are kept in memory.
+
+        :param key: Which key to use to compare entities. Defaults to "mbid".
+    """
+
+    def __init__(self, key="mbid"):
+        super().__init__(key)
 
     def read(self, entities):
         entities_0 = entities[0]
-        entities_1 = entities[1]
+        others = entities[1:]
 
-        if not entities_0 or not entities_1:
+        if not entities_0 or not all(others):
             return []
 
-        _ensure_conformity(entities_0, entities_1)
-        _check_key_for_set_op(entities_0, self.key)
+        key = self._key_function(entities)
+        if not others:
+            return entities_0
 
-        entity_dict = {}
-        for e in entities_1:
-            if isinstance(e, troi.Artist) and self.key == "mbids":
-                entity_dict[",".join(getattr(e, self.key))] = e
-            else:
-                entity_dict[getattr(e, self.key)] = e
+        others = sorted(others, key=len)
+        if len(entities_0) < len(others[0]):
+            keys = set(map(key, entities_0))
+        else:
+            keys = set(map(key, others.pop(0)))
 
-        results = []
-        for e in entities_0:
-            if isinstance(e, troi.Artist) and self.key == "mbids":
-                if ",".join(getattr(e, self.key)) in entity_dict:
-                    results.append(e)
-            else:
-                if getattr(e, self.key) in entity_dict:
-                    results.append(e)
+        for other in others:
+            if not keys:
+                break
+            # Only the keys found in both are kept, so the set never grows
+            keys = keys.intersection(map(key, other))
 
+        return [e for e in entities_0 if key(e) in keys]
 
-        return results
+    def stream(self, source_iterators):
+        key = key_function(self.key)
 
+        keys = None
+        for iterator in source_iterators[1:]:
+            keys = set(map(key, iterator)) if keys is None else keys.intersection(map(key, iterator))
 
-class DifferenceElement(troi.Element):
-    '''
-        Return the list of recordings in entities_0 minus those in entities_1
+        if keys is None:
+            return source_iterators[0]
+
+        return (e for e in source_iterators[0] if key(e) in keys)
+
+
+class DifferenceElement(_SetOperationElement):
     '''
+        Return the entities in the first input whose key is not found in any of the other
+        inputs, in the order of the first input.
 
-    def __init__(self, key = "mbid"):
-        troi.Element.__init__(self)
-        self.key = key
+        :param key: Which key to use to compare entities. Defaults to "mbid".
+    '''
 
-    def inputs(self):
-        return []
+    def __init__(self, key="mbid"):
+        super().__init__(key)
 
     def read(self, entities):
         entities_0 = entities[0]
-        entities_1 = entities[1]
+        others = [e for e in entities[1:] if e]
 
         if not entities_0:
             return []
 
-        if not entities_1:
+        if not others:
             return entities_0
 
-        _ensure_conformity(entities_0, entities_1)
-        _check_key_for_set_op(entities_0, self.key)
-
-        entity_dict = {}
-        for e in entities_1:
-            if isinstance(e, troi.Artist) and self.key == "mbids":
-                entity_dict[",".join(getattr(e, self.key))] = e
-            else:
-                entity_dict[getattr(e, self.key)] = e
-
-        results = []
-        for e in entities_0:
-            if isinstance(e, troi.Artist) and self.key == "mbids":
-                if ",".join(getattr(e, self.key)) not in entity_dict:
-                    results.append(e)
-            else:
-                if getattr(e, self.key) not in entity_dict:
-                    results.append(e)
-
-        return results
+        key = self._key_function([entities_0] + others)
+        keys_0 = [key(e) for e in entities_0]
+
+        if len(entities_0) < sum(len(other) for other in others):
+            # Hash the smaller side: only keep the keys of the other inputs that are in the first input
+            candidates = set(keys_0)
+            removed = set()
+            for other in others:
+                removed.update(k for k in map(key, other) if k in candidates)
+        else:
+            removed = set()
+            for other in others:
+                removed.update(map(key, other))
+
+        return [e for e, k in zip(entities_0, keys_0) if k not in removed]
+
+    def stream(self, source_iterators):
+        key = key_function(self.key)
+
+        removed = set()
+        for iterator in source_iterators[1:]:
+            removed.update(map(key, iterator))
+
+        return (e for e in source_iterators[0] if key(e) not in removed)
 
 
 class ZipperElement(troi.Element):
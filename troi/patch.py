@@ -1,8 +1,15 @@
+import asyncio
+import copy
 import logging
+import random
+import threading
 
 import troi
 from abc import ABC, abstractmethod
 
+from troi.executor import get_executor
+from troi.pipeline import Pipeline
+from troi.snapshot import SnapshotStore
 from troi.playlist import PlaylistElement
 from troi.logging_utils import set_log_level
 from troi.recording_search_service import RecordingSearchByTagService, RecordingSearchByArtistService
@@ -20,7 +27,13 @@ default_patch_args = dict(save=False,
                           spotify=None,
                           apple_music=None,
                           soundcloud=None,
-                          quiet=False)
+                          quiet=False,
+                          concurrency=1,
+                          stream=False,
+                          record=None,
+                          replay=None,
+                          seed=None,
+                          timeout=None)
 
 
 class Patch(ABC):
@@ -32,9 +45,37 @@ class Patch(ABC):
         # Dict used for local storage
         self.local_storage = {}
 
+        # Per-element timing and counters of the last generate_playlist() run.
+        self.stats = None
+
+        # Held while a playlist is generated, since runs share the compiled plan and the local storage.
+        self._run_lock = threading.Lock()
+
         self.patch_args = {**default_patch_args, **args}
         self.pipeline = self.create(self.patch_args)
-        self._set_element_patch(self.pipeline)
+
+        # The local storage set up by create(), which every run starts from.
+        self._initial_storage = copy.deepcopy(self.local_storage)
+
+        # Check the pipeline once and compile it into a plan that generate_playlist() runs.
+        root = PlaylistElement()
+        root.set_sources(self.pipeline)
+        self.plan = Pipeline(root).compile()
+        for element in self.plan.elements:
+            element.set_patch_object(self)
+
+        # The executor used to evaluate sibling sources in the pipeline. Replace it to plug in a different one.
+        self.executor = get_executor(self.patch_args["concurrency"])
+
+        # Record the output of each element to disk, or replay it from there, see troi.snapshot.
+        self.snapshots = None
+        record, replay = self.patch_args["record"], self.patch_args["replay"]
+        if record and replay:
+            raise RuntimeError("A patch cannot record and replay snapshots at the same time.")
+        if record:
+            self.snapshots = SnapshotStore(record, SnapshotStore.RECORD, self.patch_args["seed"])
+        elif replay:
+            self.snapshots = SnapshotStore(replay, SnapshotStore.REPLAY, self.patch_args["seed"])
 
         auth_token = self.patch_args["token"]
         # Setup extensible services
@@ -133,10 +174,17 @@ class Patch(ABC):
         except KeyError:
             return []
 
-    def generate_playlist(self):
+    def generate_playlist(self, arguments=None):
         """
         Generate a playlist 
 
+        The pipeline is compiled when the patch is created, so a patch can generate many playlists.
+        If arguments is given, it is a dict of runtime arguments (e.g. user_name or auth_token) that is
+        passed to Element.set_arguments() of each element before the run. Each run starts with the
+        local storage as create() left it. A patch generates one playlist at a time: starting a run
+        while another is in progress (e.g. concurrent calls to agenerate_playlist()) raises RuntimeError,
+        so create one patch object for each concurrent run.
+
         The args parameter is a dict and may containt the following keys:
 
         * quiet: Do not print out anything
@@ -150,26 +198,92 @@ class Patch(ABC):
         * spotify: if present, attempt to submit the playlist to spotify as well. should be a dict and contain the spotify user id, spotify auth token with appropriate permissions, whether the playlist should be public, private or collaborative. it can also optionally have the existing urls to update playlists instead of creating new ones.
         * apple_music: if present, attempt to submit the playlist to Apple Music as well. should be a dict and contain the apple developer token, user music token, whether the playlist should be public, private. it can also optionally have the existing urls to update playlists instead of creating new ones.
         * soundcloud: if present, attempt to submit the palylist to soundcloud. should contain soundcloud auth token, whether the playlist should be public or private
+        * concurrency: The number of sibling sources in the pipeline that may be evaluated at the same time. Default: 1, evaluate sources one after another.
+        * stream: If True, run the pipeline in streaming mode, where elements pull recordings from their sources only as they need them. Default: False.
+        * record: If given, save the output of each element in this directory, so that the run can be replayed later.
+        * replay: If given, use the output of each element saved in this directory by an earlier run with record, instead of reading from the element.
+        * seed: If given, seed the random number generator with this value before the run, so that shuffles and random choices can be repeated.
+        * timeout: If given, the time budget of the run in seconds. HTTP requests are cut short at the deadline; optional elements (e.g. the streams of a blend) then output nothing, other elements raise DeadlineExceeded.
+
+        Once this function returns (or raises), the stats attribute holds a dict with the wall time, CPU time, items in/out and HTTP requests, bytes and rate limit sleep time for each element of the pipeline.
         """
 
+        context = self._start_context()
         try:
-            set_log_level(self.patch_args.get("quiet", False))
-            playlist = PlaylistElement()
-            playlist.set_sources(self.pipeline)
-            logger.info("Troi playlist generation starting...")
-            result = playlist.generate(self.quiet)
+            result = self.plan.run(self.quiet, context, arguments)
+            # The root element is reused by the next run, so hand out a copy that holds this run's playlists.
+            playlist = copy.copy(self.plan.root)
+        except troi.PipelineError as err:
+            raise RuntimeError("Playlist generation failed: %s" % err)
+        finally:
+            self._finish_run(context)
 
-            name = self.patch_args["name"]
-            if name:
-                playlist.playlists[0].name = name
+        return self._process_playlist(playlist, result)
 
-            desc = self.patch_args["desc"]
-            if desc:
-                playlist.playlists[0].descripton = desc
+    async def agenerate_playlist(self, arguments=None):
+        """
+        The asyncio version of generate_playlist(), which takes the same patch arguments. The compiled
+        pipeline is run on the event loop using Element.agenerate(), so that sources are evaluated
+        concurrently. Saving, printing and uploading the finished playlist is blocking and runs in a
+        worker thread. As for generate_playlist(), a patch runs one playlist at a time; use one patch
+        object for each playlist that is generated concurrently.
+        """
 
-            logger.info("done.")
+        context = self._start_context()
+        try:
+            result = await self.plan.arun(self.quiet, context, arguments)
+            playlist = copy.copy(self.plan.root)
         except troi.PipelineError as err:
             raise RuntimeError("Playlist generation failed: %s" % err)
+        finally:
+            self._finish_run(context)
+
+        return await asyncio.to_thread(self._process_playlist, playlist, result)
+
+    def _start_context(self):
+        """
+            Create the RunContext for a new run.
+        """
+
+        if not self._run_lock.acquire(blocking=False):
+            raise RuntimeError("This patch is already generating a playlist. Use one patch object for each concurrent run.")
+
+        set_log_level(self.patch_args.get("quiet", False))
+        logger.info("Troi playlist generation starting...")
+
+        if self.snapshots is None and self.patch_args["seed"] is not None:
+            random.seed(self.patch_args["seed"])
+
+        self.local_storage = copy.deepcopy(self._initial_storage)
+        # The root element only sets its playlists when it is read, which it isn't if a source returns None
+        self.plan.root.playlists = []
+
+        timeout = self.patch_args["timeout"]
+        return troi.RunContext(executor=self.executor,
+                               streaming=self.patch_args["stream"],
+                               snapshots=self.snapshots,
+                               deadline=troi.Deadline(timeout) if timeout is not None else None)
+
+    def _finish_run(self, context):
+        context.instrumentation.finish()
+        self.stats = context.instrumentation.stats()
+        self._run_lock.release()
+
+    def _process_playlist(self, playlist, result):
+        """
+            Apply name/description overrides to the generated playlist, then save, upload and print it
+            as requested by the patch arguments.
+        """
+
+        name = self.patch_args["name"]
+        if name:
+            playlist.playlists[0].name = name
+
+        desc = self.patch_args["desc"]
+        if desc:
+            playlist.playlists[0].descripton = desc
+
+        logger.info("done.")
 
         upload = self.patch_args["upload"]
         token = self.patch_args["token"]
@@ -232,11 +346,3 @@ class Patch(ABC):
             logger.info("%d playlists were generated." % len(playlist.playlists))
 
         return playlist
-
-    def _set_element_patch(self, element):
-        """ 
-            Go through the pipeline, setting the patch objects for each Element
-        """
-        element.set_patch_object(self)
-        for src in element.sources:
-            self._set_element_patch(src)
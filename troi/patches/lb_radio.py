@@ -245,6 +245,9 @@ class LBRadioPatch(troi.patch.Patch):
             hate_filter = troi.filters.HatedRecordingsFilterElement()
             hate_filter.set_sources(recs_lookup)
 
+            # If the run has a time budget, blend whichever streams complete in time
+            source.optional = recs_lookup.optional = hate_filter.optional = True
+
             elements.append(hate_filter)
 
         # Finish the pipeline with the element that blends and weighs the streams
@@ -1,8 +1,68 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
+
+from more_itertools import roundrobin
+
 import troi
-from random import randint
 from troi import Recording
 from troi import TARGET_NUMBER_OF_RECORDINGS
+from troi.sampling import AliasTable
+
+
+def weighted_blend(queues, weights, accept=None, rng=None):
+    """
+        Lazily blend the items of several queues: for each item, a queue is picked at random with a
+        probability proportional to its weight, and items are taken from the front of the queue until
+        one is accepted. Queues that run out are dropped right away, so each pick takes O(1) time and
+        the blend of all queues takes time linear in the total number of items.
+
+        :param queues: A list of deques, which are consumed.
+        :param weights: The weight of each queue. Queues with a weight of 0 are never picked.
+        :param accept: A function that is given an item and returns False if the item should be skipped.
+        :param rng: The random.Random instance to use, or None to use the random module.
+    """
+
+    active = [i for i, queue in enumerate(queues) if queue and weights[i] > 0]
+    while active:
+        table = AliasTable([weights[i] for i in active], rng)
+        while True:
+            pick = table.pick()
+            queue = queues[active[pick]]
+            while queue:
+                item = queue.popleft()
+                if accept is None or accept(item):
+                    yield item
+                    break
+
+            if not queue:
+                # Rebuild the table without the exhausted queue
+                del active[pick]
+                break
+
+
+class IteratorQueue:
+    """
+        A queue over an iterator, which can be passed to weighted_blend() in place of a deque: items are
+        pulled from the iterator only as they are taken from the queue.
+    """
+
+    _EMPTY = object()
+
+    def __init__(self, iterator):
+        self.iterator = iter(iterator)
+        self.head = self._EMPTY
+
+    def __bool__(self):
+        if self.head is self._EMPTY:
+            self.head = next(self.iterator, self._EMPTY)
+        return self.head is not self._EMPTY
+
+    def popleft(self):
+        if not self:
+            raise IndexError("pop from an empty queue")
+
+        item, self.head = self.head, self._EMPTY
+        return item
 
 
 class InterleaveRecordingsElement(troi.Element):
@@ -20,21 +80,10 @@ class InterleaveRecordingsElement(troi.Element):
         return [Recording]
 
     def read(self, entities):
+        return list(roundrobin(*entities))
 
-        recordings = []
-        while True:
-            empty = 0
-            for entity in entities:
-                try:
-                    recordings.append(entity.pop(0))
-                except IndexError:
-                    empty += 1
-
-            # Did we process all the recordings?
-            if empty == len(entities):
-                break
-
-        return recordings
+    def stream(self, source_iterators):
+        return roundrobin(*source_iterators)
 
 
 class WeighAndBlendRecordingsElement(troi.Element):
@@ -43,6 +92,8 @@ class WeighAndBlendRecordingsElement(troi.Element):
         then combine all the input sources into one weighted output stream.
 
         A source that has a weight of 2 will be chosen 2 times more often than a source with weight 1.
+        Recordings whose MBID is already in the output are skipped, as are recordings by artists that already
+        have max_artist_occurrence recordings in the output.
     """
 
     def __init__(self, weights, max_num_recordings=TARGET_NUMBER_OF_RECORDINGS, max_artist_occurrence=None):
@@ -58,50 +109,38 @@ class WeighAndBlendRecordingsElement(troi.Element):
         return [Recording]
 
     def read(self, entities):
+        return list(self._blend([deque(e) for e in entities]))
 
-        total_available = sum([len(e) for e in entities])
+    def stream(self, source_iterators):
+        """ Pull recordings from the sources only until the output is full. """
 
-        # prepare the weights
-        total = sum(self.weights)
-        summed = []
-        acc = 0
-        for i in self.weights:
-            acc += i
-            summed.append(acc)
+        return self._blend([IteratorQueue(iterator) for iterator in source_iterators])
 
-        # Ensure seed artists are the first tracks -- doing this for all recording elements work in this case.
-        recordings = []
-        for element in entities:
-            try:
-                recordings.append(element.pop(0))
-            except IndexError:
-                pass
+    def _blend(self, queues):
 
         # This still allows sequential tracks to be from the same artists. I'll wait for feedback to see if this
         # is a problem.
         artist_counts = defaultdict(int)
         dedup_set = set()
-        while True:
-            r = randint(0, total)
-            for i, s in enumerate(summed):
-                if r < s:
-                    while True:
-                        if len(entities[i]) > 0:
-                            rec = entities[i].pop(0)
-                            if rec.mbid in dedup_set:
-                                total_available -= 1
-                                continue
-                            if self.max_artist_occurrence is not None and \
-                                    artist_counts[rec.artist_credit.artist_credit_id] == self.max_artist_occurrence:
-                                total_available -= 1
-                                continue
-
-                            recordings.append(rec)
-                            dedup_set.add(rec.mbid)
-                            artist_counts[rec.artist_credit.artist_credit_id] += 1
-                        break
-
-            if len(recordings) >= self.max_num_recordings or len(recordings) == total_available:
-                break
 
-        return recordings
+        def accept(rec):
+            key = rec.mbid
+            if key in dedup_set:
+                return False
+
+            if self.max_artist_occurrence is not None:
+                artist_credit_id = rec.artist_credit.artist_credit_id
+                if artist_counts[artist_credit_id] == self.max_artist_occurrence:
+                    return False
+                artist_counts[artist_credit_id] += 1
+
+            dedup_set.add(key)
+            return True
+
+        # Ensure seed artists are the first tracks -- doing this for all recording elements work in this case.
+        seeds = [queue.popleft() for queue in queues if queue]
+        recordings = [rec for rec in seeds if accept(rec)]
+        yield from recordings
+
+        remaining = max(0, self.max_num_recordings - len(recordings))
+        yield from islice(weighted_blend(queues, self.weights, accept), remaining)
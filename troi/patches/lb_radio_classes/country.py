@@ -67,7 +67,7 @@ class LBRadioCountryRecordingElement(Element):
 
         r = Recording(mbid=row['recording_mbid'])
         if 'artist_credit_name' in row:
-            r.artist = ArtistCredit(name=row['artist_credit_name'])
+            r.artist_credit = ArtistCredit(name=row['artist_credit_name'])
 
         if 'recording_name' in row:
             r.name = row['recording_name']
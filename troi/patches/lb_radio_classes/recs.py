@@ -5,9 +5,10 @@ from uuid import UUID
 import troi
 import liblistenbrainz
 import liblistenbrainz.errors
-from troi import Artist, Recording
+from troi import Artist, Recording, deadline
 from troi import TARGET_NUMBER_OF_RECORDINGS
 from troi.parse_prompt import TIME_RANGES
+from troi.listenbrainz.client import ListenBrainzClient
 
 
 class LBRadioRecommendationRecordingElement(troi.Element):
@@ -23,7 +24,7 @@ class LBRadioRecommendationRecordingElement(troi.Element):
         self.user_name = user_name
         self.listened = listened
         self.mode = mode
-        self.client = liblistenbrainz.ListenBrainz()
+        self.client = ListenBrainzClient()
         if auth_token:
             self.client.set_auth_token(auth_token)
 
@@ -47,6 +48,7 @@ class LBRadioRecommendationRecordingElement(troi.Element):
         recordings = []
         count = self.MAX_RECOMMENDED_RECORDINGS // 3
         while count > 0:
+            deadline.check()
             # Fetch the user recs
             try:
                 result = self.client.get_user_recommendation_recordings(self.user_name, "raw",
@@ -8,6 +8,7 @@ import liblistenbrainz.errors
 from troi import Artist, ArtistCredit, Recording
 from troi import TARGET_NUMBER_OF_RECORDINGS
 from troi.parse_prompt import TIME_RANGES
+from troi.listenbrainz.client import ListenBrainzClient
 
 
 class LBRadioStatsRecordingElement(troi.Element):
@@ -22,7 +23,7 @@ class LBRadioStatsRecordingElement(troi.Element):
         self.user_name = user_name
         self.time_range = time_range
         self.mode = mode
-        self.client = liblistenbrainz.ListenBrainz()
+        self.client = ListenBrainzClient()
         if auth_token:
             self.client.set_auth_token(auth_token)
 
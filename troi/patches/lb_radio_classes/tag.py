@@ -59,7 +59,7 @@ class LBRadioTagRecordingElement(troi.Element):
         if len(self.tags) == 1 and self.include_similar_tags:
             similar_tags = self.fetch_similar_tags(self.tags[0])
 
-            if len(similar_tags[sim_start:sim_stop]) > 2:
+            if len(similar_tags.view(sim_start, sim_stop)) > 2:
                 while True:
                     selected_tags = similar_tags.random_item(count=2)
                     if selected_tags[0] == selected_tags[1]:
@@ -68,7 +68,7 @@ class LBRadioTagRecordingElement(troi.Element):
                     break
                 similar_tags = selected_tags
             else:
-                similar_tags = similar_tags[sim_start:sim_stop]
+                similar_tags = similar_tags.view(sim_start, sim_stop)
 
             similar_tags = [tag["similar_tag"] for tag in similar_tags]
             if len(similar_tags) > 0:
@@ -109,7 +109,6 @@ class PeriodicJamsPatch(Patch):
         if jam_type in ("daily-jams", "weekly-jams"):
             # Remove tracks that have not been listened to before.
             never_listened = troi.filters.NeverListenedFilterElement(keep_unlistened_if_empty=True)
-            never_listened.set_sources(recent_listens_lookup)
             if jam_type == "daily-jams":
                 jam_name = "Daily Jams"
             else:
@@ -119,23 +118,23 @@ class PeriodicJamsPatch(Patch):
 
             latest_filter = troi.filters.LatestListenedAtFilterElement(DAYS_OF_RECENT_LISTENS_TO_EXCLUDE,
                                                                        keep_unlistened_if_empty=True)
-            latest_filter.set_sources(never_listened)
         elif jam_type == "weekly-exploration":
             # Remove tracks that have been listened to before.
             never_listened = troi.filters.NeverListenedFilterElement(remove_unlistened=False)
-            never_listened.set_sources(recent_listens_lookup)
             jam_name = "Weekly Exploration"
             jam_date = "week of " + jam_date
             self.local_storage["jam_name"] = jam_name
 
             latest_filter = troi.filters.LatestListenedAtFilterElement(DAYS_OF_RECENT_LISTENS_TO_EXCLUDE)
-            latest_filter.set_sources(never_listened)
 
         else:
             raise RuntimeError("someone goofed up!")
 
+        listened_filter = troi.filters.FilterChainElement([never_listened, latest_filter])
+        listened_filter.set_sources(recent_listens_lookup)
+
         feedback_lookup = troi.listenbrainz.feedback.ListensFeedbackLookup(user_name, auth_token=inputs.get("token"))
-        feedback_lookup.set_sources(latest_filter)
+        feedback_lookup.set_sources(listened_filter)
 
         recs_lookup = troi.musicbrainz.recording_lookup.RecordingLookupElement(auth_token=inputs.get("token"))
         recs_lookup.set_sources(feedback_lookup)
@@ -1,5 +1,8 @@
 from datetime import datetime, timedelta
 
+import troi.filters
+import troi.listenbrainz.feedback
+import troi.listenbrainz.listens
 import troi.listenbrainz.recs
 import troi.musicbrainz.recording_lookup
 from troi import Playlist
@@ -60,11 +63,13 @@ class PeriodicJamsLocalPatch(Patch):
                                                                                        days=2)
         recent_listens_lookup.set_sources(recs)
 
-        latest_filter = troi.filters.LatestListenedAtFilterElement(DAYS_OF_RECENT_LISTENS_TO_EXCLUDE)
-        latest_filter.set_sources(recent_listens_lookup)
+        listened_filter = troi.filters.FilterChainElement([
+            troi.filters.LatestListenedAtFilterElement(DAYS_OF_RECENT_LISTENS_TO_EXCLUDE)
+        ])
+        listened_filter.set_sources(recent_listens_lookup)
 
         feedback_lookup = troi.listenbrainz.feedback.ListensFeedbackLookup(user_name, auth_token=inputs.get("token"))
-        feedback_lookup.set_sources(latest_filter)
+        feedback_lookup.set_sources(listened_filter)
 
         recs_lookup = troi.musicbrainz.recording_lookup.RecordingLookupElement()
         recs_lookup.set_sources(feedback_lookup)
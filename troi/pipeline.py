@@ -0,0 +1,196 @@
+import copy
+
+from troi import RunContext
+from troi.executor import SerialExecutor
+
+_VISITING = 1
+_DONE = 2
+
+
+class PlanStep:
+    """
+        One element of a compiled execution plan.
+
+        :param element: The element to read from.
+        :param path: The path of the element from the root of the pipeline, as used in the run stats.
+        :param sources: The indexes of the steps that produce the inputs of the element, in the order of element.sources.
+        :param level: The number of steps on the longest path from any source element to this one.
+        :param shared: True if the output of this element, or of any element upstream of it, is read by more than one consumer.
+    """
+
+    def __init__(self, element, path, sources, level, shared):
+        self.element = element
+        self.path = path
+        self.sources = sources
+        self.level = level
+        self.shared = shared
+
+
+class Pipeline:
+    """
+        A pipeline of elements that is checked and flattened into an execution plan once, so that it
+        can be run many times without walking the element graph and type checking every result again.
+
+        compile() rejects cycles and elements that cannot accept the output of their sources, and then
+        orders the elements so that each comes after all of its sources. With a concurrent executor, run()
+        evaluates the plan one level at a time, with all the elements of a level read through the executor
+        of the run context, so that independent elements may run concurrently. With the default serial
+        executor, the elements are read depth first, in the order Element.generate() reads them, so that an
+        element that returns None stops the elements after it from being read at all. Only the runtime
+        arguments of the elements (see Element.set_arguments()) should change between runs.
+
+        :param root: The last element of the pipeline, whose output is the output of the pipeline.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.steps = None
+        self.levels = None
+        self.serial_order = None
+        self.paths = None
+        self.consumers = None
+
+    @property
+    def elements(self):
+        """ The elements of the compiled plan, sources before the elements that read from them. """
+
+        if self.steps is None:
+            self.compile()
+
+        return [step.element for step in self.steps]
+
+    def compile(self):
+        """
+            Check the pipeline and build its execution plan. Raises RuntimeError if the pipeline contains
+            a cycle or an element that cannot accept the output of one of its sources.
+
+            :returns: This pipeline, so that it can be compiled and run in one line.
+        """
+
+        # Iterative depth first search, which yields the elements in post-order: every element
+        # after all of its sources.
+        order = []
+        state = {self.root: _VISITING}
+        stack = [(self.root, iter(self.root.sources))]
+        while stack:
+            element, sources = stack[-1]
+            for source in sources:
+                if state.get(source) == _VISITING:
+                    trail = [e for e, _ in stack]
+                    cycle = trail[trail.index(source):] + [source]
+                    raise RuntimeError("Pipeline contains a cycle: %s" % " -> ".join([type(e).__name__ for e in cycle]))
+                if source not in state:
+                    state[source] = _VISITING
+                    stack.append((source, iter(source.sources)))
+                    break
+            else:
+                stack.pop()
+                state[element] = _DONE
+                order.append(element)
+
+        for element in order:
+            for source in element.sources:
+                element.check_source(source)
+
+        self.paths, self.consumers = RunContext.walk(self.root)
+
+        levels = {}
+        shared = {}
+        for element in order:
+            levels[element] = max([levels[source] + 1 for source in element.sources], default=0)
+            shared[element] = self.consumers[element] > 1 or any([shared[source] for source in element.sources])
+
+        depth_first = list(order)
+        order.sort(key=lambda element: levels[element])
+        index = {element: i for i, element in enumerate(order)}
+        self.serial_order = [index[element] for element in depth_first]
+        self.steps = [
+            PlanStep(element, self.paths[element], [index[source] for source in element.sources], levels[element],
+                     shared[element]) for element in order
+        ]
+
+        self.levels = [[] for _ in range(levels[self.root] + 1)]
+        for i, step in enumerate(self.steps):
+            self.levels[step.level].append(i)
+
+        return self
+
+    def run(self, quiet=True, context=None, arguments=None):
+        """
+            Run the compiled plan and return the output of the root element, or None if any element
+            returned None. The pipeline is compiled first if needed.
+
+            :param quiet: Do not log the number of items each element produced.
+            :param context: The RunContext for this run. If not given, a new one that evaluates elements serially is used.
+            :param arguments: A dict of runtime arguments to set on the elements before the run, see Element.set_arguments().
+        """
+
+        if self.steps is None:
+            self.compile()
+
+        if arguments is not None:
+            for step in self.steps:
+                step.element.set_arguments(arguments)
+
+        if context is None:
+            context = RunContext()
+        context.start(self.root, self)
+
+        # Streaming runs are driven by the root element pulling from its sources.
+        if context.streaming:
+            return self.root.generate(quiet, context)
+
+        if isinstance(context.executor, SerialExecutor):
+            batches = [[i] for i in self.serial_order]
+        else:
+            batches = self.levels
+
+        results = [None] * len(self.steps)
+        for batch in batches:
+            outputs = context.executor.map(lambda i: self._run_step(i, results, quiet, context), batch)
+            for i, items in zip(batch, outputs):
+                if items is None:
+                    return None
+                results[i] = items
+                context.set_result(self.steps[i].element, items)
+
+        return results[-1]
+
+    async def arun(self, quiet=True, context=None, arguments=None):
+        """
+            The asyncio counterpart to run(): the compiled plan is evaluated on the running event loop with
+            Element.agenerate(), so that independent elements run concurrently as tasks. The context's executor
+            and streaming mode are not used.
+
+            :param quiet: Do not log the number of items each element produced.
+            :param context: The RunContext for this run. If not given, a new one is used.
+            :param arguments: A dict of runtime arguments to set on the elements before the run, see Element.set_arguments().
+        """
+
+        if self.steps is None:
+            self.compile()
+
+        if arguments is not None:
+            for step in self.steps:
+                step.element.set_arguments(arguments)
+
+        if context is None:
+            context = RunContext()
+        context.start(self.root, self)
+
+        return await self.root.agenerate(quiet, context)
+
+    def _run_step(self, i, results, quiet, context):
+        step = self.steps[i]
+        found, items = step.element._replay(quiet, context)
+        if found:
+            return items
+
+        source_lists = []
+        for j in step.sources:
+            items = results[j]
+            if step.element.COPY_ON_WRITE and self.steps[j].shared:
+                items = copy.deepcopy(items)
+            source_lists.append(items)
+
+        return step.element._read_inputs(source_lists, quiet, context)
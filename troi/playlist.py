@@ -175,6 +175,8 @@ class PlaylistElement(Element):
         is designed to be the end of the pipeline for saving results.
     """
 
+    SNAPSHOT = False
+
     def __init__(self):
         super().__init__()
         self.playlists = []
@@ -189,6 +191,7 @@ class PlaylistElement(Element):
 
     def read(self, inputs):
 
+        self.playlists = []
         for input in inputs:
             if len(input) == 0:
                 logger.info("No recordings or playlists generated to save.")
@@ -381,6 +384,8 @@ class PlaylistRedundancyReducerElement(Element):
         in the playlist.
     '''
 
+    COPY_ON_WRITE = True
+
     def __init__(self, max_artist_occurrence=2, max_num_recordings=50):
         super().__init__()
         self.max_num_recordings = max_num_recordings
@@ -422,6 +427,8 @@ class PlaylistShuffleElement(Element):
         Take in a list of playlists, pass on shuffled playlists.
     '''
 
+    COPY_ON_WRITE = True
+
     def __init__(self):
         super().__init__()
 
@@ -447,6 +454,8 @@ class PlaylistBPMSawtoothSortElement(Element):
         Sort a playlist by BPM going from slow to fast and back to slow.
     '''
 
+    COPY_ON_WRITE = True
+
     def __init__(self):
         super().__init__()
 
@@ -493,6 +502,9 @@ class PlaylistMakerElement(Element):
         :param is_april_first: If True, do something very sneaky. Default: False.
     '''
 
+    COPY_ON_WRITE = True
+    RUNTIME_ARGUMENTS = ("name", "desc", "user_name")
+
     def __init__(self,
                  name=None,
                  desc=None,
@@ -523,18 +535,19 @@ class PlaylistMakerElement(Element):
         # We never actually return more than one playlist.
         return [Playlist]
 
-    def read(self, inputs):
-        recordings = inputs[0]
+    def _select(self, recordings):
+        """
+            Pick the recordings for the playlist from the given iterable, pulling no more recordings
+            from it than are needed to fill the playlist.
+        """
 
-        if self.max_num_recordings is None:
-            max_num_recordings = len(recordings)
-        else:
-            max_num_recordings = self.max_num_recordings
+        kept = []
+        if self.max_num_recordings is not None and self.max_num_recordings <= 0:
+            return kept
 
-        if self.max_artist_occurrence is not None:
-            kept = []
-            artists = defaultdict(int)
-            for r in recordings:
+        artists = defaultdict(int)
+        for r in recordings:
+            if self.max_artist_occurrence is not None:
                 keep = True
                 for mbid in [ a.mbid for a in r.artist_credit.artists ]:
                     if artists[mbid] >= self.max_artist_occurrence:
@@ -542,12 +555,25 @@ class PlaylistMakerElement(Element):
                         break
                     artists[mbid] += 1
 
-                if keep:
-                    kept.append(r)
+                if not keep:
+                    continue
 
-            recordings = kept[:max_num_recordings]
-        else:
-            recordings = recordings[:max_num_recordings]
+            kept.append(r)
+            if self.max_num_recordings is not None and len(kept) >= self.max_num_recordings:
+                break
+
+        return kept
+
+    def read(self, inputs):
+        return self._make_playlist(self._select(inputs[0]))
+
+    def stream(self, source_iterators):
+        """ Stop pulling recordings as soon as the playlist is full. """
+
+        yield from self._make_playlist(self._select(source_iterators[0]))
+
+    def _make_playlist(self, recordings):
+        """ Create the playlist from the selected recordings. """
 
         # Call the patch's post_process function
         self.patch.post_process()
@@ -1,6 +1,9 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
+from collections.abc import Sequence
 from datetime import datetime
-from random import randint
+from functools import partial
+
+from troi.sampling import AliasTable, sample_indexes
 
 
 class plist(list):
@@ -17,6 +20,11 @@ class plist(list):
         > a[a.uslice(.5)
         [3, 4]
 
+        Slicing returns a new list. To count, iterate over or sample a percent slice without
+        copying it, use a view:
+        > a.view(50)
+        plistview([3, 4])
+
     """
 
     def _get_index(self, percent):
@@ -57,29 +65,129 @@ class plist(list):
     def dslice(self, start=None, stop=None):
         return super().__getitem__(slice(start, stop))
 
-    def random_item(self, start_percent=0, stop_percent=99, count=1):
+    def _range(self, start_percent, stop_percent):
+        """ Return the range of indexes of the given percent slice. """
+
+        return range(len(self))[slice(self._get_index(start_percent), self._get_index(stop_percent))]
+
+    def view(self, start_percent=None, stop_percent=None):
+        """
+            Return a plistview of the specified percent slice, which refers to the items of this
+            list rather than copying them.
+        """
+
+        return plistview(self, self._range(start_percent, stop_percent))
+
+    def random_item(self, start_percent=0, stop_percent=99, count=1, rng=None):
         """
             Return a random item from the specified percent slice
 
-            count specifies the number of items to return, default 1.
+            count specifies the number of items to return, default 1. Items are sampled without
+            replacement, in O(count) time and without copying the slice.
 
             Return value is a data item, unless count is > 1, then a list is returned
+
+            rng is the random.Random instance to use, by default the random module.
         """
 
         if len(self) == 0:
             return []
 
-        start_index = self._get_index(start_percent)
-        stop_index = self._get_index(stop_percent)
+        return self.view(start_percent, stop_percent).random_item(count, rng)
+
+    def weighted_random_items(self, slices, count=1, rng=None):
+        """
+            Return a list of up to count random items from weighted percent slices: for each item, a
+            slice is picked with a probability proportional to its weight and then an item of that
+            slice is picked, without replacement. If a slice runs out of items, fewer items are returned.
+            The slices should not overlap, or the same item may be returned more than once.
+
+            > a.weighted_random_items([(0, 20, 3), (20, 100, 1)], count=10)
+
+            picks three out of four items from the top 20 percent of the list.
+
+            slices is a list of (start_percent, stop_percent, weight) tuples. rng is the random.Random
+            instance to use, by default the random module.
+        """
+
+        if len(self) == 0 or count < 1:
+            return []
+
+        ranges = [self._range(start_percent, stop_percent) for start_percent, stop_percent, _ in slices]
+        table = AliasTable([weight for _, _, weight in slices], rng)
+        picks = [table.pick() for _ in range(count)]
+
+        samples = {}
+        for s, n in Counter(picks).items():
+            samples[s] = [ranges[s][i] for i in sample_indexes(len(ranges[s]), n, rng)]
 
-        data = super().__getitem__(slice(start_index, stop_index))
         items = []
-        for i in range(len(data)):
-            index = randint(0, len(data) - 1)
-            items.append(data[index])
-            del data[index]
-            if len(items) == count or not data:
-                break
+        for s in picks:
+            if samples[s]:
+                items.append(super().__getitem__(samples[s].pop()))
+
+        return items
+
+
+class plistview(Sequence):
+    """
+        A read-only view of a slice of a plist, as returned by plist.view(). A view supports len(),
+        iteration, indexing and the other read-only list operations without copying any items, and
+        compares equal to a list with the same items. Slicing a view (with regular, not percent, indexes)
+        returns another view; tolist() or list() copy the items into a list.
+
+        A view refers to positions in the plist, so it reflects later changes to the plist.
+    """
+
+    __slots__ = ("_data", "_indexes")
+
+    def __init__(self, data, indexes):
+        self._data = data
+        self._indexes = indexes
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return plistview(self._data, self._indexes[index])
+
+        return list.__getitem__(self._data, self._indexes[index])
+
+    def __iter__(self):
+        return map(partial(list.__getitem__, self._data), self._indexes)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, plistview)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+        return NotImplemented
+
+    def __add__(self, other):
+        return self.tolist() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.tolist()
+
+    def __repr__(self):
+        return "plistview(%r)" % self.tolist()
+
+    def tolist(self):
+        """ Return the items of the view as a list. """
+
+        indexes = self._indexes
+        if indexes.step < 0:
+            return list(self)
+
+        return list.__getitem__(self._data, slice(indexes.start, indexes.stop, indexes.step))
+
+    def random_item(self, count=1, rng=None):
+        """
+            Return a random item of the view, or a list of count items if count is > 1, as
+            plist.random_item() does.
+        """
+
+        items = [self[i] for i in sample_indexes(len(self), count, rng)]
 
         if count > 1:
             return items
@@ -0,0 +1,135 @@
+import os
+import threading
+from time import monotonic
+
+# Hosts whose rate limit is configured rather than learned from the X-RateLimit-* headers of their responses.
+# key: host value: dict of TokenBucket arguments. MusicBrainz' Rate Limit headers are busted, so it gets a fixed
+# 1 request per second. Will need to remove after https://tickets.metabrainz.org/browse/MBH-589 is fixed.
+HOST_RATE_LIMITS = {
+    "musicbrainz.org": {"rate": 1.0, "capacity": 1, "use_headers": False},
+}
+
+# The token bucket of each host. key: scheme, host value: TokenBucket
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+        A token bucket that limits the rate of requests to one host, shared by all the threads and
+        event loops of the process. Each request takes a token; tokens are added at rate tokens per second,
+        up to capacity. When there are no tokens left, requests are queued: reserve() takes a token from
+        the future and returns how long the caller must wait before making its request, so that concurrent
+        requests share the budget rather than each sleeping for the whole of it. reserve() never blocks,
+        so it can be called from asyncio code as well as from threads.
+
+        A bucket without a rate does not limit requests until update() seeds it from the X-RateLimit
+        headers of a response.
+
+        :param rate: The number of requests per second, or None if it is not known yet.
+        :param capacity: The number of requests that can be made at once, default 1.
+        :param use_headers: If False, the X-RateLimit headers are ignored and the configured rate is kept.
+    """
+
+    def __init__(self, rate=None, capacity=1, use_headers=True):
+        self.rate = rate
+        self.capacity = capacity
+        self.use_headers = use_headers
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """ Take a token and return the number of seconds to wait before making the request. """
+
+        with self.lock:
+            if not self.rate:
+                return 0.0
+
+            self._refill(monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+
+            return -self.tokens / self.rate
+
+    def release(self):
+        """ Give back a token taken by reserve() for a request that was not made. """
+
+        with self.lock:
+            if self.rate:
+                self.tokens = min(self.capacity, self.tokens + 1)
+
+    def update(self, limit, remaining, reset_in):
+        """
+            Seed the bucket from the rate limit of the host: limit requests per window, of which remaining
+            can be made in the reset_in seconds until the window resets. The bucket holds the remaining
+            requests, up to limit, and refills at the rate that spreads the remaining requests over the time
+            left in the window; with no requests remaining, the next one waits for the reset.
+        """
+
+        if not self.use_headers or limit <= 0:
+            return
+
+        with self.lock:
+            self.updated = monotonic()
+            # The window may have reset by the time the response is read
+            reset_in = max(reset_in, .1)
+            self.rate = max(remaining, 1) / reset_in
+            self.capacity = limit
+            self.tokens = float(min(self.capacity, max(remaining, 0)))
+
+
+def get_bucket(scheme, host):
+    """ Return the token bucket for the given host (with its port, if any), creating it on first use. """
+
+    key = (scheme, host)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(key)
+            if bucket is None:
+                config = HOST_RATE_LIMITS.get(host) or HOST_RATE_LIMITS.get(host.rsplit(":", 1)[0], {})
+                bucket = TokenBucket(**config)
+                _buckets[key] = bucket
+
+    return bucket
+
+
+def configure_host(host, rate, capacity=1, use_headers=False):
+    """
+        Set the rate limit for a host, replacing the limit learned from its responses.
+
+        :param host: The host name (and port, if any) of the URLs to limit.
+        :param rate: The number of requests per second.
+        :param capacity: The number of requests that can be made at once.
+        :param use_headers: If True, the X-RateLimit headers of responses will update the rate.
+    """
+
+    HOST_RATE_LIMITS[host] = {"rate": rate, "capacity": capacity, "use_headers": use_headers}
+    with _buckets_lock:
+        for key in [key for key in _buckets if host in (key[1], key[1].rsplit(":", 1)[0])]:
+            del _buckets[key]
+
+
+def reset():
+    """ Forget the rate limits learned from responses. """
+
+    with _buckets_lock:
+        _buckets.clear()
+
+
+def _reset_after_fork():
+    # A child process starts with its own budget, and must not inherit a lock held by another thread
+    global _buckets_lock
+    _buckets.clear()
+    _buckets_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
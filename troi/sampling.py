@@ -0,0 +1,74 @@
+import random
+
+
+def sample_indexes(population, count, rng=None):
+    """
+        Return count distinct indexes into range(population), in random order, using a partial
+        Fisher-Yates shuffle. Only the positions that are swapped are stored, so this takes O(count)
+        time and memory however large the population is. If count is larger than the population,
+        all indexes are returned.
+
+        :param population: The number of items to sample from.
+        :param count: The number of indexes to return.
+        :param rng: The random.Random instance to use, or None to use the random module.
+    """
+
+    rng = rng or random
+    count = min(count, population)
+
+    swapped = {}
+    indexes = []
+    for i in range(count):
+        j = rng.randint(i, population - 1)
+        indexes.append(swapped.get(j, j))
+        swapped[j] = swapped.get(i, i)
+
+    return indexes
+
+
+class AliasTable:
+    """
+        Pick indexes at random with the probabilities given by a list of weights, using Vose's alias
+        method: building the table takes O(n) time, after which each pick takes O(1) time, however many
+        weights there are.
+
+        :param weights: A list of non-negative weights, at least one of which is positive.
+        :param rng: The random.Random instance to use, or None to use the random module.
+    """
+
+    def __init__(self, weights, rng=None):
+        if any(w < 0 for w in weights) or sum(weights) <= 0:
+            raise ValueError("weights must not be negative and at least one weight must be positive.")
+
+        self.rng = rng or random
+        count = len(weights)
+        total = sum(weights)
+
+        # Scale the weights so that they average 1, then pair each index that is below 1 with an
+        # index that is above 1 and takes the remainder of its slot.
+        self.probability = [w * count / total for w in weights]
+        self.alias = list(range(count))
+        small = [i for i, p in enumerate(self.probability) if p < 1.0]
+        large = [i for i, p in enumerate(self.probability) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.alias[s] = l
+            self.probability[l] += self.probability[s] - 1.0
+            if self.probability[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+
+        # Whatever is left over is 1, up to rounding errors
+        for i in small + large:
+            self.probability[i] = 1.0
+
+    def __len__(self):
+        return len(self.probability)
+
+    def pick(self):
+        """ Return a random index, with the probability given by its weight. """
+
+        i = int(self.rng.random() * len(self.probability))
+        return i if self.rng.random() < self.probability[i] else self.alias[i]
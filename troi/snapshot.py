@@ -0,0 +1,98 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pickle
+import random
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotStore:
+    """
+        Record the output of every element of a pipeline run to a directory, or replay previously
+        recorded output instead of reading from the elements. Replaying a recorded run lets downstream
+        elements (blends, filters, the playlist maker) be benchmarked offline against real data.
+
+        Each snapshot is a gzipped pickle, keyed by the path of the element in the pipeline and the simple
+        (str, int, float, bool or None) public attributes of the element, such as the user name or count
+        it was created with. Elements that are not found in the store during a replay are read as usual.
+
+        Snapshots are used by list mode runs (sync, async and compiled) and are ignored in streaming runs.
+        A replayed element is not read, so any side effects of its read() (e.g. writing to the local storage of
+        the patch) do not happen. Elements that must always be read set SNAPSHOT = False.
+
+        :param directory: The directory to store the snapshots in. Created if it does not exist.
+        :param mode: Either SnapshotStore.RECORD or SnapshotStore.REPLAY.
+        :param seed: If given, the random module is seeded with this value at the start of each run, so that elements
+                     that shuffle or sample produce the same output every time. Use a serial executor to keep this deterministic.
+        :param live: Paths of elements to always read, even when replaying. Use this to benchmark one element against
+                     recorded inputs.
+    """
+
+    RECORD = "record"
+    REPLAY = "replay"
+
+    def __init__(self, directory, mode, seed=None, live=()):
+        if mode not in (self.RECORD, self.REPLAY):
+            raise ValueError("Snapshot mode must be '%s' or '%s', not '%s'" % (self.RECORD, self.REPLAY, mode))
+
+        self.directory = directory
+        self.mode = mode
+        self.seed = seed
+        self.live = set(live)
+        self.hits = 0
+        self.misses = 0
+        if mode == self.RECORD:
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        """ Called at the start of each run. """
+
+        if self.seed is not None:
+            random.seed(self.seed)
+
+    @staticmethod
+    def arguments(element):
+        """ Return the dict of attributes that, with its path, identify the output of an element. """
+
+        return {
+            name: value
+            for name, value in vars(element).items()
+            if not name.startswith("_") and name not in ("sources", "patch") and
+            isinstance(value, (str, int, float, bool, type(None)))
+        }
+
+    def filename(self, element, path):
+        key = json.dumps([path, self.arguments(element)], sort_keys=True)
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pickle.gz")
+
+    def replay(self, element, path):
+        """
+            Return a tuple (found, items) with the recorded output of the given element. found is always
+            False when recording, or if the element is live.
+        """
+
+        if self.mode != self.REPLAY or path in self.live:
+            return False, None
+
+        try:
+            with gzip.open(self.filename(element, path), "rb") as f:
+                _, _, items = pickle.load(f)
+        except FileNotFoundError:
+            logger.warning("No snapshot found for %s, reading it instead." % path)
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        return True, items
+
+    def record(self, element, path, items):
+        """ Save the output of the given element, if recording. """
+
+        if self.mode != self.RECORD:
+            return
+
+        with gzip.open(self.filename(element, path), "wb") as f:
+            pickle.dump((path, self.arguments(element), items), f, protocol=pickle.HIGHEST_PROTOCOL)
@@ -1,6 +1,9 @@
+from heapq import nsmallest
 from sys import maxsize
 from operator import attrgetter
 
+import numpy as np
+
 import troi
 from troi import PipelineError, Recording
 
@@ -16,6 +19,8 @@ class YearSortElement(troi.Element):
         :param reverse: Reverse the sort order.
     '''
 
+    BATCH = True
+
     def __init__(self, reverse=False):
         super().__init__()
         self.reverse = reverse
@@ -36,3 +41,82 @@ class YearSortElement(troi.Element):
             return r.year
 
         return sorted(inputs[0], key=year_sorter, reverse=self.reverse)
+
+    def read_batch(self, batches):
+        batch = batches[0]
+        years = np.where(batch.year == 0, maxsize, batch.year)
+        return batch.take(np.argsort(-years if self.reverse else years, kind="stable"))
+
+
+class RankSortElement(troi.Element):
+    '''
+        Sort recordings by one or more numeric keys, highest first, and optionally keep only
+        the first count recordings. When only the top count of many recordings is wanted, they
+        are selected with a heap, in O(n log count) time, rather than by sorting all recordings.
+
+        Each key is the name of an attribute of the recording (e.g. "ranking"), a key in one of the
+        metadata dicts written as "dict.key" (e.g. "musicbrainz.popularity" or "listenbrainz.listen_count"),
+        or a function that is given a recording and returns a number. Ties on the first key are broken
+        by the second key and so on; recordings that tie on all keys stay in input order. Recordings
+        that have no value for a key are sorted after those that do.
+
+        :param keys: A key or a list of keys to sort by. Defaults to "ranking".
+        :param count: The number of recordings to return, or None to return all recordings. Default None.
+        :param ascending: Sort lowest first instead. Default False.
+    '''
+
+    def __init__(self, keys="ranking", count=None, ascending=False):
+        super().__init__()
+        self.keys = keys if isinstance(keys, (list, tuple)) else [keys]
+        self.count = count
+        self.ascending = ascending
+
+    @staticmethod
+    def inputs():
+        return [Recording]
+
+    @staticmethod
+    def outputs():
+        return [Recording]
+
+    @staticmethod
+    def _value_getter(key):
+        if callable(key):
+            return key
+
+        if "." in key:
+            attr, name = key.split(".", 1)
+            return lambda r: getattr(r, attr).get(name)
+
+        return lambda r: getattr(r, key, None)
+
+    def sort_key(self):
+        """
+            Return the function that computes the sort key of a recording: a list that has, for each
+            key, whether the value is missing and the value, negated when sorting highest first.
+        """
+
+        getters = [self._value_getter(key) for key in self.keys]
+        sign = 1 if self.ascending else -1
+
+        def sort_key(r):
+            k = []
+            for getter in getters:
+                value = getter(r)
+                if value is None:
+                    k.extend((1, 0))
+                else:
+                    k.extend((0, sign * value))
+            return k
+
+        return sort_key
+
+    def read(self, inputs):
+        recordings = inputs[0]
+        sort_key = self.sort_key()
+
+        if self.count is not None and self.count < len(recordings):
+            # nsmallest is stable, like sorted()
+            return nsmallest(self.count, recordings, key=sort_key)
+
+        return sorted(recordings, key=sort_key)
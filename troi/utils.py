@@ -5,6 +5,8 @@ import os
 import traceback
 import sys
 
+from more_itertools import roundrobin
+
 logger = logging.getLogger(__name__)
 
 
@@ -79,21 +81,7 @@ def recursively_update_dict(source, overrides):
 
 
 def interleave(lists):
-    """ Return a list with all items from the given lists."""
-
-    result = []
-
-    while True:
-        added = False
-        for l in lists:
-            try:
-                result.append(l.pop(0))
-                added = True
-            except IndexError:
-                pass
-
-        if not added:
-            break
+    """ Return a list with all items from the given lists, taking one item from each list in turn. """
 
-    return result
+    return list(roundrobin(*lists))
 